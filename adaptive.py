@@ -0,0 +1,262 @@
+import numpy as np
+
+from normalization import clamp_nonfinite, measure_range, normalize_into
+
+# leaves are never split below this size in lattice steps, their centers have to be lattice points
+MIN_LEAF = 2
+
+
+class AdaptiveMesh:
+    def __init__(self, max_vertices, tolerance=1e-3, refine_rate=0.1):
+        """Quadtree mesh that spends a vertex budget where the surface bends
+
+        The leaves are squares on the lattice of a 2**k + 1 point grid, k the
+        smallest with 2**k + 1 >= grid_points, so the finest leaves are as
+        fine as the full grid. Every leaf is drawn as a fan around its center.
+        The error of a leaf is how far Z at the center is from the mean of
+        its corners, i.e. how badly the flat leaf approximates the surface.
+
+        Each step adapts the mesh with the errors of the previous step: the
+        worst leaves are split and groups of four siblings that are flat as
+        one leaf are merged, at most refine_rate of the leaves per step and
+        within max_vertices. Leaves with an error below tolerance times the Z
+        range are not split. Neighboring leaves differ by at most one level,
+        so a leaf edge holds at most one corner of a finer neighbor, which
+        joins the fan and the mesh has no cracks.
+        """
+        self.max_vertices = max_vertices
+        self.tolerance = tolerance
+        self.refine_rate = refine_rate
+        self.key = None
+        self.topology = 0  # changes whenever the leaves change
+        self.converged = False  # True once a step left the leaves as they were
+        self.colors = None
+
+    def ensure(self, grid_points, x_limits, y_limits, dtype='float64'):
+        """Start from a uniform mesh if the grid settings changed, return True if so"""
+        dtype = np.dtype(dtype)
+        key = (grid_points, tuple(x_limits), tuple(y_limits), dtype)
+        if key == self.key:
+            return False
+        k = max(1, int(np.ceil(np.log2(max(grid_points - 1, 2)))))
+        self.size = 2 ** k  # lattice steps along each axis
+        self.origin = (float(x_limits[0]), float(y_limits[0]))
+        self.spacing = ((x_limits[1] - x_limits[0]) / self.size, (y_limits[1] - y_limits[0]) / self.size)
+        self.dtype = dtype
+
+        # as many uniform leaves as a quarter of the budget allows
+        levels = min(k - 1, max(0, int(np.log2(max(self.max_vertices, 8) / 8) / 2)))
+        count = 2 ** levels
+        leaf = self.size // count
+        j, i = np.divmod(np.arange(count * count, dtype=np.int64), count)
+        self.i, self.j = i * leaf, j * leaf
+        self.s = np.full(count * count, leaf, dtype=np.int64)
+        self.error = None
+        self.key = key
+        self.topology += 1
+        self.converged = False
+        return True
+
+    # lattice points are keyed row-major like the grid, row * (size + 1) + column
+    def _keys(self, i, j):
+        return j * (self.size + 1) + i
+
+    def _corner_keys(self):
+        """(n, 4) keys of the leaf corners, counter-clockwise from the lower left"""
+        i, j, s = self.i, self.j, self.s
+        return np.stack([self._keys(i, j), self._keys(i + s, j), self._keys(i + s, j + s), self._keys(i, j + s)],
+                        axis=1)
+
+    @staticmethod
+    def _lookup(sorted_keys, keys):
+        """Positions of keys in sorted_keys, -1 where a key is missing"""
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return np.where(sorted_keys[pos] == keys, pos, -1)
+
+    def _split(self, leaves):
+        """Replace the leaves at the given indices by their four children"""
+        keep = np.ones(len(self.s), dtype=bool)
+        keep[leaves] = False
+        i, j, h = self.i[leaves], self.j[leaves], self.s[leaves] // 2
+        self.i = np.concatenate([self.i[keep], i, i + h, i, i + h])
+        self.j = np.concatenate([self.j[keep], j, j, j + h, j + h])
+        self.s = np.concatenate([self.s[keep], h, h, h, h])
+
+    def _siblings(self):
+        """(groups, parent errors): leaf indices of complete sibling quadruples and the error of their parent"""
+        i, j, s = self.i, self.j, self.s
+        first = np.nonzero((s < self.size) & (i % (2 * s) == 0) & (j % (2 * s) == 0))[0]
+        order = np.argsort(self._keys(i, j))
+        leaf_keys = self._keys(i, j)[order]
+        fi, fj, fs = i[first], j[first], s[first]
+        groups = [first]
+        for di, dj in ((1, 0), (0, 1), (1, 1)):
+            pos = self._lookup(leaf_keys, self._keys(fi + di * fs, fj + dj * fs))
+            index = np.where(pos >= 0, order[np.maximum(pos, 0)], -1)
+            groups.append(np.where((index >= 0) & (s[index] == fs), index, -1))
+        groups = np.stack(groups, axis=1)
+        complete = (groups >= 0).all(axis=1)
+        groups, fi, fj, fs = groups[complete], fi[complete], fj[complete], fs[complete]
+
+        # the parent's center and corners are corners of the children, evaluated in the last step
+        z = self._corner_z
+        center = z[self._lookup(self._vertex_keys, self._keys(fi + fs, fj + fs))]
+        corners = [z[self._lookup(self._vertex_keys, self._keys(fi + di, fj + dj))]
+                   for di, dj in ((0, 0), (2 * fs, 0), (0, 2 * fs), (2 * fs, 2 * fs))]
+        error = np.abs(center - np.mean(corners, axis=0))
+        return groups, np.where(np.isfinite(error), error, np.inf)
+
+    def _adapt(self):
+        """Split the worst leaves and merge the flattest sibling groups, within the budget and rate"""
+        n = len(self.s)
+        limit = max(1, int(self.refine_rate * n))
+        max_leaves = max(4, self.max_vertices // 2)  # one center and about one corner per leaf
+        threshold = self.tolerance * self._z_span
+
+        candidates = np.nonzero((self.s > MIN_LEAF) & (self.error > threshold))[0]
+        splits = candidates[np.argsort(-self.error[candidates], kind='stable')][:limit]
+        split_error = self.error[splits]
+
+        groups, merge_error = self._siblings()
+        splitting = np.zeros(n, dtype=bool)
+        splitting[splits] = True
+        free = ~splitting[groups].any(axis=1)
+        groups, merge_error = groups[free], merge_error[free]
+        order = np.argsort(merge_error, kind='stable')[:limit]
+        groups, merge_error = groups[order], merge_error[order]
+        flat = int(np.count_nonzero(merge_error < threshold))
+
+        # the largest number of splits paid for by merging groups that are flatter than the split leaves
+        k = np.arange(len(splits) + 1)
+        merges = np.maximum(flat, -((max_leaves - n - 3 * k) // 3))
+        feasible = merges <= len(groups)
+        worth = np.ones(len(k), dtype=bool)
+        paid = feasible & (merges > flat) & (k > 0)
+        worth[paid] = merge_error[merges[paid] - 1] < split_error[k[paid] - 1]
+        valid = np.nonzero(feasible & worth)[0]
+        if len(valid):
+            k = valid[-1]
+            merges = merges[k]
+        else:  # over budget without enough merges, merge what there is
+            k, merges = 0, len(groups)
+
+        if merges:
+            merged = groups[:merges]
+            first = merged[:, 0]
+            parents = (self.i[first], self.j[first], 2 * self.s[first])
+            keep = np.ones(n, dtype=bool)
+            keep[merged.ravel()] = False
+            # indices of the leaves to split after the merged ones are gone
+            remap = np.cumsum(keep) - 1
+            splits = remap[splits[:k]]
+            self.i = np.concatenate([self.i[keep], parents[0]])
+            self.j = np.concatenate([self.j[keep], parents[1]])
+            self.s = np.concatenate([self.s[keep], parents[2]])
+        else:
+            splits = splits[:k]
+        if len(splits):
+            self._split(splits)
+        balanced = self._balance()
+        return bool(k or merges or balanced)
+
+    def _balance(self):
+        """Split leaves next to leaves more than one level finer, return the number of splits"""
+        total = 0
+        while True:
+            keys = np.unique(self._corner_keys())
+            # only leaves of 4 steps or more have quarter points where a finer neighbor's corner could hang
+            large = np.nonzero(self.s >= 4)[0]
+            i, j, s = self.i[large], self.j[large], self.s[large]
+            q = s // 4
+            quarter = np.stack([self._keys(qi, qj) for qi, qj in (
+                (i + q, j), (i + 3 * q, j), (i + s, j + q), (i + s, j + 3 * q),
+                (i + q, j + s), (i + 3 * q, j + s), (i, j + q), (i, j + 3 * q))], axis=1)
+            hanging = (self._lookup(keys, quarter) >= 0).any(axis=1)
+            unbalanced = large[hanging]
+            if not len(unbalanced):
+                return total
+            self._split(unbalanced)
+            total += len(unbalanced)
+
+    def step(self, formula, params, ranges=None):
+        """Adapt the mesh with the last errors, then evaluate formula at its vertices
+
+        Afterwards ij, faces, z_upload, normals and z_range describe the frame,
+        z_range is measured by the RangeEstimator ranges if given.
+        """
+        if self.error is not None:
+            changed = self._adapt()
+            self.converged = not changed
+            if changed:
+                self.topology += 1
+
+        corners = self._corner_keys()
+        self._vertex_keys, corner_index = np.unique(corners, return_inverse=True)
+        corner_index = corner_index.reshape(-1, 4)
+        n, nc = len(self.s), len(self._vertex_keys)
+        center_index = nc + np.arange(n)
+
+        # lattice coordinates (column, row) of the corners followed by the centers
+        ij = np.empty((nc + n, 2), dtype=np.float32)
+        ij[:nc, 1], ij[:nc, 0] = np.divmod(self._vertex_keys, self.size + 1)
+        ij[nc:, 0] = self.i + self.s // 2
+        ij[nc:, 1] = self.j + self.s // 2
+        self.ij = ij
+        X = (self.origin[0] + ij[:, 0] * self.spacing[0]).astype(self.dtype)[None]
+        Y = (self.origin[1] + ij[:, 1] * self.spacing[1]).astype(self.dtype)[None]
+        a, b, c = (self.dtype.type(value) for value in params)
+        Z = formula.evaluate(X, Y, a, b, c)
+        self.Z = np.array(np.broadcast_to(Z, X.shape)[0], dtype=self.dtype)
+        self._corner_z = self.Z[:nc]
+
+        zc = self.Z[corner_index]
+        error = np.abs(self.Z[nc:] - zc.mean(axis=1))
+        self.error = np.where(np.isfinite(error), error, np.inf)
+        # like FrameBuffers.update_range, NaN and inf are clamped once the errors have seen them
+        self.z_range, finite, self._covers = measure_range(self.Z, ranges)
+        if not finite:
+            clamp_nonfinite(self.Z, self.z_range)
+        self._z_span = float(self.z_range[1] - self.z_range[0])
+        self.z_upload = self.Z.astype(np.float32)
+
+        self.faces = self._triangulate(corner_index, center_index)
+        self.normals = self._slopes()
+        return self
+
+    def normalize(self):
+        """Scale Z into [0, 1] in norm_Z, color buffers follow the vertex count"""
+        if self.colors is None or len(self.colors) != len(self.Z):
+            self.norm_Z = np.empty(len(self.Z), dtype=self.dtype)
+            self.color_index = np.empty(len(self.Z), dtype=np.intp)
+            self.colors = np.empty((len(self.Z), 4), dtype=np.float32)
+        return normalize_into(self.Z, self.norm_Z, self.z_range, True, self._covers)
+
+    def _triangulate(self, corner_index, center_index):
+        """Fan of every leaf around its center through its corners and the corners of finer neighbors"""
+        i, j, s = self.i, self.j, self.s
+        h = s // 2
+        middles = [(i + h, j), (i + s, j + h), (i + h, j + s), (i, j + h)]
+        triangles = []
+        for edge, (mi, mj) in enumerate(middles):
+            p, q = corner_index[:, edge], corner_index[:, (edge + 1) % 4]
+            middle = self._lookup(self._vertex_keys, self._keys(mi, mj))
+            split = middle >= 0
+            # clockwise like the grid strips
+            triangles.append(np.stack([center_index[~split], q[~split], p[~split]], axis=1))
+            triangles.append(np.stack([center_index[split], middle[split], p[split]], axis=1))
+            triangles.append(np.stack([center_index[split], q[split], middle[split]], axis=1))
+        return np.concatenate(triangles).astype(np.uint32)
+
+    def _slopes(self):
+        """(-dZ/dx, -dZ/dy) per vertex from the area weighted normals of its triangles"""
+        x = self.ij[:, 0] * np.float32(self.spacing[0])
+        y = self.ij[:, 1] * np.float32(self.spacing[1])
+        P = np.stack([x, y, self.z_upload], axis=1)
+        f = self.faces
+        # faces are clockwise, (p2 - p0) x (p1 - p0) points up
+        normal = np.cross(P[f[:, 2]] - P[f[:, 0]], P[f[:, 1]] - P[f[:, 0]])
+        vertices = len(P)
+        summed = np.stack([np.bincount(f.ravel(), weights=np.repeat(normal[:, axis], 3), minlength=vertices)
+                           for axis in range(3)], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (summed[:, :2] / summed[:, 2:]).astype(np.float32)
@@ -59,7 +59,7 @@ EXAMPLE_FUNCTIONS  = [  '(a * np.cos(np.pi * X) * np.cos(np.pi * Y) + b * np.sin
 
 # following np functions are allowed to be written in the input line
 ALLOWED_CALCULATIONS = ["np.arcsinh", "np.arccosh", "np.arctanh",
-                        "np.arcsin", "np.arccos", "np.arctan", 
+                        "np.arcsin", "np.arccos", "np.arctan", "np.arctan2",
                         "np.sinh", "np.cosh", "np.tanh",
                         "np.sin", "np.cos", "np.tan",
                         "np.sqrt", "np.exp", "np.log", "np.abs", 
@@ -131,7 +131,7 @@ INFO_TEXT = ("You must use the following variables in your equation:\n"
              "X, Y, a, b, c\nOther variables are not allowed.\n\n"
              "You can use the following np calculations in your formula:\n"
              "np.sqrt(), np.exp(), np.log(), np.abs(), np.pi(), np.e()\n"
-             "np.arctan(), np.arcsin(), np.arccos(), np.arccosh(), np.arcsinh(), \n"
+             "np.arctan(), np.arctan2(), np.arcsin(), np.arccos(), np.arccosh(), np.arcsinh(), \n"
              "np.arctanh(), np.sinh(), np.cosh(), np.tanh(), np.sin(), np.cos(), np.tan()\n\n"
              "Example functions are available to show you the possibilities.")
 
@@ -169,6 +169,81 @@ ALLOWED_COLORMAPS = ["GrBu",
 
 # Starting colormap
 DEFAULT_CMAP = "viridis"
+
+# "gpu" colors the surface in the shader from z, "cpu" maps and uploads per-vertex colors
+COLORMAP_MODE = "gpu"
+
+# compute frames on a worker thread while the GUI thread renders, with this many ring buffers
+BACKGROUND_COMPUTE = True
+PIPELINE_SLOTS = 3
+
+# fixed simulation step in seconds and how the animation reacts when frames take longer, catch-up
+# advances up to CATCH_UP_RATE steps per shown frame while it runs behind
+SIMULATION_STEP = 1 / 60
+CATCH_UP_RATE = 4
+TIMING_MODES = ["Real-time (skip steps)",
+                "Every step (slow down)",
+                "Catch-up (speed up later)"]
+
+# memory budget of the frame cache for periodic animations (0 disables it); frames are cached only
+# while one period of the scaling rules fits, their phases are then snapped to the simulation steps
+FRAME_CACHE_MB = 512
+
+# precision of the grid, the evaluation and all per-frame buffers, float32 halves the memory traffic
+PRECISIONS = ["float32", "float64"]
+DEFAULT_PRECISION = "float32"
+
+# evaluation backends, numexpr and numba are optional and fall back to numpy when missing
+EVALUATION_BACKENDS = ["auto", "numpy", "numexpr", "numba"]
+DEFAULT_BACKEND = "auto"
+
+# tiled evaluation: worker threads (0 uses all cores), grid points per tile and the largest grid
+EVALUATION_THREADS = 0
+TILE_POINTS = 65536
+MAX_GRID_POINTS = 4096
+
+# batched evaluation of several frames: bytes of Z per broadcast pass
+BATCH_CHUNK_BYTES = 1 << 20
+
+# stage timings: samples per stage for the rolling percentiles and where recorded traces are written
+PROFILER_WINDOW = 300
+TRACE_DIRECTORY = "."
+
+# shared memory frame bus between app_frame_server.py and viewers: default name and ring slots
+FRAME_BUS_NAME = "function_plotter"
+FRAME_BUS_SLOTS = 4
+
+# frame pacing: highest frame rate while animating (0 = as fast as possible) and whether updates
+# stop while nothing animates, changes or moves
+FPS_CAP = 60
+IDLE_SUSPEND = True
+
+# trial evaluation of new formulas in a worker process: time limit in seconds (0 disables the
+# trial), largest frame allocation in MB and the NaN/inf fraction that is worth a warning
+TRIAL_TIMEOUT = 1.0
+TRIAL_MAX_FRAME_MB = 1024
+TRIAL_NONFINITE_WARN = 0.05
+
+# adaptive level of detail: default target frame rate and the lowest resolution it may pick
+LOD_TARGET_FPS = 30
+LOD_MIN_POINTS = 40
+
+# adaptive mesh: default and largest vertex budget, the error in units of the Z range below which
+# leaves are not split and the fraction of the leaves split or merged per frame
+MESH_VERTICES = 65536
+MESH_MAX_VERTICES = 1048576
+MESH_TOLERANCE = 1e-3
+MESH_REFINE_RATE = 0.1
+
+# color range: the percentage of values clipped at both ends and the weight of the previous range in
+# its moving average over the frames
+RANGE_PERCENTILE = 0.0
+RANGE_SMOOTHING = 0.0
+
+# several surfaces in one view: most surfaces at once and the gap between neighbours in units of
+# the X range
+MAX_SURFACES = 4
+SURFACE_GAP = 0.1
 # Possible colormaps for the plot, some others are not compatible with the program
 ALLOWED_COLORMAPS = ["GrBu",
                      "GrBu_d",
@@ -0,0 +1,78 @@
+import argparse
+import signal
+import sys
+import time
+
+import app_config
+from app_precompute import parse_rule
+from evaluation import BackendSelector, NumbaBackend, NumexprBackend, TiledEvaluator
+from expression import FormulaError, compile_formula
+from frame_bus import FramePublisher
+from grid import FrameBuffers, GridBuffers
+from scheduler import REAL_TIME, SimulationClock, parameters_at
+
+
+def main():
+    """Evaluate the animation once and publish the frames to viewers over shared memory."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--name', default=app_config.FRAME_BUS_NAME, help="shared memory name of the bus")
+    parser.add_argument('--formula', default=app_config.START_FUNCTION)
+    parser.add_argument('--rules', type=parse_rule, nargs=3, default=[(0, 0.5), (1, 0.5), (3, 0.5)],
+                        metavar='RULE:SPEED', help="scaling rules of a, b and c, e.g. sin:50 cos:50 static")
+    parser.add_argument('--x-limit', type=float, default=2)
+    parser.add_argument('--y-limit', type=float, default=2)
+    parser.add_argument('--grid-points', type=int, default=100)
+    parser.add_argument('--precision', choices=app_config.PRECISIONS, default=app_config.DEFAULT_PRECISION)
+    parser.add_argument('--backend', choices=app_config.EVALUATION_BACKENDS, default=app_config.DEFAULT_BACKEND)
+    parser.add_argument('--dt', type=float, default=app_config.SIMULATION_STEP, help="seconds between frames")
+    args = parser.parse_args()
+
+    try:
+        formula = compile_formula(args.formula)
+    except FormulaError as e:
+        print(f"Error during compile_formula: {e}")
+        sys.exit(1)
+    threads = app_config.EVALUATION_THREADS or None
+    evaluator = BackendSelector([TiledEvaluator(threads, app_config.TILE_POINTS), NumexprBackend(threads),
+                                 NumbaBackend(threads)], args.backend)
+    grid = GridBuffers()
+    grid.ensure(args.grid_points, (-args.x_limit, args.x_limit), (-args.y_limit, args.y_limit), args.precision)
+    frame = FrameBuffers()
+    frame.ensure(grid)
+    clock = SimulationClock(args.dt, REAL_TIME)
+    publisher = FramePublisher(args.name, app_config.FRAME_BUS_SLOTS)
+    print(f"Publishing {args.grid_points}² frames on {args.name!r}, stop with Ctrl+C")
+
+    # a terminated server removes its shared memory like one stopped with Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    last = time.perf_counter()
+    reported, published = last, 0
+    try:
+        while True:
+            now = time.perf_counter()
+            clock.tick(now - last)
+            last = now
+            step = clock.next_step()
+            if step is None:
+                time.sleep(max(0.0, clock.step_time(clock.shown_step + 1) - clock.wall_time))
+                continue
+            params = parameters_at(args.rules, clock.step_time(step))
+            evaluator.evaluate(formula, grid, params, frame.Z)
+            frame.store_z()
+            frame.update_range()
+            frame.compute_normals()
+            publisher.publish(frame, grid, step)
+            clock.mark_shown(step)
+            published += 1
+            if now - reported > 5:
+                print(f"{published / (now - reported):.1f} frames/s, lag {clock.lag:.2f} s")
+                reported, published = now, 0
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+        evaluator.shutdown()
+
+
+if __name__ == '__main__':
+    main()
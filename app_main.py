@@ -1,3 +1,4 @@
+import argparse
 import sys
 from PyQt6 import QtWidgets
 from vispy import app
@@ -8,12 +9,18 @@ import app_config
 
 def main():
     """Entry point for the application."""
-    appQt = QtWidgets.QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="3D function plotter")
+    parser.add_argument('--attach', metavar='NAME', help="show the frames of a running app_frame_server.py")
+    args, qt_args = parser.parse_known_args()
+
+    appQt = QtWidgets.QApplication(sys.argv[:1] + qt_args)
     appQt.setStyleSheet(app_config.STYLE_SHEET)  # apply stylesheet globally
     function_plotter = FunctionPlotterUI()
     function_plotter.setGeometry(WINDOW_POS[0], WINDOW_POS[1], WINDOW_SIZE[0], WINDOW_SIZE[1])
     function_plotter.setWindowTitle("Function Plotter")
     function_plotter.show()
+    if args.attach:
+        function_plotter.attach_frame_server(args.attach)
     app.run()
 
 if __name__ == '__main__':
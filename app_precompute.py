@@ -0,0 +1,57 @@
+import argparse
+import sys
+import time
+
+import app_config
+from expression import FormulaError
+from frame_store import precompute
+from scheduler import RULE_NAMES
+
+
+def parse_rule(text):
+    """'sin:50' -> (rule index, speed) with the speed in percent like the speed options of the UI"""
+    name, _, speed = text.partition(':')
+    if name not in RULE_NAMES:
+        raise argparse.ArgumentTypeError(f"Unknown scaling rule {name!r}, use one of {', '.join(RULE_NAMES)}")
+    try:
+        return RULE_NAMES.index(name), float(speed or 100) / 100
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"The speed of {text!r} is not a number") from None
+
+
+def main():
+    """Precompute an animation into a memory-mapped frame store without opening a window."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('output', help="frame store directory to write")
+    parser.add_argument('--formula', default=app_config.START_FUNCTION)
+    parser.add_argument('--rules', type=parse_rule, nargs=3, default=[(0, 0.5), (1, 0.5), (3, 0.5)],
+                        metavar='RULE:SPEED', help="scaling rules of a, b and c, e.g. sin:50 cos:50 static")
+    parser.add_argument('--x-limit', type=float, default=2)
+    parser.add_argument('--y-limit', type=float, default=2)
+    parser.add_argument('--grid-points', type=int, default=100)
+    parser.add_argument('--dt', type=float, default=app_config.SIMULATION_STEP, help="seconds between frames")
+    parser.add_argument('--start', type=float, default=0.0, help="first second of the animation")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of animation to store")
+    parser.add_argument('--normals', action='store_true', help="also store the normals")
+    parser.add_argument('--colormap', choices=app_config.ALLOWED_COLORMAPS,
+                        help="also store the colors of the cpu colormap mode")
+    args = parser.parse_args()
+
+    def progress(done, total):
+        print(f"\r{done}/{total} frames", end='', flush=True)
+
+    start = time.perf_counter()
+    try:
+        meta = precompute(args.output, args.formula, args.rules, (-args.x_limit, args.x_limit),
+                          (-args.y_limit, args.y_limit), args.grid_points, args.dt, args.start,
+                          args.start + args.duration, normals=args.normals, colormap=args.colormap,
+                          progress=progress)
+    except (FormulaError, ValueError, OSError) as e:
+        print(f"Error during precompute: {e}")
+        sys.exit(1)
+    print(f"\nStored {meta['frames']} frames of {args.grid_points}² in {args.output} "
+          f"({time.perf_counter() - start:.1f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,17 @@
+import os
+import time
+
 import numpy as np
 from PyQt6 import QtWidgets
 from PyQt6.QtCore import Qt
 from PyQt6.QtWidgets import (QVBoxLayout, QPushButton, QWidget, QSplitter, QLabel,
-                           QSpinBox, QComboBox, QGridLayout, QLineEdit, QHBoxLayout, QCheckBox, QFrame)
+                           QSpinBox, QComboBox, QGridLayout, QLineEdit, QHBoxLayout, QCheckBox, QFrame,
+                           QFileDialog, QInputDialog, QDoubleSpinBox)
 from vispy import scene
 from vispy.color.colormap import get_colormaps
 
 import app_config
+from expression import validate_formula
 from logic import FunctionPlotter
 
 class ObjectWidget(QWidget):
@@ -44,6 +49,12 @@ class ObjectWidget(QWidget):
         self.info_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.info_label.setStyleSheet("color: red")
 
+        # Keep the current function as another surface next to the main one, drawn in the same pass
+        self.add_surface_button = QPushButton("Add Surface")
+        self.add_surface_button.setToolTip("Show the current function and scaling rules as another surface")
+        self.clear_surfaces_button = QPushButton("Clear Surfaces")
+        self.l_surfaces = QLabel("")
+
         # Add a small collapse button for hiding settings (will be placed at bottom)
         self.collapse_button = QPushButton("<")
         self.collapse_button.setFlat(True)
@@ -83,6 +94,29 @@ class ObjectWidget(QWidget):
         self.scaling_speed_c.addItems(app_config.SPEED_OPTIONS)
         self.scaling_speed_c.setCurrentIndex(4)
 
+        # Simulation timing when frames take longer than the simulation step
+        self.l_timing_mode = QLabel("Timing Mode")
+        self.timing_mode = QComboBox(self)
+        self.timing_mode.addItems(app_config.TIMING_MODES)
+
+        # Highest frame rate while animating, updates stop entirely while nothing changes
+        self.l_fps_cap = QLabel("Frame Rate Cap")
+        self.fps_cap = QSpinBox()
+        self.fps_cap.setMinimum(0)
+        self.fps_cap.setMaximum(240)
+        self.fps_cap.setSpecialValueText("Off")
+        self.fps_cap.setValue(app_config.FPS_CAP)
+
+        # Play an animation precomputed with app_precompute.py instead of evaluating
+        self.playback_button = QPushButton("Play Frame Store...")
+        self.playback_button.setCheckable(True)
+        self.playback_button.setToolTip("Stream the frames of a directory written by app_precompute.py")
+
+        # Show the frames of a running app_frame_server.py instead of computing them
+        self.bus_button = QPushButton("Attach to Frame Server...")
+        self.bus_button.setCheckable(True)
+        self.bus_button.setToolTip("Render the frames another process publishes over shared memory")
+
     def create_limits_section(self):
         """Create grid limits and color map section"""
         self.l_limits_placeholder = QLabel("")
@@ -105,12 +139,45 @@ class ObjectWidget(QWidget):
         self.y_limits.setValue(2)
 
         # Grid resolution
-        self.l_grid_points = QLabel("Grid Resolution (between 10 and 1000)")
+        self.l_grid_points = QLabel(f"Grid Resolution (between 10 and {app_config.MAX_GRID_POINTS})")
         self.grid_points = QSpinBox()
         self.grid_points.setMinimum(10)
-        self.grid_points.setMaximum(1000)
+        self.grid_points.setMaximum(app_config.MAX_GRID_POINTS)
         self.grid_points.setValue(100)
 
+        # Adaptive resolution, lowers the grid resolution to reach the target FPS
+        self.adaptive_lod = QCheckBox("Adaptive Resolution, target FPS")
+        self.adaptive_lod.setChecked(False)
+        self.adaptive_lod.setToolTip("Lower the resolution while animating or moving the camera, refine when idle")
+        self.target_fps = QSpinBox()
+        self.target_fps.setMinimum(5)
+        self.target_fps.setMaximum(144)
+        self.target_fps.setValue(app_config.LOD_TARGET_FPS)
+
+        # Adaptive mesh, refines a quadtree where the surface bends instead of sampling the whole grid
+        self.adaptive_mesh = QCheckBox("Adaptive Mesh, max vertices")
+        self.adaptive_mesh.setChecked(False)
+        self.adaptive_mesh.setToolTip("Spend the vertices where the surface bends, as fine as the grid resolution")
+        self.mesh_vertices = QSpinBox()
+        self.mesh_vertices.setMinimum(1000)
+        self.mesh_vertices.setMaximum(app_config.MESH_MAX_VERTICES)
+        self.mesh_vertices.setSingleStep(1000)
+        self.mesh_vertices.setValue(app_config.MESH_VERTICES)
+
+        # Numeric precision of the computation
+        self.l_precision = QLabel("Precision")
+        self.precision = QComboBox(self)
+        self.precision.addItems(app_config.PRECISIONS)
+        self.precision.setCurrentText(app_config.DEFAULT_PRECISION)
+        self.precision.setToolTip("float32 halves the memory traffic, large powers are still computed in float64")
+
+        # Evaluation backend, the optional ones are used only when installed
+        self.l_backend = QLabel("Evaluation Backend")
+        self.backend = QComboBox(self)
+        self.backend.addItems(app_config.EVALUATION_BACKENDS)
+        self.backend.setCurrentText(app_config.DEFAULT_BACKEND)
+        self.backend.setToolTip("auto times every available backend on the formula and keeps the fastest")
+
         # Color map selection
         self.l_cmap = QLabel("Color Map ")
         self.cmap = sorted(get_colormaps().keys())
@@ -120,6 +187,20 @@ class ObjectWidget(QWidget):
         # define default color map
         self.combo.setCurrentText(app_config.DEFAULT_CMAP)
 
+        # Color range: share of the values clipped at both ends and smoothing of the range over frames
+        self.l_range_percentile = QLabel("Color Range Clipping (%)")
+        self.range_percentile = QDoubleSpinBox()
+        self.range_percentile.setRange(0.0, 10.0)
+        self.range_percentile.setSingleStep(0.5)
+        self.range_percentile.setValue(app_config.RANGE_PERCENTILE)
+        self.range_percentile.setToolTip("Ignore this share of the highest and lowest values, e.g. near poles")
+        self.l_range_smoothing = QLabel("Color Range Smoothing")
+        self.range_smoothing = QDoubleSpinBox()
+        self.range_smoothing.setRange(0.0, 0.99)
+        self.range_smoothing.setSingleStep(0.05)
+        self.range_smoothing.setValue(app_config.RANGE_SMOOTHING)
+        self.range_smoothing.setToolTip("Weight of the previous range, higher values stop the colors from flickering")
+
     def create_info_section(self):
         """Create guidelines section"""
         self.l_info_placeholder = QLabel("")
@@ -145,6 +226,9 @@ class ObjectWidget(QWidget):
         fn_box.addWidget(self.function_input, 3, 0)
         fn_box.addWidget(self.l_function_refresher, 3, 1)
         fn_box.addWidget(self.info_label, 4, 0, 1, 2)
+        fn_box.addWidget(self.add_surface_button, 5, 0)
+        fn_box.addWidget(self.clear_surfaces_button, 5, 1)
+        fn_box.addWidget(self.l_surfaces, 6, 0, 1, 2)
 
         # Dynamic Scaling Rules section
         sec_sc = QFrame()
@@ -159,6 +243,12 @@ class ObjectWidget(QWidget):
         sc_box.addWidget(self.scaling_speed_b, 2, 1)
         sc_box.addWidget(self.scaling_rule_c, 3, 0)
         sc_box.addWidget(self.scaling_speed_c, 3, 1)
+        sc_box.addWidget(self.l_timing_mode, 4, 0)
+        sc_box.addWidget(self.timing_mode, 4, 1)
+        sc_box.addWidget(self.l_fps_cap, 5, 0)
+        sc_box.addWidget(self.fps_cap, 5, 1)
+        sc_box.addWidget(self.playback_button, 6, 0, 1, 2)
+        sc_box.addWidget(self.bus_button, 7, 0, 1, 2)
 
         # Grid Limits and Color Map section
         sec_lim = QFrame()
@@ -173,8 +263,20 @@ class ObjectWidget(QWidget):
         lim_box.addWidget(self.y_limits, 2, 1)
         lim_box.addWidget(self.l_grid_points, 3, 0)
         lim_box.addWidget(self.grid_points, 3, 1)
-        lim_box.addWidget(self.l_cmap, 4, 0)
-        lim_box.addWidget(self.combo, 4, 1)
+        lim_box.addWidget(self.adaptive_lod, 4, 0)
+        lim_box.addWidget(self.target_fps, 4, 1)
+        lim_box.addWidget(self.adaptive_mesh, 5, 0)
+        lim_box.addWidget(self.mesh_vertices, 5, 1)
+        lim_box.addWidget(self.l_precision, 6, 0)
+        lim_box.addWidget(self.precision, 6, 1)
+        lim_box.addWidget(self.l_backend, 7, 0)
+        lim_box.addWidget(self.backend, 7, 1)
+        lim_box.addWidget(self.l_cmap, 8, 0)
+        lim_box.addWidget(self.combo, 8, 1)
+        lim_box.addWidget(self.l_range_percentile, 9, 0)
+        lim_box.addWidget(self.range_percentile, 9, 1)
+        lim_box.addWidget(self.l_range_smoothing, 10, 0)
+        lim_box.addWidget(self.range_smoothing, 10, 1)
 
         # Guidelines section
         sec_info = QFrame()
@@ -204,7 +306,17 @@ class ObjectWidget(QWidget):
         self.show_fps_checkbox.setChecked(True)
         self.show_fps_checkbox.setToolTip("Toggle FPS display on the canvas")
 
+        # stage timing breakdown and trace recording
+        self.show_stages_checkbox = QCheckBox("Stage Timings")
+        self.show_stages_checkbox.setChecked(False)
+        self.show_stages_checkbox.setToolTip("Show p50/p95/p99 of every frame stage on the canvas")
+        self.trace_button = QPushButton("Record Trace")
+        self.trace_button.setCheckable(True)
+        self.trace_button.setToolTip("Record all stage timings and save them as Chrome trace JSON when stopped")
+
         bottom_bar.addWidget(self.show_fps_checkbox)
+        bottom_bar.addWidget(self.show_stages_checkbox)
+        bottom_bar.addWidget(self.trace_button)
         bottom_bar.addStretch(1)
         bottom_bar.addWidget(self.l_hide_settings)
         bottom_bar.addWidget(self.collapse_button)
@@ -289,8 +401,27 @@ class FunctionPlotterUI(QtWidgets.QMainWindow):
         self.props.y_limits.valueChanged.connect(self.update_y_limits)
         self.props.grid_points.valueChanged.connect(self.update_grid_points)
         self.props.combo.currentIndexChanged.connect(self.update_colormap)
+        self.props.range_percentile.valueChanged.connect(self.update_range_percentile)
+        self.props.range_smoothing.valueChanged.connect(self.update_range_smoothing)
+        self.props.precision.currentIndexChanged.connect(self.update_precision)
+        self.props.backend.currentIndexChanged.connect(self.update_backend)
+        self.props.adaptive_lod.toggled.connect(self.update_adaptive_lod)
+        self.props.target_fps.valueChanged.connect(self.update_target_fps)
+        self.props.adaptive_mesh.toggled.connect(self.update_adaptive_mesh)
+        self.props.mesh_vertices.valueChanged.connect(self.update_mesh_vertices)
+        for combo in (self.props.scaling_rule_a, self.props.scaling_rule_b, self.props.scaling_rule_c,
+                      self.props.scaling_speed_a, self.props.scaling_speed_b, self.props.scaling_speed_c):
+            combo.currentIndexChanged.connect(self.update_scaling_rules)
+        self.props.timing_mode.currentIndexChanged.connect(self.update_timing_mode)
+        self.props.fps_cap.valueChanged.connect(self.update_fps_cap)
+        self.props.playback_button.toggled.connect(self.toggle_playback)
+        self.props.bus_button.toggled.connect(self.toggle_bus)
+        self.props.add_surface_button.clicked.connect(self.add_surface)
+        self.props.clear_surfaces_button.clicked.connect(self.clear_surfaces)
         # connect FPS toggle
         self.props.show_fps_checkbox.toggled.connect(self.update_show_fps)
+        self.props.show_stages_checkbox.toggled.connect(self.update_show_stages)
+        self.props.trace_button.toggled.connect(self.toggle_trace)
 
     # Add the two missing methods to control the collapse/restore behavior
     def minimize_settings(self):
@@ -316,8 +447,96 @@ class FunctionPlotterUI(QtWidgets.QMainWindow):
     def update_grid_points(self):
         self.plotter.update_grid_points(self.props.grid_points.value())
         
+    def update_precision(self):
+        self.plotter.update_precision(self.props.precision.currentText())
+
+    def update_backend(self):
+        self.plotter.update_backend(self.props.backend.currentText())
+
     def update_colormap(self):
         self.plotter.update_colormap(self.props.combo.currentText())
+
+    def update_range_percentile(self):
+        self.plotter.update_range_percentile(self.props.range_percentile.value())
+
+    def update_range_smoothing(self):
+        self.plotter.update_range_smoothing(self.props.range_smoothing.value())
+
+    def update_adaptive_lod(self):
+        self.plotter.update_adaptive_lod(self.props.adaptive_lod.isChecked())
+
+    def update_target_fps(self):
+        self.plotter.update_target_fps(self.props.target_fps.value())
+
+    def update_adaptive_mesh(self):
+        self.plotter.update_adaptive_mesh(self.props.adaptive_mesh.isChecked())
+
+    def update_mesh_vertices(self):
+        self.plotter.update_mesh_vertices(self.props.mesh_vertices.value())
+
+    def update_scaling_rules(self):
+        self.plotter.update_scaling_rules()
+
+    def update_timing_mode(self):
+        self.plotter.update_timing_mode(self.props.timing_mode.currentIndex())
+
+    def update_fps_cap(self):
+        self.plotter.set_fps_cap(self.props.fps_cap.value())
+
+    def add_surface(self):
+        if not self.plotter.add_surface():
+            self.props.info_label.setText(f"At most {app_config.MAX_SURFACES} surfaces can be shown.")
+        self.update_surfaces_label()
+
+    def clear_surfaces(self):
+        self.plotter.clear_surfaces()
+        self.update_surfaces_label()
+
+    def update_surfaces_label(self):
+        lines = [f"{layer.colormap.name}: {layer.formula.text}" for layer in self.plotter.surfaces]
+        self.props.l_surfaces.setText("\n".join(lines))
+
+    def toggle_playback(self, playing):
+        button = self.props.playback_button
+        if not playing:
+            self.plotter.stop_playback()
+            button.setText("Play Frame Store...")
+            return
+        path = QFileDialog.getExistingDirectory(self, "Frame Store Directory")
+        if path and self.plotter.start_playback(path):
+            button.setText("Stop Playback")
+        else:
+            button.blockSignals(True)
+            button.setChecked(False)
+            button.blockSignals(False)
+
+    def toggle_bus(self, attached, name=None):
+        button = self.props.bus_button
+        if not attached:
+            self.plotter.detach_bus()
+            button.setText("Attach to Frame Server...")
+            return
+        if name is None:
+            name, ok = QInputDialog.getText(self, "Frame Server", "Shared memory name", text=app_config.FRAME_BUS_NAME)
+            if not ok:
+                name = None
+        if name and self.plotter.attach_bus(name):
+            button.setText("Detach from Frame Server")
+        else:
+            button.blockSignals(True)
+            button.setChecked(False)
+            button.blockSignals(False)
+
+    def attach_frame_server(self, name):
+        """Attach to a frame server by name, as if chosen in the UI"""
+        self.props.bus_button.blockSignals(True)
+        self.props.bus_button.setChecked(True)
+        self.props.bus_button.blockSignals(False)
+        self.toggle_bus(True, name)
+
+    def closeEvent(self, event):
+        self.plotter.stop()
+        super().closeEvent(event)
         
     def change_function(self):
         """Validate and update the function"""
@@ -329,30 +548,30 @@ class FunctionPlotterUI(QtWidgets.QMainWindow):
             self.props.info_label.setText(error_message)
             return
         
-        # Clear error message and update function
-        self.props.info_label.setText("")
-        self.plotter.update_function(function_input)
+        # Trial evaluation on sample grids, may reject the formula or adjust the settings
+        accepted, message = self.plotter.check_function(function_input)
+        self.props.info_label.setText(message)
+        if accepted:
+            self.plotter.update_function(function_input)
         
     # forward checkbox state to plotter
     def update_show_fps(self, checked=None):
         self.plotter.set_show_fps(self.props.show_fps_checkbox.isChecked())
 
+    def update_show_stages(self, checked=None):
+        self.plotter.set_show_stages(self.props.show_stages_checkbox.isChecked())
+
+    def toggle_trace(self, recording):
+        if recording:
+            self.plotter.start_trace()
+            self.props.trace_button.setText("Stop Trace")
+            return
+        path = os.path.join(app_config.TRACE_DIRECTORY, time.strftime("trace_%Y%m%d_%H%M%S.json"))
+        count = self.plotter.stop_trace(path)
+        self.props.trace_button.setText("Record Trace")
+        print(f"Saved {count} trace events to {path}")
+
     def validate_function_input(self, function_input):
         """Validate if the function input contains required variables and no illegal ones"""
-        # Filter out allowed special functions
-        filtered_input = function_input
-        for func in app_config.ALLOWED_CALCULATIONS:
-            filtered_input = filtered_input.replace(func, "")
-            
-        # Check for required variables
-        for var in ['X', 'Y', 'a', 'b', 'c']:
-            if var not in filtered_input:
-                return False, f"The function input must contain X, Y, a, b, c. You are missing {var}."
-                
-        # Check for illegal variables
-        illegal_chars = [char for char in filtered_input if char.isalpha() and char not in ['X', 'Y', 'a', 'b', 'c']]
-        if illegal_chars:
-            return False, f"The function input contains other variables than X, Y, a, b, c. Remove the character {illegal_chars[0]}."
-            
-        return True, ""
-        return True, ""
+        # Parsing also compiles and caches the formula for the plotter
+        return validate_formula(function_input)
@@ -0,0 +1,236 @@
+"""Headless benchmark of the frame pipeline over the example formulas.
+
+Runs every formula of app_config.EXAMPLE_FUNCTIONS over a matrix of grid
+sizes, dtypes and evaluation backends through the same stages as
+FunctionPlotter: evaluate (through a BackendSelector, so symmetric formulas
+are mirrored as in the app), normalize, colormap (cpu colormap mode only),
+normals (the per-vertex streams) and upload (set_data and a render of an
+offscreen canvas). --raw-evaluate adds evaluate_raw, the backend on the full
+grid without the selector. Each stage reports its median and minimum time, the bytes
+it leaves allocated and its peak allocation.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --output new.json --baseline results.json
+
+With --baseline the run is compared against an earlier JSON file and the exit
+status is 1 if a stage got slower by more than --tolerance. The upload stage
+needs an OpenGL context without a window, e.g. EGL_PLATFORM=surfaceless with
+--gl egl, or --gl none to skip it.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import app_config
+from colormap import ColormapLUT
+from evaluation import BackendSelector, NumbaBackend, NumexprBackend, TiledEvaluator
+from expression import compile_formula
+from grid import FrameBuffers, GridBuffers
+from instrumentation import AllocationCounter
+
+PARAMS = (0.5, 0.7, 0.3)
+
+
+class OffscreenSurface:
+    def __init__(self, gl_app, colormap_mode, colormap):
+        """GridSurface in a canvas that is never shown, rendered into an offscreen buffer"""
+        import vispy
+        vispy.use(app=gl_app)
+        from vispy import scene
+        from surface import GridSurface
+
+        self.canvas = scene.SceneCanvas(show=False, size=(800, 600))
+        view = self.canvas.central_widget.add_view()
+        view.camera = 'turntable'
+        view.camera.fov = app_config.FOV
+        view.camera.distance = app_config.CAMERA_DISTANCE
+        self.surface = GridSurface(np.zeros(2), np.zeros(2), colormap_mode=colormap_mode, colormap=colormap.table,
+                                   parent=view.scene)
+        self.generation = None
+
+    def upload(self, frame):
+        """Stream one frame to the GPU and draw it"""
+        if self.generation != frame.generation:
+            self.surface.set_grid(frame.x, frame.y)
+            self.generation = frame.generation
+        colors = frame.colors if self.surface.colormap_mode == 'cpu' else None
+        self.surface.set_data(frame.z_upload, frame.normals.reshape(-1, 2), colors, frame.z_range)
+        self.canvas.render()
+
+
+def stage_functions(backend, formula, grid, frame, colormap, offscreen, colormap_mode, raw_evaluate=False):
+    """{stage: function} of one benchmark case, in pipeline order"""
+    selector = BackendSelector([backend], backend.name)
+
+    def evaluate():
+        selector.evaluate(formula, grid, PARAMS, frame.Z)
+        frame.store_z()
+
+    def evaluate_raw():
+        backend.evaluate(formula, grid, PARAMS, frame.Z)
+        frame.store_z()
+
+    def normalize():
+        if colormap_mode == 'cpu':
+            frame.normalize()
+        else:
+            frame.update_range()
+
+    stages = {'evaluate': evaluate}
+    if raw_evaluate:
+        stages['evaluate_raw'] = evaluate_raw
+    stages['normalize'] = normalize
+    if colormap_mode == 'cpu':
+        stages['colormap'] = lambda: colormap.map(frame.norm_Z, frame.color_index, frame.colors)
+    stages['normals'] = frame.compute_normals
+    if offscreen is not None:
+        stages['upload'] = lambda: offscreen.upload(frame)
+    return stages
+
+
+def run_case(grid, backend, formula, points, dtype, colormap, offscreen, colormap_mode, repeat, raw_evaluate=False):
+    """Time and count allocations of every stage for one formula, grid size, dtype and backend"""
+    # one grid for all cases, its generation tells the offscreen surface when to upload x/y again
+    grid.ensure(points, (-2, 2), (-2, 2), dtype)
+    grid.clear_invariants()
+    frame = FrameBuffers()
+    frame.ensure(grid)
+    stages = stage_functions(backend, formula, grid, frame, colormap, offscreen, colormap_mode, raw_evaluate)
+
+    # warm-up: compiles Numba kernels, fills the invariant cache and uploads the grid
+    for function in stages.values():
+        function()
+
+    times = {name: [] for name in stages}
+    for _ in range(repeat):
+        for name, function in stages.items():
+            start = time.perf_counter()
+            function()
+            times[name].append(time.perf_counter() - start)
+
+    results = {}
+    for name, function in stages.items():
+        with AllocationCounter() as counter:
+            function()
+        results[name] = {
+            'median_ms': float(np.median(times[name]) * 1000),
+            'min_ms': float(np.min(times[name]) * 1000),
+            'alloc_bytes': counter.net,
+            'peak_bytes': counter.peak,
+        }
+    return results
+
+
+def compare(results, baseline, tolerance, min_ms=0.1):
+    """Print the stages that got slower than in baseline, return their number"""
+    def key(record):
+        return record['formula'], record['grid_points'], record['dtype'], record['backend']
+
+    old = {key(record): record for record in baseline['results']}
+    regressions = 0
+    for record in results:
+        previous = old.get(key(record))
+        if previous is None:
+            continue
+        for stage, values in record['stages'].items():
+            before = previous['stages'].get(stage)
+            if before is None:
+                continue
+            now, then = values['median_ms'], before['median_ms']
+            if now > then * (1 + tolerance) and now - then > min_ms:
+                regressions += 1
+                print(f"REGRESSION {stage:>9} {then:9.2f} -> {now:9.2f} ms  "
+                      f"{record['grid_points']}² {record['dtype']} {record['backend']}  {record['formula']}")
+    print(f"{regressions} regressions against the baseline (tolerance {tolerance:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 250, 500, 1000, 2000])
+    parser.add_argument('--dtypes', nargs='+', default=app_config.PRECISIONS)
+    parser.add_argument('--backends', nargs='+', default=['numpy', 'numexpr', 'numba'])
+    parser.add_argument('--formulas', type=int, nargs='+', help="indices into EXAMPLE_FUNCTIONS, default all")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--colormap-mode', choices=('gpu', 'cpu'), default=app_config.COLORMAP_MODE)
+    parser.add_argument('--gl', default='egl', help="vispy app backend of the offscreen canvas, 'none' skips upload")
+    parser.add_argument('--raw-evaluate', action='store_true',
+                        help="also time the backend on the full grid, without mirroring symmetric formulas")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against the results in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="allowed slow-down per stage, 0.15 = 15%%")
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore', RuntimeWarning)
+    threads = app_config.EVALUATION_THREADS or None
+    backends = [backend for backend in (TiledEvaluator(threads, app_config.TILE_POINTS), NumexprBackend(threads),
+                                        NumbaBackend(threads))
+                if backend.name in args.backends and getattr(backend, 'available', True)]
+    formulas = app_config.EXAMPLE_FUNCTIONS
+    if args.formulas:
+        formulas = [formulas[i] for i in args.formulas]
+    colormap = ColormapLUT(app_config.DEFAULT_CMAP)
+
+    offscreen = None
+    if args.gl != 'none':
+        try:
+            offscreen = OffscreenSurface(args.gl, args.colormap_mode, colormap)
+        except Exception as e:
+            print(f"Error during offscreen canvas setup, skipping the upload stage: {e}")
+
+    grid = GridBuffers()
+    results = []
+    for text in formulas:
+        formula = compile_formula(text)
+        for points in args.sizes:
+            for dtype in args.dtypes:
+                for backend in backends:
+                    if not backend.supports(formula, dtype):
+                        continue
+                    stages = run_case(grid, backend, formula, points, dtype, colormap, offscreen, args.colormap_mode,
+                                      args.repeat, args.raw_evaluate)
+                    total = sum(values['median_ms'] for name, values in stages.items() if name != 'evaluate_raw')
+                    results.append({'formula': text, 'grid_points': points, 'dtype': dtype,
+                                    'backend': backend.name, 'total_ms': total, 'stages': stages})
+                    print(f"{total:9.2f} ms  {points:>5}² {dtype:>7} {backend.name:>7}  " + "  ".join(
+                        f"{name} {values['median_ms']:.2f}" for name, values in stages.items()) + f"  {text[:40]}")
+    for backend in backends:
+        backend.shutdown()
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'colormap_mode': args.colormap_mode,
+            'upload': offscreen is not None,
+            'repeat': args.repeat,
+            'raw_evaluate': args.raw_evaluate,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(results, baseline, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Measure how the tiled evaluation scales with the number of worker threads.
+
+Usage: python benchmarks/tiled_scaling.py [--points 2048 4096] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import app_config
+from evaluation import TiledEvaluator
+from expression import compile_formula
+from grid import GridBuffers
+
+
+def time_evaluation(evaluator, formula, grid, out, repeat):
+    """Best wall time of repeat evaluations"""
+    evaluator.evaluate(formula, grid, (0.5, 0.7, 0.3), out)  # warm up, fills the invariant cache
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        evaluator.evaluate(formula, grid, (0.5, 0.7, 0.3), out)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+', default=[1024, 2048, 4096])
+    parser.add_argument('--formula', default=app_config.EXAMPLE_FUNCTIONS[22])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-threads', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    formula = compile_formula(args.formula)
+    threads = sorted({1, 2, 4, 8, 16, args.max_threads} & set(range(1, args.max_threads + 1)))
+    print(f"formula: {args.formula}")
+    print(f"{'points':>8} {'threads':>8} {'seconds':>10} {'speed-up':>9}")
+    np.seterr(all='ignore')
+    for points in args.points:
+        grid = GridBuffers()
+        grid.ensure(points, (-2, 2), (-2, 2))
+        out = np.empty((points, points))
+        single = None
+        for workers in threads:
+            evaluator = TiledEvaluator(workers, app_config.TILE_POINTS, min_points=0)
+            seconds = time_evaluation(evaluator, formula, grid, out, args.repeat)
+            evaluator.shutdown()
+            single = single or seconds
+            print(f"{points:>8} {workers:>8} {seconds:>10.4f} {single / seconds:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+import numpy as np
+from vispy.color.colormap import get_colormap
+
+# number of entries in the colormap lookup table
+LUT_SIZE = 512
+
+
+class ColormapLUT:
+    def __init__(self, name, size=LUT_SIZE):
+        """Sample a vispy colormap once into a lookup table"""
+        self.name = name
+        self.cmap = get_colormap(name)
+        self.table = self.cmap.map(np.linspace(0, 1, size)).astype(np.float32)
+
+    def map(self, norm_Z, index, out):
+        """Write RGBA colors for normalized values into out without allocating"""
+        np.multiply(norm_Z.ravel(), len(self.table) - 1, out=index, casting='unsafe')
+        np.take(self.table, index, axis=0, out=out, mode='clip')
+        return out
@@ -0,0 +1,348 @@
+import ast
+import copy
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from symmetry import evaluate_mirrored
+
+# optional evaluation backends, used only when installed
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# np functions of ALLOWED_CALCULATIONS that numexpr knows under the same name, np.abs is abs there
+NUMEXPR_FUNCTIONS = frozenset(('sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2', 'sinh', 'cosh', 'tanh',
+                               'arcsinh', 'arccosh', 'arctanh', 'sqrt', 'exp', 'log', 'abs'))
+NUMEXPR_CONSTANTS = {'pi': np.pi, 'e': np.e}
+
+# np functions of ALLOWED_CALCULATIONS that Numba compiles for scalars
+NUMBA_FUNCTIONS = NUMEXPR_FUNCTIONS
+
+
+class TiledEvaluator:
+    name = "numpy"
+
+    def __init__(self, workers=None, tile_points=65536, min_points=250000):
+        """Evaluate formulas in row bands on a thread pool, writing into one Z buffer
+
+        Each band is about tile_points grid points, so the temporaries of a
+        formula stay bounded per tile instead of growing with the full grid.
+        NumPy releases the GIL inside its loops, so the bands run in parallel.
+        Grids with fewer than min_points points are evaluated in one piece.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.tile_points = tile_points
+        self.min_points = min_points
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="TiledEvaluator")
+
+    def supports(self, formula, dtype):
+        """NumPy evaluates every valid formula"""
+        return True
+
+    def ready(self, formula):
+        """NumPy needs no preparation"""
+        return True
+
+    def bands(self, rows, cols):
+        """(start, stop) row ranges of the tiles"""
+        step = max(1, self.tile_points // max(cols, 1))
+        return [(start, min(start + step, rows)) for start in range(0, rows, step)]
+
+    def invariants(self, formula, grid):
+        """Time-invariant terms of formula on grid, evaluated tile by tile and cached in the grid"""
+        values = tuple(grid.invariants.get(key) for key in formula.frame_keys)
+        if all(value is not None for value in values):
+            return values
+
+        bands = self.bands(*grid.X.shape)
+        first = formula.evaluate_invariants(grid.X[slice(*bands[0])], grid.Y[slice(*bands[0])])
+        results = [np.empty(grid.X.shape, dtype=np.result_type(value)) for value in first]
+        for result, value in zip(results, first):
+            result[slice(*bands[0])] = value
+
+        def work(band):
+            rows = slice(*band)
+            for result, value in zip(results, formula.evaluate_invariants(grid.X[rows], grid.Y[rows])):
+                result[rows] = value
+
+        self._run(work, bands[1:])
+        for key, result in zip(formula.frame_keys, results):
+            grid.invariants[key] = result
+        return tuple(results)
+
+    def evaluate(self, formula, grid, params, out):
+        """Evaluate formula on grid into out, tiled if the grid is large enough"""
+        # parameters in the grid dtype, a NumPy float64 scalar would upcast a float32 grid
+        a, b, c = (grid.dtype.type(value) for value in params)
+        if out.size < self.min_points:
+            np.copyto(out, formula.evaluate(grid.X, grid.Y, a, b, c, grid.invariants), casting='same_kind')
+            return out
+
+        invariants = self.invariants(formula, grid)
+
+        def work(band):
+            rows = slice(*band)
+            band_invariants = tuple(value[rows] for value in invariants)
+            np.copyto(out[rows], formula.evaluate_frame(grid.X[rows], grid.Y[rows], a, b, c, band_invariants),
+                      casting='same_kind')
+
+        self._run(work, self.bands(*out.shape))
+        return out
+
+    def _run(self, work, bands):
+        """Run work over all bands on the pool and re-raise the first error"""
+        for future in [self._pool.submit(work, band) for band in bands]:
+            future.result()
+
+    def shutdown(self):
+        """Stop the worker threads"""
+        self._pool.shutdown(wait=False)
+
+
+def evaluate_batch(formula, grid, params, out, chunk_bytes=1 << 20):
+    """Evaluate K (a, b, c) triples into out (K, N, N) in broadcast passes
+
+    The invariant terms are evaluated once for the whole batch and the
+    per-frame part runs with a, b and c shaped (chunk, 1, 1). A chunk holds
+    as many frames as fit into chunk_bytes, so that the temporaries stay in
+    cache; large grids end up with one frame per pass. Symmetric formulas
+    are evaluated on their fundamental region and mirrored.
+    """
+    def evaluate(formula, grid, params, out):
+        return _evaluate_batch(formula, grid, params, out, chunk_bytes)
+
+    return evaluate_mirrored(evaluate, formula, grid, params, out)
+
+
+def _evaluate_batch(formula, grid, params, out, chunk_bytes):
+    params = np.asarray(params, dtype=grid.dtype).reshape(-1, 3)
+    chunk_frames = max(1, chunk_bytes // (grid.X.size * grid.dtype.itemsize))
+    invariants = formula.evaluate_invariants(grid.X, grid.Y, grid.invariants)
+    for start in range(0, len(params), chunk_frames):
+        chunk = params[start:start + chunk_frames, :, None, None]
+        np.copyto(out[start:start + len(chunk)],
+                  formula.evaluate_frame(grid.X, grid.Y, chunk[:, 0], chunk[:, 1], chunk[:, 2], invariants),
+                  casting='same_kind')
+    return out
+
+
+def _uses_upcast(formula):
+    """True if the formula casts large powers to float64 (see expression.FLOAT32_MAX_EXPONENT)"""
+    return 'np.float64' in formula.frame_source or any('np.float64' in key for key in formula.frame_keys)
+
+
+def _np_calls(tree):
+    """Names of the np attributes used in a formula tree"""
+    return {node.attr for node in ast.walk(tree)
+            if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'np'}
+
+
+class _NumexprTranslator(ast.NodeTransformer):
+    """Turn np.f into the numexpr function f and np.pi, np.e into numbers"""
+
+    def visit_Attribute(self, node):
+        if node.attr in NUMEXPR_CONSTANTS:
+            return ast.copy_location(ast.Constant(value=NUMEXPR_CONSTANTS[node.attr]), node)
+        return ast.copy_location(ast.Name(id=node.attr, ctx=ast.Load()), node)
+
+
+class NumexprBackend:
+    name = "numexpr"
+
+    def __init__(self, workers=None):
+        """Evaluate the whole formula in one fused, multi-threaded and cache-blocked numexpr pass"""
+        self.available = numexpr is not None
+        if self.available and workers:
+            numexpr.set_num_threads(workers)
+        self._sources = {}
+
+    def source(self, formula):
+        """numexpr version of the formula text, None if numexpr can not evaluate it"""
+        if formula.text not in self._sources:
+            self._sources[formula.text] = self._translate(formula.tree)
+        return self._sources[formula.text]
+
+    @staticmethod
+    def _translate(tree):
+        """Rewrite np.f(...) calls to numexpr functions and np constants to numbers"""
+        if any(isinstance(node, ast.FloorDiv) for node in ast.walk(tree)):
+            return None
+        if not _np_calls(tree) <= NUMEXPR_FUNCTIONS | set(NUMEXPR_CONSTANTS):
+            return None
+        return ast.unparse(_NumexprTranslator().visit(copy.deepcopy(tree)))
+
+    def supports(self, formula, dtype):
+        """numexpr is installed, knows every function and float32 needs no float64 powers"""
+        if not self.available or self.source(formula) is None:
+            return False
+        return not (np.dtype(dtype) == np.float32 and _uses_upcast(formula))
+
+    def ready(self, formula):
+        """numexpr compiles a formula within the first frame"""
+        return True
+
+    def evaluate(self, formula, grid, params, out):
+        """Evaluate formula on grid into out"""
+        a, b, c = (grid.dtype.type(value) for value in params)
+        numexpr.evaluate(self.source(formula), local_dict={'X': grid.X, 'Y': grid.Y, 'a': a, 'b': b, 'c': c},
+                         out=out, casting='same_kind')
+        return out
+
+    def shutdown(self):
+        pass
+
+
+class NumbaBackend:
+    name = "numba"
+
+    def __init__(self, workers=None):
+        """Evaluate the formula as a parallel Numba ufunc, compiled once per formula
+
+        The point function works in float64 registers also for a float32 grid,
+        so only the memory traffic is float32 and large powers do not overflow.
+        """
+        self.available = numba is not None
+        if self.available:
+            # the TBB layer hangs the interpreter exit after a ufunc ran on a worker thread
+            numba.config.THREADING_LAYER_PRIORITY = ['omp', 'tbb', 'workqueue']
+        if self.available and workers:
+            numba.set_num_threads(min(workers, numba.config.NUMBA_NUM_THREADS))
+        self._kernels = {}
+        self._compiling = set()  # formula texts compiled, or failed to compile, in the background
+        self._lock = threading.Lock()
+
+    def supports(self, formula, dtype):
+        """Numba is installed and compiles every function of the formula"""
+        return self.available and _np_calls(formula.tree) <= NUMBA_FUNCTIONS | {'pi', 'e'}
+
+    def ready(self, formula):
+        """True once the kernel of formula is compiled, else start compiling it on a background thread"""
+        with self._lock:
+            if formula.text in self._kernels:
+                return True
+            if formula.text in self._compiling:
+                return False
+            self._compiling.add(formula.text)
+        threading.Thread(target=self._compile_in_background, args=(formula,), name="NumbaCompile",
+                         daemon=True).start()
+        return False
+
+    def _compile_in_background(self, formula):
+        try:
+            self.kernel(formula)
+        except Exception as e:
+            # stays in _compiling, so the formula is not tried again
+            print(f"Error during numba compilation: {e}")
+
+    def kernel(self, formula):
+        """Parallel ufunc of the formula, compiled on first use"""
+        with self._lock:
+            kernel = self._kernels.get(formula.text)
+        if kernel is not None:
+            return kernel
+        # compiled outside the lock, which ready() takes on every frame
+        source = (f"def _point(x, y, a, b, c):\n    X = float(x)\n    Y = float(y)\n"
+                  f"    return {ast.unparse(formula.tree)}\n")
+        namespace = {'np': np}
+        exec(compile(source, '<formula>', 'exec'), namespace)
+        kernel = numba.vectorize(['float64(float64, float64, float64, float64, float64)',
+                                  'float32(float32, float32, float32, float32, float32)'],
+                                 target='parallel')(namespace['_point'])
+        with self._lock:
+            return self._kernels.setdefault(formula.text, kernel)
+
+    def evaluate(self, formula, grid, params, out):
+        """Evaluate formula on grid into out"""
+        a, b, c = (grid.dtype.type(value) for value in params)
+        self.kernel(formula)(grid.X, grid.Y, a, b, c, out=out)
+        return out
+
+    def shutdown(self):
+        pass
+
+
+class BackendSelector:
+    def __init__(self, backends, choice="auto", trial_frames=3):
+        """Evaluate frames with the chosen backend, falling back to NumPy when it can not
+
+        In "auto" mode every backend that supports the formula is timed for
+        trial_frames frames per formula and grid, after that the fastest is
+        used. A backend joins only once it is ready() for the formula, Numba
+        compiles in the background until then. The first frame of a backend
+        is a warm-up and not counted. last holds (backend name, seconds) of
+        the newest frame.
+        """
+        self.backends = {backend.name: backend for backend in backends}
+        self.fallback = backends[0]
+        self.choice = choice
+        self.trial_frames = trial_frames
+        self.costs = {}  # (formula text, grid key, backend name) -> [frames, average seconds]
+        self.last = None
+        self._failed = set()  # (formula text, backend name) that raised
+
+    def candidates(self, formula, dtype):
+        """Backends that can evaluate formula in dtype"""
+        return [backend for backend in self.backends.values()
+                if (formula.text, backend.name) not in self._failed and backend.supports(formula, dtype)]
+
+    def select(self, formula, grid):
+        """Backend for the next frame of formula on grid"""
+        candidates = self.candidates(formula, grid.dtype)
+        if self.choice != "auto":
+            chosen = self.backends.get(self.choice)
+            return chosen if chosen in candidates else self.fallback
+
+        best, best_cost = self.fallback, np.inf
+        for backend in candidates:
+            if not backend.ready(formula):
+                continue
+            frames, cost = self.costs.get((formula.text, grid.key, backend.name), (0, None))
+            if frames < self.trial_frames:
+                return backend
+            if cost < best_cost:
+                best, best_cost = backend, cost
+        return best
+
+    def evaluate(self, formula, grid, params, out):
+        """Evaluate formula on grid into out, only the fundamental region of a symmetric formula"""
+        start = time.perf_counter()
+        evaluate_mirrored(self._evaluate, formula, grid, params, out)
+        self.last = (self.last[0], time.perf_counter() - start)
+        return out
+
+    def _evaluate(self, formula, grid, params, out):
+        """Evaluate formula on grid, or a block of it, into out and record the cost per frame"""
+        backend = self.select(formula, grid)
+        start = time.perf_counter()
+        try:
+            backend.evaluate(formula, grid, params, out)
+        except Exception as e:
+            if backend is self.fallback:
+                raise
+            print(f"Error during {backend.name} evaluation: {e}")
+            self._failed.add((formula.text, backend.name))
+            return self._evaluate(formula, grid, params, out)
+        elapsed = time.perf_counter() - start
+
+        key = (formula.text, grid.key, backend.name)
+        if key in self.costs:
+            frames, cost = self.costs[key]
+            self.costs[key] = [frames + 1, cost + (elapsed - cost) / min(frames + 1, 10)]
+        else:
+            self.costs[key] = [0, elapsed]  # warm-up frame
+        self.last = (backend.name, elapsed)
+        return out
+
+    def shutdown(self):
+        """Stop the worker threads of all backends"""
+        for backend in self.backends.values():
+            backend.shutdown()
@@ -0,0 +1,247 @@
+import ast
+import copy
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+
+import app_config
+from symmetry import analyze
+
+# variables that every formula has to use
+REQUIRED_VARIABLES = ('X', 'Y', 'a', 'b', 'c')
+GRID_VARIABLES = frozenset(('X', 'Y'))
+PARAMETERS = frozenset(('a', 'b', 'c'))
+
+# operators that may appear between the allowed names
+ALLOWED_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.FloorDiv, ast.USub, ast.UAdd)
+
+# np names of ALLOWED_CALCULATIONS that are constants and functions that take two arguments, all
+# other functions take exactly one (NumPy reads further positional arguments as output arrays)
+CONSTANT_ATTRIBUTES = frozenset(('pi', 'e'))
+BINARY_FUNCTIONS = frozenset(('arctan2',))
+
+# powers with a larger constant exponent are evaluated in float64, they overflow in float32
+FLOAT32_MAX_EXPONENT = 16
+
+
+class FormulaError(ValueError):
+    """Raised when a formula is not a valid expression of the allowed names"""
+
+
+class CompiledFormula:
+    def __init__(self, text, tree):
+        """Keep the parsed formula together with its compiled code objects"""
+        self.text = text
+        self.tree = tree
+        self.code = compile(tree, '<formula>', 'eval')
+        self.symmetry = analyze(tree)  # parity in X and Y and X/Y swap, lets evaluation mirror blocks
+
+        # split into terms that only depend on X and Y and the per-frame rest
+        rewritten = ast.fix_missing_locations(_PrecisionRewriter().visit(copy.deepcopy(tree)))
+        splitter = _InvariantSplitter(rewritten)
+        frame_body = splitter.visit(rewritten.body)
+        self.invariants = splitter.invariants
+        self.temporaries = splitter.temporaries
+        referenced = {n.id for n in ast.walk(frame_body) if isinstance(n, ast.Name)}
+        referenced.update(n.id for _, node in self.temporaries for n in ast.walk(node) if isinstance(n, ast.Name))
+        self.frame_args = tuple(name for name, _, _ in self.invariants if name in referenced)
+        self.frame_keys = tuple(key for name, key, _ in self.invariants if name in referenced)
+        self.frame_source = _frame_source(self.frame_args, self.temporaries, frame_body)
+        namespace = {'np': np}
+        exec(compile(self.frame_source, '<formula>', 'exec'), namespace)
+        self.frame_function = namespace['_frame']
+
+    def evaluate_invariants(self, X, Y, cache=None):
+        """Evaluate the time-invariant terms, reusing values found in cache
+
+        Only the terms passed to the frame function are stored in cache, inner
+        shared terms live just long enough to build them.
+        """
+        if cache is None:
+            cache = {}
+        values = tuple(cache.get(key) for key in self.frame_keys)
+        if all(value is not None for value in values):
+            return values
+
+        env = {'np': np, 'X': X, 'Y': Y}
+        for name, key, code in self.invariants:
+            value = cache.get(key)
+            env[name] = eval(code, env) if value is None else value
+        for name, key in zip(self.frame_args, self.frame_keys):
+            cache[key] = env[name]
+        return tuple(env[name] for name in self.frame_args)
+
+    def evaluate_frame(self, X, Y, a, b, c, invariants):
+        """Evaluate the per-frame part given the precomputed invariant terms"""
+        return self.frame_function(X, Y, a, b, c, *invariants)
+
+    def evaluate(self, X, Y, a, b, c, cache=None):
+        """Evaluate the formula on the given grid and parameters"""
+        return self.evaluate_frame(X, Y, a, b, c, self.evaluate_invariants(X, Y, cache))
+
+
+class _PrecisionRewriter(ast.NodeTransformer):
+    """Keep the formula in the grid dtype, upcasting only where float32 would overflow
+
+    Calls on constants alone are folded into plain floats, a NumPy float64
+    scalar like np.sqrt(2) would turn a float32 grid into float64. The base
+    of a power with a large constant exponent is cast to float64, X**33
+    overflows in float32. With a float64 grid the cast is a no-op.
+    """
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        if all(isinstance(arg, ast.Constant) for arg in node.args):
+            try:
+                with np.errstate(all='ignore'):
+                    value = float(eval(compile(ast.Expression(body=node), '<formula>', 'eval'), {'np': np}))
+            except (ArithmeticError, TypeError, ValueError) as e:
+                raise FormulaError(f"{ast.unparse(node)} cannot be evaluated: {e}.") from None
+            if np.isfinite(value):
+                # a negative constant is written as a unary minus, unparse then keeps -x ** 2 apart from (-x) ** 2
+                folded = ast.Constant(value=abs(value))
+                if np.signbit(value):
+                    folded = ast.UnaryOp(op=ast.USub(), operand=folded)
+                return ast.copy_location(folded, node)
+        return node
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        exponent = node.right
+        if isinstance(exponent, ast.UnaryOp) and isinstance(exponent.op, (ast.USub, ast.UAdd)):
+            exponent = exponent.operand
+        if (isinstance(node.op, ast.Pow) and isinstance(exponent, ast.Constant)
+                and abs(exponent.value) > FLOAT32_MAX_EXPONENT):
+            cast = ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()), attr='float64', ctx=ast.Load())
+            node.left = ast.Call(func=cast, args=[node.left], keywords=[])
+        return node
+
+
+def _is_compound(node):
+    """True for nodes that perform an actual computation"""
+    return isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Call))
+
+
+class _InvariantSplitter:
+    def __init__(self, tree):
+        """Collect hoisted invariant terms and repeated per-frame terms of a formula"""
+        self.counts = Counter(ast.dump(n) for n in ast.walk(tree) if _is_compound(n))
+        self.names = {}
+        self.invariants = []  # (name, expanded source, code) in evaluation order
+        self.temporaries = []  # (name, node) assignments of the frame function
+
+    def visit(self, node, inside_invariant=False):
+        """Return node rewritten to reference hoisted and shared terms by name"""
+        if not _is_compound(node):
+            return node
+        key = ast.dump(node)
+        if key in self.names:
+            return ast.Name(id=self.names[key], ctx=ast.Load())
+
+        names = {n.id for n in ast.walk(node) if isinstance(n, ast.Name)} - {'np'}
+        invariant = bool(names) and names <= GRID_VARIABLES
+        repeated = self.counts[key] > 1
+        rewritten = self._visit_children(node, invariant)
+
+        # the outermost invariant term is always hoisted, inner ones only if they repeat
+        if invariant and (repeated or not inside_invariant):
+            name = f"_i{len(self.invariants)}"
+            code = compile(ast.Expression(body=rewritten), '<formula>', 'eval')
+            self.invariants.append((name, ast.unparse(node), code))
+        elif repeated and not invariant and names & PARAMETERS:
+            name = f"_t{len(self.temporaries)}"
+            self.temporaries.append((name, rewritten))
+        else:
+            return rewritten
+        self.names[key] = name
+        return ast.Name(id=name, ctx=ast.Load())
+
+    def _visit_children(self, node, inside_invariant):
+        """Copy node with every child expression visited"""
+        fields = {}
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, ast.expr):
+                value = self.visit(value, inside_invariant)
+            elif isinstance(value, list):
+                value = [self.visit(v, inside_invariant) if isinstance(v, ast.expr) else v for v in value]
+            fields[field] = value
+        return ast.fix_missing_locations(type(node)(**fields))
+
+
+def _frame_source(frame_args, temporaries, body):
+    """Python source of the per-frame function"""
+    lines = [f"def _frame(X, Y, a, b, c{''.join(', ' + name for name in frame_args)}):"]
+    lines += [f"    {name} = {ast.unparse(node)}" for name, node in temporaries]
+    lines.append(f"    return {ast.unparse(body)}")
+    return "\n".join(lines) + "\n"
+
+
+def _allowed_attributes():
+    """Names of the np attributes listed in ALLOWED_CALCULATIONS"""
+    return {name.split('.', 1)[1] for name in app_config.ALLOWED_CALCULATIONS}
+
+
+def _check_node(node, used_names, allowed_attributes):
+    """Walk the AST and reject everything but arithmetic on the allowed names"""
+    if isinstance(node, ast.Expression):
+        _check_node(node.body, used_names, allowed_attributes)
+    elif isinstance(node, ast.BinOp):
+        if not isinstance(node.op, ALLOWED_OPERATORS):
+            raise FormulaError(f"The operator {type(node.op).__name__} is not allowed.")
+        _check_node(node.left, used_names, allowed_attributes)
+        _check_node(node.right, used_names, allowed_attributes)
+    elif isinstance(node, ast.UnaryOp):
+        if not isinstance(node.op, ALLOWED_OPERATORS):
+            raise FormulaError(f"The operator {type(node.op).__name__} is not allowed.")
+        _check_node(node.operand, used_names, allowed_attributes)
+    elif isinstance(node, ast.Call):
+        if node.keywords or not isinstance(node.func, ast.Attribute):
+            raise FormulaError("Only np functions from the guidelines can be called.")
+        _check_node(node.func, used_names, allowed_attributes)
+        name = node.func.attr
+        if name in CONSTANT_ATTRIBUTES:
+            raise FormulaError(f"np.{name} is a constant, write it without parentheses.")
+        arity = 2 if name in BINARY_FUNCTIONS else 1
+        if len(node.args) != arity:
+            raise FormulaError(f"np.{name} takes {arity} argument{'s' if arity > 1 else ''}, "
+                               f"not {len(node.args)}.")
+        for arg in node.args:
+            _check_node(arg, used_names, allowed_attributes)
+    elif isinstance(node, ast.Attribute):
+        if not (isinstance(node.value, ast.Name) and node.value.id == 'np' and node.attr in allowed_attributes):
+            raise FormulaError(f"The function input contains a calculation that is not allowed: {ast.unparse(node)}.")
+    elif isinstance(node, ast.Name):
+        if node.id not in REQUIRED_VARIABLES:
+            raise FormulaError(f"The function input contains other variables than X, Y, a, b, c. Remove {node.id}.")
+        used_names.add(node.id)
+    elif isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise FormulaError(f"Only numbers are allowed as constants, not {node.value!r}.")
+    else:
+        raise FormulaError(f"The expression element {type(node).__name__} is not allowed.")
+
+
+@lru_cache(maxsize=64)
+def compile_formula(text):
+    """Parse, validate and compile a formula once, cached by its text"""
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as e:
+        raise FormulaError(f"The function input is not a valid expression: {e.msg}.") from None
+
+    used_names = set()
+    _check_node(tree, used_names, _allowed_attributes())
+    for var in REQUIRED_VARIABLES:
+        if var not in used_names:
+            raise FormulaError(f"The function input must contain X, Y, a, b, c. You are missing {var}.")
+    return CompiledFormula(text, tree)
+
+
+def validate_formula(text):
+    """Return (valid, error_message) for a formula"""
+    try:
+        compile_formula(text)
+    except FormulaError as e:
+        return False, str(e)
+    return True, ""
@@ -0,0 +1,210 @@
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from grid import FrameBuffers, GridBuffers
+
+# control block: int64 fields followed by the float64 grid limits
+BUS_MAGIC = 0x46425332  # "FBS2", version 2 streams two-component normals
+_MAGIC, _LAYOUT, _GRID_POINTS, _SLOTS, _LATEST_SEQ = range(5)
+_CONTROL_INTS = 8
+_CONTROL_BYTES = _CONTROL_INTS * 8 + 4 * 8
+
+# per-slot metadata: sequence written before and after the data (a seqlock), step and z range
+_SEQ_BEGIN, _SEQ_END, _STEP, _Z_MIN, _Z_MAX = range(5)
+_SLOT_FIELDS = 5
+
+# reads of a slot that was overwritten while it was copied before latest() gives up until the next call
+READ_ATTEMPTS = 3
+
+
+def _attach(name):
+    """Open an existing segment without letting this process' resource tracker unlink it at exit"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def _data_layout(buffer, slots, n):
+    """(slot metadata, z, normals) arrays over a data segment"""
+    meta = np.ndarray((slots, _SLOT_FIELDS), dtype=np.float64, buffer=buffer)
+    offset = meta.nbytes
+    z = np.ndarray((slots, n * n), dtype=np.float32, buffer=buffer, offset=offset)
+    offset += z.nbytes
+    normals = np.ndarray((slots, n * n, 2), dtype=np.float32, buffer=buffer, offset=offset)
+    return meta, z, normals
+
+
+def _data_size(slots, n):
+    return slots * _SLOT_FIELDS * 8 + slots * n * n * 3 * 4
+
+
+def _data_name(name, layout):
+    return f"{name}_{layout}"
+
+
+class FramePublisher:
+    def __init__(self, name, slots=4):
+        """Producer side of the frame bus, publishes frames into a shared memory ring
+
+        The small control segment called name holds the grid settings, the
+        current layout and the newest sequence number. Frames go round-robin
+        into the slots of a data segment that is replaced when the grid
+        changes. Publishing never waits for viewers.
+        """
+        self.name = name
+        self.slots = slots
+        self.seq = 0
+        self._control = shared_memory.SharedMemory(name=name, create=True, size=_CONTROL_BYTES)
+        self._ints = np.ndarray(_CONTROL_INTS, dtype=np.int64, buffer=self._control.buf)
+        self._limits = np.ndarray(4, dtype=np.float64, buffer=self._control.buf, offset=_CONTROL_INTS * 8)
+        self._ints[:] = 0
+        self._ints[_MAGIC] = BUS_MAGIC
+        self._ints[_SLOTS] = slots
+        self._data = None
+        self._grid_key = None
+
+    def _create_layout(self, grid):
+        """Allocate the data segment for the grid of the next frame"""
+        layout = int(self._ints[_LAYOUT]) + 1
+        n = len(grid.x)
+        data = shared_memory.SharedMemory(name=_data_name(self.name, layout), create=True,
+                                          size=_data_size(self.slots, n))
+        self._meta, self._z, self._normals = _data_layout(data.buf, self.slots, n)
+        self._meta[:] = -1
+        if self._data is not None:
+            # viewers still attached to the old segment keep their mapping
+            self._data.close()
+            self._data.unlink()
+        self._data = data
+        self._grid_key = grid.key
+
+        self._ints[_GRID_POINTS] = n
+        self._limits[:] = (grid.x[0], grid.x[-1], grid.y[0], grid.y[-1])
+        self._ints[_LAYOUT] = layout  # viewers switch segments when they see the new layout
+
+    def publish(self, frame, grid, step):
+        """Copy a finished frame into the next slot and announce it, return its sequence number"""
+        if grid.key != self._grid_key:
+            self._create_layout(grid)
+        self.seq += 1
+        slot = self.seq % self.slots
+        meta = self._meta[slot]
+        meta[_SEQ_BEGIN] = self.seq
+        np.copyto(self._z[slot], frame.z_upload, casting='same_kind')
+        np.copyto(self._normals[slot], frame.normals.reshape(-1, 2))
+        meta[_STEP] = step
+        meta[_Z_MIN], meta[_Z_MAX] = frame.z_range
+        meta[_SEQ_END] = self.seq
+        self._ints[_LATEST_SEQ] = self.seq
+        return self.seq
+
+    def close(self):
+        """Remove the segments, attached viewers keep their mappings until they detach"""
+        self._meta = self._z = self._normals = self._ints = self._limits = None
+        for segment in (self._data, self._control):
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+        self._data = None
+
+
+class FrameViewer:
+    def __init__(self, name):
+        """Viewer side of the frame bus, hands out a copy of the newest frame
+
+        latest() skips straight to the newest published frame, a viewer that
+        falls behind never slows the publisher down. The slot is copied out
+        and its sequence checked again afterwards, a frame whose slot was
+        overwritten meanwhile is read again from the newest slot. The upload
+        reads the copy later, the publisher may reuse the slot by then.
+        """
+        self.name = name
+        self._control = _attach(name)
+        self._ints = np.ndarray(_CONTROL_INTS, dtype=np.int64, buffer=self._control.buf)
+        self._limits = np.ndarray(4, dtype=np.float64, buffer=self._control.buf, offset=_CONTROL_INTS * 8)
+        if self._ints[_MAGIC] != BUS_MAGIC:
+            self._control.close()
+            raise ValueError(f"{name!r} is not a frame bus")
+        self.slots = int(self._ints[_SLOTS])
+        self.seq = 0
+        self.skipped = 0  # frames published but never shown by this viewer
+        self._layout = None
+        self._data = None
+        self._stale = []  # replaced data segments that frames on screen may still point into
+        self.grid = GridBuffers()
+        self._frame = FrameBuffers()
+
+    def _attach_layout(self, layout):
+        """Map the data segment of a new layout and rebuild the local x/y grid"""
+        data = _attach(_data_name(self.name, layout))
+        n = int(self._ints[_GRID_POINTS])
+        self._meta, self._z, self._normals = _data_layout(data.buf, self.slots, n)
+        if self._data is not None:
+            self._stale.append(self._data)
+        self._data = data
+        self._close_stale()
+        self._layout = layout
+        x0, x1, y0, y1 = self._limits
+        self.grid.ensure(n, (x0, x1), (y0, y1), 'float32')
+        self._frame.ensure(self.grid)  # the frames are copied into its z_upload and normals
+
+    def latest(self):
+        """Newest frame not returned before, or None"""
+        layout = int(self._ints[_LAYOUT])
+        if layout == 0:
+            return None
+        if layout != self._layout:
+            try:
+                self._attach_layout(layout)
+            except FileNotFoundError:
+                return None  # replaced again before we could attach
+        frame = self._frame
+        for _ in range(READ_ATTEMPTS):
+            seq = int(self._ints[_LATEST_SEQ])
+            if seq <= self.seq:
+                return None
+            slot = seq % self.slots
+            meta = self._meta[slot]
+            if meta[_SEQ_BEGIN] != seq or meta[_SEQ_END] != seq:
+                return None
+            np.copyto(frame.z_upload, self._z[slot])
+            np.copyto(frame.normals.reshape(-1, 2), self._normals[slot])
+            z_range = (float(meta[_Z_MIN]), float(meta[_Z_MAX]))
+            step = int(meta[_STEP])
+            # the publisher sets _SEQ_BEGIN before it overwrites a slot, unchanged means the copy is whole
+            if meta[_SEQ_BEGIN] == seq:
+                break
+        else:
+            return None
+        if self.seq:
+            self.skipped += max(0, seq - self.seq - 1)
+        self.seq = seq
+        frame.z_range = z_range
+        frame.step = step
+        return frame
+
+    def _close_stale(self):
+        """Unmap replaced data segments once nothing points into them any more"""
+        for segment in list(self._stale):
+            try:
+                segment.close()
+            except BufferError:
+                continue
+            self._stale.remove(segment)
+
+    def close(self):
+        """Detach from the bus"""
+        self._meta = self._z = self._normals = self._ints = self._limits = None
+        self._frame = FrameBuffers()
+        if self._data is not None:
+            self._stale.append(self._data)
+            self._data = None
+        self._close_stale()
+        try:
+            self._control.close()
+        except BufferError:
+            pass
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class CachedFrame:
+    def __init__(self, frame, with_colors):
+        """Copy of the displayable parts of a computed frame"""
+        self.z_upload = frame.z_upload.copy()
+        self.normals = frame.normals.copy()
+        self.colors = frame.colors.copy() if with_colors else None
+        self.z_range = frame.z_range
+        self.nbytes = self.z_upload.nbytes + self.normals.nbytes + (self.colors.nbytes if self.colors is not None else 0)
+
+
+class FrameCache:
+    def __init__(self, budget_mb=512):
+        """LRU cache of computed frames keyed by settings and quantized (a, b, c)"""
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(request, decimals=9):
+        """Cache key of a frame request"""
+        params = tuple(round(float(v), decimals) for v in request.params)
+        colormap = request.colormap.name if request.colormap is not None else None
+        # the stored z_range and colors depend on how the color range is clipped and smoothed
+        return (request.formula.text, request.grid_points, tuple(request.x_limits), tuple(request.y_limits),
+                colormap, str(request.dtype), tuple(request.range_settings), params)
+
+    def load(self, key, frame):
+        """Copy a cached frame into frame, return False on a miss"""
+        with self._lock:
+            cached = self._frames.get(key)
+            if cached is None:
+                self.misses += 1
+                return False
+            self._frames.move_to_end(key)
+            self.hits += 1
+        np.copyto(frame.z_upload, cached.z_upload)
+        if not np.shares_memory(frame.z_upload, frame.Z):
+            np.copyto(frame.Z, cached.z_upload.reshape(frame.Z.shape))
+        np.copyto(frame.normals, cached.normals)
+        if cached.colors is not None:
+            np.copyto(frame.colors, cached.colors)
+        frame.z_range = cached.z_range
+        return True
+
+    def store(self, key, frame, with_colors=False):
+        """Keep a copy of frame, evicting the least recently used frames over budget"""
+        cached = CachedFrame(frame, with_colors)
+        if cached.nbytes > self.budget:
+            return
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._frames[key] = cached
+            self.nbytes += cached.nbytes
+            while self.nbytes > self.budget:
+                _, evicted = self._frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        """Drop all frames and reset the counters"""
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._frames)
@@ -0,0 +1,138 @@
+import json
+import os
+
+import numpy as np
+
+from colormap import ColormapLUT
+from evaluation import evaluate_batch
+from expression import compile_formula
+from grid import FrameBuffers, GridBuffers
+from scheduler import parameters_at
+
+# files of a frame store directory
+META_FILE = "meta.json"
+Z_FILE = "z.npy"
+RANGES_FILE = "ranges.npy"
+NORMALS_FILE = "normals.npy"
+COLORS_FILE = "colors.npy"
+STORE_VERSION = 2
+
+
+def precompute(path, formula_text, rules, x_limits, y_limits, grid_points, step, start, stop,
+               normals=False, colormap=None, batch_frames=32, progress=None):
+    """Evaluate the steps of [start, stop) seconds into a frame store directory at path
+
+    Z frames go into a memory-mapped (K, N, N) float32 .npy stack, written
+    in batches straight into the map. With normals the (K, N*N, 2) normals
+    are stored too, with a colormap name the (K, N*N, 4) colors of the cpu
+    colormap mode. meta.json holds the settings the frames were made with.
+    """
+    formula = compile_formula(formula_text)
+    steps = np.arange(int(round(start / step)), int(round(stop / step)))
+    if len(steps) == 0:
+        raise ValueError("The time range contains no simulation step")
+    os.makedirs(path, exist_ok=True)
+
+    grid = GridBuffers()
+    grid.ensure(grid_points, x_limits, y_limits, 'float32')
+    frame = FrameBuffers()
+    frame.ensure(grid)
+    n = grid_points
+
+    Z = np.lib.format.open_memmap(os.path.join(path, Z_FILE), mode='w+', dtype=np.float32, shape=(len(steps), n, n))
+    ranges = np.zeros((len(steps), 2), dtype=np.float32)
+    stored_normals = stored_colors = None
+    if normals:
+        stored_normals = np.lib.format.open_memmap(os.path.join(path, NORMALS_FILE), mode='w+', dtype=np.float32,
+                                                   shape=(len(steps), n * n, 2))
+    lut = ColormapLUT(colormap) if colormap else None
+    if lut is not None:
+        stored_colors = np.lib.format.open_memmap(os.path.join(path, COLORS_FILE), mode='w+', dtype=np.float32,
+                                                  shape=(len(steps), n * n, 4))
+
+    for first in range(0, len(steps), batch_frames):
+        chunk = steps[first:first + batch_frames]
+        params = np.stack(np.broadcast_arrays(*parameters_at(rules, chunk * step)), axis=-1)
+        evaluate_batch(formula, grid, params, Z[first:first + len(chunk)])
+        for k in range(first, first + len(chunk)):
+            frame.Z = Z[k]
+            ranges[k] = frame.update_range()
+            if stored_normals is not None:
+                stored_normals[k] = frame.compute_normals()
+            if stored_colors is not None:
+                lut.map(frame.normalize(), frame.color_index, stored_colors[k])
+        if progress is not None:
+            progress(first + len(chunk), len(steps))
+
+    np.save(os.path.join(path, RANGES_FILE), ranges)
+    for stack in (Z, stored_normals, stored_colors):
+        if stack is not None:
+            stack.flush()
+    meta = {
+        'version': STORE_VERSION,
+        'formula': formula_text,
+        'rules': [list(rule) for rule in rules],
+        'x_limits': list(x_limits),
+        'y_limits': list(y_limits),
+        'grid_points': grid_points,
+        'step': step,
+        'start': float(steps[0] * step),
+        'frames': len(steps),
+        'normals': stored_normals is not None,
+        'colormap': colormap,
+    }
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+class FrameStore:
+    def __init__(self, path):
+        """Open a frame store read-only, the stacks stay memory-mapped"""
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported frame store version {self.meta.get('version')}")
+        self.path = path
+        self.Z = np.load(os.path.join(path, Z_FILE), mmap_mode='r')
+        self.ranges = np.load(os.path.join(path, RANGES_FILE))
+        self.normals = np.load(os.path.join(path, NORMALS_FILE), mmap_mode='r') if self.meta['normals'] else None
+        self.colors = np.load(os.path.join(path, COLORS_FILE), mmap_mode='r') if self.meta['colormap'] else None
+        self.step = self.meta['step']
+
+        self.grid = GridBuffers()
+        self.grid.ensure(self.meta['grid_points'], self.meta['x_limits'], self.meta['y_limits'], 'float32')
+        # buffers for what is not stored: normals and the colors of the cpu colormap mode
+        self._frame = FrameBuffers()
+        self._frame.ensure(self.grid)
+        self._normals = self._frame.normals
+        self._colors = self._frame.colors
+
+    def __len__(self):
+        return len(self.Z)
+
+    def index_at(self, time):
+        """Frame shown at a time in seconds, looping over the stored range"""
+        return int((time - self.meta['start']) / self.step + 1e-9) % len(self)
+
+    def frame(self, index, colormap=None):
+        """Frame index ready for display, z and the stored streams are views into the maps
+
+        Normals that are not stored are computed from z, colors only if a
+        colormap is given and the store has none.
+        """
+        frame = self._frame
+        frame.Z = self.Z[index]
+        frame.z_upload = frame.Z.reshape(-1)
+        frame.z_range = tuple(self.ranges[index])
+        if self.normals is not None:
+            frame.normals = self.normals[index]
+        else:
+            frame.normals = self._normals
+            frame.compute_normals()
+        if self.colors is not None:
+            frame.colors = self.colors[index]
+        elif colormap is not None:
+            frame.colors = colormap.map(frame.normalize(), frame.color_index, self._colors)
+        frame.step = index
+        return frame
@@ -0,0 +1,175 @@
+import itertools
+
+import numpy as np
+
+from normalization import clamp_nonfinite, measure_range, normalize_into
+
+# grid generations are unique across all grids, a frame's generation identifies its grid
+_generations = itertools.count(1)
+
+
+class GridBuffers:
+    def __init__(self):
+        """Hold the evaluation grid and the time-invariant formula terms on it"""
+        self.key = None
+        self.generation = 0  # new value with every rebuild
+        self.invariants = {}  # time-invariant formula terms for this grid
+        self.parent = None  # grid this one is a block of, see region()
+        self.regions = {}
+
+    def ensure(self, grid_points, x_limits, y_limits, dtype='float64'):
+        """Rebuild the grid if the settings changed, return True on rebuild"""
+        dtype = np.dtype(dtype)
+        key = (grid_points, tuple(x_limits), tuple(y_limits), dtype)
+        if key == self.key:
+            return False
+        n = grid_points
+
+        # everything evaluated on the grid inherits its dtype
+        x = np.linspace(*x_limits, n, dtype=dtype)
+        y = np.linspace(*y_limits, n, dtype=dtype)
+        self.X, self.Y = np.meshgrid(x, y)
+        self.x, self.y = x, y
+        self.dtype = dtype
+        self.inv_dx = (n - 1) / (x_limits[1] - x_limits[0]) if n > 1 else 0.0
+        self.inv_dy = (n - 1) / (y_limits[1] - y_limits[0]) if n > 1 else 0.0
+
+        self.invariants = {}
+        self.regions = {}
+        self.key = key
+        self.generation = next(_generations)
+        return True
+
+    def region(self, rows, cols):
+        """Grid over the X/Y views of the block rows x cols, (start, stop) each, with its own invariant terms"""
+        region = self.regions.get((rows, cols))
+        if region is None:
+            region = GridBuffers()
+            region.X = self.X[rows[0]:rows[1], cols[0]:cols[1]]
+            region.Y = self.Y[rows[0]:rows[1], cols[0]:cols[1]]
+            region.x, region.y = self.x[cols[0]:cols[1]], self.y[rows[0]:rows[1]]
+            region.dtype = self.dtype
+            region.inv_dx, region.inv_dy = self.inv_dx, self.inv_dy
+            region.key = self.key + (rows, cols)
+            region.generation = self.generation
+            region.parent = self
+            self.regions[(rows, cols)] = region
+        return region
+
+    def clear_invariants(self):
+        """Drop the cached invariant terms of the grid and its blocks"""
+        self.invariants.clear()
+        for region in self.regions.values():
+            region.invariants.clear()
+
+    def retain_invariants(self, keys):
+        """Drop the cached invariant terms of the grid and its blocks except those of keys"""
+        for grid in (self, *self.regions.values()):
+            for key in set(grid.invariants) - set(keys):
+                del grid.invariants[key]
+
+
+class FrameBuffers:
+    def __init__(self):
+        """Per-frame buffers, allocated once per grid and overwritten every frame"""
+        self.generation = None  # grid generation the buffers were sized for
+        self.epoch = None  # settings epoch of the frame stored in the buffers
+        self.params = None  # (a, b, c) of the frame stored in the buffers
+        self.step = None  # simulation step of the frame stored in the buffers
+        self.z_key = None  # inputs of the Z stored in the buffers, None if unknown
+        self.clamped = False  # NaN or inf in Z were replaced since it was stored, Z is no longer raw
+        self.z_range = (0.0, 0.0)
+        self.surfaces = ()  # SurfaceLayer of every layer after the first
+        self.layers = [self]  # buffers of every surface, see ensure()
+
+    def ensure(self, grid, layers=1):
+        """Resize the buffers for grid and layers surfaces, return True if they were reallocated
+
+        The surfaces share one block per buffer, so that all of them are
+        uploaded together. self holds the views of the first surface and
+        self.layers a FrameBuffers over the views of each.
+        """
+        if self.generation == grid.generation and len(self.layers) == layers:
+            return False
+        n = len(grid.x)
+        Z = np.zeros((layers, n, n), dtype=grid.dtype)
+        # a float32 Z is uploaded as it is, float64 goes through a float32 copy
+        if grid.dtype == np.float32:
+            z_upload = Z.reshape(-1)
+        else:
+            z_upload = np.zeros(layers * n * n, dtype=np.float32)
+        # unnormalized normals (-dZ/dx, -dZ/dy, 1) without the constant 1, the shader adds and normalizes it
+        normals = np.zeros((layers, n, n, 2), dtype=np.float32)
+        colors = np.zeros((layers * n * n, 4), dtype=np.float32)
+        self._blocks = (z_upload, normals.reshape(-1, 2), colors)
+
+        self.layers = [self] + [FrameBuffers() for _ in range(1, layers)]
+        for k, layer in enumerate(self.layers):
+            layer.x, layer.y = grid.x, grid.y
+            layer._inv_dx, layer._inv_dy = grid.inv_dx, grid.inv_dy
+            layer.Z = Z[k]
+            layer.norm_Z = np.zeros((n, n), dtype=grid.dtype)
+            layer.color_index = np.zeros(n * n, dtype=np.intp)
+            layer.colors = colors[k * n * n:(k + 1) * n * n]
+            layer.z_upload = z_upload[k * n * n:(k + 1) * n * n]
+            layer.normals = normals[k]
+            layer.z_range = (0.0, 0.0)
+            layer.z_key = None
+            layer.clamped = False
+            layer.generation = grid.generation
+        self.Z_layers = Z
+        return True
+
+    def upload_data(self):
+        """(z, slopes, colors, z_range) of all surfaces for one upload, z_range is a list with several"""
+        if len(self.layers) == 1:
+            return self.z_upload, self.normals.reshape(-1, 2), self.colors, self.z_range
+        return self._blocks + ([layer.z_range for layer in self.layers],)
+
+    def store_z(self, Z=None):
+        """Copy an evaluation result (or what was written into self.Z) into the upload buffer"""
+        if Z is not None:
+            np.copyto(self.Z, Z, casting='same_kind')
+        if not np.shares_memory(self.z_upload, self.Z):
+            np.copyto(self.z_upload, self.Z.ravel(), casting='same_kind')
+        self.clamped = False
+        return self.Z
+
+    def compute_normals(self):
+        """Finite-difference normals of the regular grid as (-dZ/dx, -dZ/dy), written in place"""
+        self._gradient(self.Z, self.normals[..., 0], self._inv_dx)
+        self._gradient(self.Z.T, self.normals[..., 1].T, self._inv_dy)
+        return self.normals.reshape(-1, 2)
+
+    @staticmethod
+    def _gradient(Z, out, inv_step):
+        """Write -dZ along the last axis into out, central inside and one-sided at the edges"""
+        if Z.shape[-1] < 2:
+            out.fill(0)
+            return
+        np.subtract(Z[:, :-2], Z[:, 2:], out=out[:, 1:-1], casting='same_kind')
+        np.multiply(out[:, 1:-1], 0.5 * inv_step, out=out[:, 1:-1])
+        np.subtract(Z[:, 0], Z[:, 1], out=out[:, 0], casting='same_kind')
+        np.subtract(Z[:, -2], Z[:, -1], out=out[:, -1], casting='same_kind')
+        np.multiply(out[:, ::out.shape[-1] - 1], inv_step, out=out[:, ::out.shape[-1] - 1])
+
+    def update_range(self, ranges=None):
+        """Find the Z range used for normalization, exact or from a RangeEstimator
+
+        If Z holds NaN or inf, they are replaced in place, NaN and -inf by
+        the lower end of the range and inf by the upper, so the normals and
+        the uploaded surface stay finite. Finite values are left alone, and
+        clamped is set since Z no longer holds the raw evaluation.
+        """
+        self.z_range, self._finite, self._covers = measure_range(self.Z, ranges)
+        if not self._finite:
+            clamp_nonfinite(self.Z, self.z_range)
+            self.store_z()
+            self.clamped = True
+            self._finite = True
+        return self.z_range
+
+    def normalize(self, ranges=None):
+        """Scale Z into [0, 1] in the norm_Z buffer"""
+        self.update_range(ranges)
+        return normalize_into(self.Z, self.norm_Z, self.z_range, self._finite, self._covers)
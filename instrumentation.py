@@ -0,0 +1,124 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+
+class AllocationCounter:
+    def __init__(self):
+        """Count bytes allocated by Python and NumPy inside a with-block"""
+        self.net = 0  # bytes still allocated when the block ends
+        self.peak = 0  # highest number of bytes allocated during the block
+        self._started = False
+        self._before = 0
+
+    def __enter__(self):
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self._before = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current, peak = tracemalloc.get_traced_memory()
+        self.net = current - self._before
+        self.peak = peak - self._before
+        if self._started:
+            tracemalloc.stop()
+        return False
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        """Context manager that times one run of a stage"""
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class StageProfiler:
+    def __init__(self, window=300, max_trace_events=200000):
+        """Rolling per-stage timings of the frame loop and an optional trace recording
+
+        stage(name) times a with-block. While disabled it hands out one shared
+        no-op context manager, so the instrumented code pays a method call.
+        The last window durations of each stage give p50/p95/p99; while
+        recording, every run is also kept as a Chrome trace event.
+        """
+        self.enabled = False
+        self.recording = False
+        self.window = window
+        self.max_trace_events = max_trace_events
+        self.samples = {}  # stage name -> deque of the last durations in seconds
+        self.events = []  # Chrome trace events of the recording
+        self._origin = time.perf_counter()
+
+    def stage(self, name):
+        """Context manager timing one run of the stage name"""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, start, duration):
+        """Add one run of a stage that started at start (perf_counter) and took duration seconds"""
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples.setdefault(name, deque(maxlen=self.window))
+        samples.append(duration)
+        if self.recording and len(self.events) < self.max_trace_events:
+            thread = threading.current_thread()
+            self.events.append({'name': name, 'cat': 'frame', 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                                'ts': (start - self._origin) * 1e6, 'dur': duration * 1e6,
+                                'args': {'thread': thread.name}})
+
+    def percentiles(self, name, q=(50, 95, 99)):
+        """Rolling percentiles of a stage in seconds, None before the first sample"""
+        samples = self.samples.get(name)
+        if not samples:
+            return None
+        return tuple(np.percentile(np.fromiter(samples, dtype=float), q))
+
+    def summary(self):
+        """One line per stage: name and p50/p95/p99 in milliseconds"""
+        lines = []
+        for name in list(self.samples):
+            values = self.percentiles(name)
+            if values is not None:
+                lines.append(f"{name}: " + " / ".join(f"{v * 1000:.2f}" for v in values) + " ms")
+        return "\n".join(lines)
+
+    def reset(self):
+        """Forget the rolling samples"""
+        self.samples.clear()
+
+    def start_recording(self):
+        """Start collecting trace events, enables the profiler"""
+        self.events = []
+        self.enabled = True
+        self.recording = True
+
+    def stop_recording(self, path):
+        """Stop collecting and write the events as Chrome trace-event JSON, return the number written"""
+        self.recording = False
+        events = self.events
+        self.events = []
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+
+# shared no-op stage of a disabled profiler
+_NULL_STAGE = contextlib.nullcontext()
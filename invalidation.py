@@ -0,0 +1,37 @@
+# stages of a frame in dependency order, each one is computed from the one before
+FRAME_STAGES = ('grid', 'invariants', 'z', 'normalization', 'colors', 'upload')
+
+
+def affects(stage, target):
+    """True if invalidating stage also invalidates target"""
+    return FRAME_STAGES.index(stage) <= FRAME_STAGES.index(target)
+
+
+class DirtyStages:
+    def __init__(self, on_invalidate=None):
+        """Stages of the plot that a setting change made stale
+
+        Setting changes only mark the first stage they invalidate, everything
+        after it is stale as well. The plot takes the marks once per frame, so
+        a burst of changes, e.g. dragging a spinbox, costs one recompute from
+        the earliest stage any of them touched. on_invalidate() is called on
+        every mark, e.g. to wake up suspended updates.
+        """
+        self._first = None  # index of the earliest dirty stage
+        self._on_invalidate = on_invalidate
+
+    def invalidate(self, stage):
+        """Mark stage and every stage depending on it as stale"""
+        index = FRAME_STAGES.index(stage)
+        if self._first is None or index < self._first:
+            self._first = index
+        if self._on_invalidate is not None:
+            self._on_invalidate()
+
+    def is_dirty(self, stage):
+        return self._first is not None and FRAME_STAGES.index(stage) >= self._first
+
+    def take(self):
+        """Return the earliest dirty stage, or None, and mark all stages clean"""
+        first, self._first = self._first, None
+        return None if first is None else FRAME_STAGES[first]
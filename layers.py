@@ -0,0 +1,20 @@
+from normalization import RangeEstimator
+
+
+class SurfaceLayer:
+    def __init__(self, formula, rules, colormap, percentile=0.0, smoothing=0.0):
+        """Another surface shown next to the main one, with its own formula, scaling rules and colormap
+
+        It shares the grid, the cached invariant terms and the simulation
+        clock of the main surface, only its color range is its own.
+        """
+        self.formula = formula
+        self.rules = rules  # ((rule index, speed), ...) for a, b and c
+        self.colormap = colormap  # ColormapLUT
+        self.ranges = RangeEstimator(percentile, smoothing)
+
+
+def side_by_side(count, x, gap=0.0):
+    """(x, y, z) offsets that place count surfaces over the axis x next to each other, centered"""
+    width = abs(float(x[-1]) - float(x[0])) * (1 + gap)
+    return [((k - (count - 1) / 2) * width, 0.0, 0.0) for k in range(count)]
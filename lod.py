@@ -0,0 +1,64 @@
+from collections import deque
+
+
+class LodController:
+    def __init__(self, target_fps=30, min_points=40, hysteresis=0.2, settle_frames=15, granularity=10,
+                 refine_factor=1.5):
+        """Pick the evaluation grid resolution that keeps the frame rate near target_fps
+
+        While busy (animating or camera moving) the resolution follows the
+        measured frame rate, scaled by the square root of the speed ratio
+        since the cost grows with points². Changes only happen when the frame
+        rate leaves the hysteresis band around the target, and each change is
+        followed by settle_frames frames without another one. When idle the
+        resolution is refined step by step up to the full resolution.
+        """
+        self.target_fps = target_fps
+        self.min_points = min_points
+        self.hysteresis = hysteresis
+        self.settle_frames = settle_frames
+        self.granularity = granularity
+        self.refine_factor = refine_factor
+        self.points = None
+        self._cooldown = 0
+        self._frame_times = deque(maxlen=settle_frames)
+
+    def reset(self):
+        """Start again from full resolution"""
+        self.points = None
+        self._cooldown = 0
+        self._frame_times.clear()
+
+    def update(self, frame_time, max_points, busy):
+        """Feed the time between the last two frames, return the grid points to evaluate"""
+        if self.points is None or self.points > max_points:
+            self.points = max_points
+        if frame_time is not None and frame_time > 0:
+            self._frame_times.append(frame_time)
+        if self._cooldown > 0:
+            self._cooldown -= 1
+            return self.points
+
+        if not busy:
+            if self.points < max_points:
+                self._set(max(self.points * self.refine_factor, self.points + self.granularity), max_points)
+            return self.points
+
+        if len(self._frame_times) < self._frame_times.maxlen:
+            return self.points
+        fps = len(self._frame_times) / sum(self._frame_times)
+        ratio = (fps / self.target_fps) ** 0.5
+        if fps < self.target_fps * (1 - self.hysteresis) and self.points > self.min_points:
+            self._set(min(self.points * max(ratio, 0.5), self.points - self.granularity), max_points)
+        elif fps > self.target_fps * (1 + self.hysteresis) and self.points < max_points:
+            self._set(max(self.points * min(ratio, 1.25), self.points + self.granularity), max_points)
+        return self.points
+
+    def _set(self, points, max_points):
+        """Round and clamp a new resolution and start the settle period"""
+        points = int(round(points / self.granularity)) * self.granularity
+        points = max(min(self.min_points, max_points), min(points, max_points))
+        if points != self.points:
+            self.points = points
+            self._frame_times.clear()
+            self._cooldown = self.settle_frames
@@ -1,10 +1,29 @@
+import time
+
 import numpy as np
 from vispy import app
-from vispy.scene import visuals
-from vispy.color.colormap import get_colormap
 from vispy import scene  # for Text overlay
 from collections import deque  # for rolling dt window
 
+import app_config
+from adaptive import AdaptiveMesh
+from colormap import ColormapLUT
+from evaluation import BackendSelector, NumbaBackend, NumexprBackend, TiledEvaluator, evaluate_batch
+from expression import compile_formula, FormulaError
+from frame_cache import FrameCache
+from frame_bus import FrameViewer
+from frame_store import FrameStore
+from grid import FrameBuffers, GridBuffers
+from instrumentation import AllocationCounter, StageProfiler
+from invalidation import DirtyStages, affects
+from layers import SurfaceLayer, side_by_side
+from lod import LodController
+from normalization import RangeEstimator
+from pipeline import ComputePipeline, FrameRequest
+from scheduler import REAL_TIME, STATIC, SimulationClock, cycle_steps, parameters_at
+from surface import GridSurface
+from trial import FormulaTrial
+
 class FunctionPlotter:
     def __init__(self, view, props):
         """Initialize the function plotter with view and UI properties"""
@@ -12,24 +31,65 @@ class FunctionPlotter:
         self.props = props
         self.canvas = self.view.canvas  # access canvas for overlay and resize
 
-        # Initialize parameters
+        # Initialize parameters and the fixed-step simulation clock
         self.time = 0
+        self.clock = SimulationClock(app_config.SIMULATION_STEP, self.props.timing_mode.currentIndex(),
+                                     app_config.CATCH_UP_RATE)
+        self._scheduled_step = 0  # newest step handed to the pipeline
         self.a = 1
         self.b = 1
         self.c = 0
         self.function_input = self.props.function_input.text()
+        self.formula = compile_formula(self.function_input)
         
         # Initialize plot settings
         self.GRID_POINTS = self.props.grid_points.value()
         self.X_LIMITS = (self.props.x_limits.value() * -1, self.props.x_limits.value())
         self.Y_LIMITS = (self.props.y_limits.value() * -1, self.props.y_limits.value())
+        self.precision = self.props.precision.currentText()
+
+        # Adaptive level of detail, GRID_POINTS is then the full resolution
+        self.adaptive_lod = self.props.adaptive_lod.isChecked()
+        self.lod = LodController(self.props.target_fps.value(), app_config.LOD_MIN_POINTS)
+        self._last_frame_shown = None
+        self._frame_interval = None  # time between the last two new frames on screen
+        self._last_interaction = -np.inf
+
+        # Adaptive mesh, replaces the grid while enabled
+        self.adaptive_mesh = self.props.adaptive_mesh.isChecked()
+        self.mesh = AdaptiveMesh(self.props.mesh_vertices.value(), app_config.MESH_TOLERANCE,
+                                 app_config.MESH_REFINE_RATE)
+        self._mesh_topology = None  # mesh topology on the surface, None while the grid is shown
         
-        # Initialize colormap
-        self.cm = get_colormap(self.props.combo.currentText())
+        # Initialize colormap and the grid with its reusable buffers
+        self.colormap = ColormapLUT(self.props.combo.currentText())
+        self.ranges = RangeEstimator(self.props.range_percentile.value(), self.props.range_smoothing.value())
+        self.surfaces = []  # SurfaceLayer of every surface shown next to the main one
+        self.grid = GridBuffers()
+        self.frame = FrameBuffers()  # buffers of the synchronous path
+        threads = app_config.EVALUATION_THREADS or None
+        self.evaluator = BackendSelector([TiledEvaluator(threads, app_config.TILE_POINTS),
+                                          NumexprBackend(threads), NumbaBackend(threads)],
+                                         self.props.backend.currentText())
+        self._invariant_formulas = None  # formulas whose invariant terms the grid keeps
+        self.batch_grid = GridBuffers()  # grid of batched evaluations, apart from the pipeline's
+        self._batch_formula = None
+        self.pipeline = None
+        self.frame_cache = FrameCache(app_config.FRAME_CACHE_MB) if app_config.FRAME_CACHE_MB > 0 else None
+        self.profiler = StageProfiler(app_config.PROFILER_WINDOW)
+        self.playback = None  # FrameStore that is played instead of computing frames
+        self.bus = None  # FrameViewer of a frame server that computes the frames instead
+        self.trial = FormulaTrial(app_config.TRIAL_TIMEOUT) if app_config.TRIAL_TIMEOUT > 0 else None
+        if self.trial is not None:
+            self.trial.start()
+        self.dirty = DirtyStages(on_invalidate=self.wake)  # stages stale after setting changes
+        self.idle = False  # updates suspended until something changes
+        self.fps_cap = app_config.FPS_CAP
         
         # Create initial data and surface
         self.X, self.Y, self.Z = self.create_function(self.a, self.b, self.c)
         self.setup_surface_plot()
+        self.setup_pipeline()
         self.setup_timer()
 
         # FPS overlay setup
@@ -41,139 +101,770 @@ class FunctionPlotter:
             parent=self.canvas.scene
         )
         self._fps_text.visible = False
+        # Stage timing breakdown above the FPS text, shown while the profiler is enabled
+        self.show_stages = False
+        self._stages_text = scene.Text(
+            '', color='white', font_size=9,
+            anchor_x='right', anchor_y='top',
+            parent=self.canvas.scene
+        )
+        self._stages_text.visible = False
+        self._stage_frames = 0
         self._position_fps_text()
         self.canvas.events.resize.connect(self._on_canvas_resize)
+        self.canvas.events.draw.connect(self._on_draw_start, position='first')
+        self.canvas.events.draw.connect(self._on_draw_end, position='last')
+        self._draw_start = None
+
+        # Camera interaction counts as busy for the adaptive level of detail
+        self.canvas.events.mouse_move.connect(self._on_mouse_move)
+        self.canvas.events.mouse_wheel.connect(self._on_interaction)
         
     def setup_surface_plot(self):
         """Setup the surface plot visualization"""
-        self.surface = visuals.SurfacePlot(x=self.X, y=self.Y, z=self.Z, shading='smooth')
+        self.surface = GridSurface(self.grid.x, self.grid.y, colormap_mode=app_config.COLORMAP_MODE,
+                                   colormap=self.colormap.table)
+        self._surface_layout = (self.grid.generation, ())  # grid generation and surfaces on the surface
         self.view.add(self.surface)
+        self.plot_function(self.X, self.Y, self.Z)
+
+    def setup_pipeline(self):
+        """Start the background compute pipeline if enabled"""
+        self._held_frames = []  # pipeline frames uploaded but maybe not drawn yet
+        if app_config.BACKGROUND_COMPUTE:
+            self.pipeline = ComputePipeline(self.compute_frame, slots=app_config.PIPELINE_SLOTS,
+                                            ordered=self.clock.mode != REAL_TIME)
+            self.invalidate_frames()
         
     def setup_timer(self):
         """Setup the timer for updating the plot"""
-        self.timer = app.Timer(connect=self.update, interval='auto')
+        self.timer = app.Timer(connect=self.update, interval=self.frame_interval())
         self.timer.start()
+
+    def frame_interval(self):
+        """Seconds between updates, from the frame rate cap"""
+        return 1.0 / self.fps_cap if self.fps_cap > 0 else 0.0
+
+    def set_fps_cap(self, fps):
+        """Limit the update rate while animating, 0 removes the cap"""
+        self.fps_cap = fps
+        self.timer.interval = self.frame_interval()  # restarts a running timer
+
+    def is_idle(self):
+        """True if another update would show the same frame: nothing animates, is stale, moves or is computed"""
+        if self.bus is not None or self.playback is not None:
+            return False
+        if self.is_animating() or self.camera_moving() or self.dirty.is_dirty('upload'):
+            return False
+        if self.pipeline is not None and self.pipeline.busy:
+            return False
+        # the adaptive mesh and the adaptive level of detail refine while idle
+        if self.adaptive_mesh and not self.mesh.converged:
+            return False
+        if self.adaptive_lod and self.lod.points is not None and self.lod.points < self.GRID_POINTS:
+            return False
+        return True
+
+    def suspend_if_idle(self):
+        """Stop the update timer while idle, wake() starts it again"""
+        if not app_config.IDLE_SUSPEND or not self.is_idle():
+            return
+        self.idle = True
+        self.timer.stop()
+        self._fps_dts.clear()
+        self._fps_text.text = "Idle"
+
+    def wake(self):
+        """Resume updates after a suspension, the first update sees a short dt"""
+        if self.idle:
+            self.idle = False
+            self.timer.start()
         
-    def create_function(self, a, b, c):
-        """Generate data for the 3D function"""
-        x = np.linspace(*self.X_LIMITS, self.GRID_POINTS)
-        y = np.linspace(*self.Y_LIMITS, self.GRID_POINTS)
-        X, Y = np.meshgrid(x, y)
+    def frame_request(self, params=None, step=None, surfaces=None, cached=False):
+        """Snapshot the current settings for computing one frame"""
+        if surfaces is None:
+            surfaces = self.surface_parameters(self.time)
+        return FrameRequest(
+            self.pipeline.epoch if self.pipeline is not None else 0,
+            self.formula,
+            (self.a, self.b, self.c) if params is None else params,
+            self.effective_grid_points, self.X_LIMITS, self.Y_LIMITS,
+            colormap=None if app_config.COLORMAP_MODE == 'gpu' else self.colormap,
+            step=step,
+            dtype=self.precision,
+            surfaces=surfaces,
+            range_settings=(self.ranges.percentile, self.ranges.smoothing),
+            cached=cached,
+        )
+
+    def surface_parameters(self, time):
+        """((SurfaceLayer, (a, b, c)), ...) of the surfaces next to the main one at a simulation time"""
+        return tuple((layer, parameters_at(layer.rules, time)) for layer in self.surfaces)
+
+    def cache_step(self):
+        """Simulation step the phases are snapped to if the frame cache holds a whole period, else None"""
+        if self.frame_cache is None or self.surfaces:
+            return None
+        period = cycle_steps(self.scaling_rules(), self.clock.step)
+        # z_upload and normals, and the per-vertex colors in cpu colormap mode
+        frame_bytes = self.effective_grid_points ** 2 * (12 if app_config.COLORMAP_MODE == 'gpu' else 28)
+        if period == 0 or period * frame_bytes > self.frame_cache.budget:
+            return None
+        return self.clock.step
+
+    def step_request(self, step):
+        """Frame request for a simulation step"""
+        # With the frame cache the phases are snapped so that periods repeat exactly
+        with self.profiler.stage("parameters"):
+            snap = self.cache_step()
+            time = self.clock.step_time(step)
+            params = parameters_at(self.scaling_rules(), time, snap)
+            return self.frame_request(params, step, self.surface_parameters(time), cached=snap is not None)
 
-        # Evaluate the function
-        context = {'X': X, 'Y': Y, 'a': a, 'b': b, 'c': c, 'np': np}
+    def evaluate_frame(self, request, frame):
+        """Evaluate the formulas of a request into frame.Z of every layer, safe to run off the GUI thread
+
+        Return False if the buffers already hold the Z of the same formulas,
+        parameters, grid and backend, which is then kept.
+        """
+        grid = self.grid
+        grid.ensure(request.grid_points, request.x_limits, request.y_limits, request.dtype)
+        formulas = (request.formula,) + tuple(layer.formula for layer, _ in request.surfaces)
+        params = (request.params,) + tuple(params for _, params in request.surfaces)
+        if formulas != self._invariant_formulas:
+            # terms are cached by their source, the surfaces share the terms they have in common
+            grid.retain_invariants({key for formula in formulas for key in formula.frame_keys})
+            self._invariant_formulas = formulas
+        frame.ensure(grid, len(formulas))
+        frame.params = request.params
+        frame.surfaces = tuple(layer for layer, _ in request.surfaces)
+        z_key = (formulas, params, grid.generation, self.evaluator.choice)
+        if frame.z_key == z_key:
+            return False
+
+        # Evaluate with the selected backend, NumPy runs parallel tiles and caches terms of X and Y only
         try:
-            Z = eval(self.function_input, context)
+            with self.profiler.stage("evaluate"):
+                self.evaluate_layers(formulas, params, frame)
+            frame.z_key = z_key
         except Exception as e:
             print(f"Error during create_function: {e}")
-            Z = np.zeros_like(X)
-        return X, Y, Z
-        
+            for layer in frame.layers:
+                layer.Z.fill(0)
+                layer.store_z()
+            frame.z_key = None
+        return True
+
+    def evaluate_layers(self, formulas, params, frame):
+        """Evaluate formulas[k] with params[k] into layer k of frame
+
+        On grids that fit BATCH_CHUNK_BYTES neighbours with the same formula
+        are evaluated as one batch, larger grids go through the backend
+        selector layer by layer.
+        """
+        batch = self.grid.X.nbytes <= app_config.BATCH_CHUNK_BYTES
+        start = 0
+        while start < len(formulas):
+            stop = start + 1
+            while batch and stop < len(formulas) and formulas[stop] is formulas[start]:
+                stop += 1
+            if stop > start + 1:
+                begin = time.perf_counter()
+                evaluate_batch(formulas[start], self.grid, params[start:stop], frame.Z_layers[start:stop],
+                               app_config.BATCH_CHUNK_BYTES)
+                self.evaluator.last = ("batch", time.perf_counter() - begin)
+            else:
+                self.evaluator.evaluate(formulas[start], self.grid, params[start], frame.layers[start].Z)
+            start = stop
+        for layer in frame.layers:
+            layer.store_z()
+
+    def finish_frame(self, request, frame, normals=True):
+        """Normalize, color (cpu colormap mode only) and compute normals of every layer of an evaluated frame"""
+        layers = self.frame_layers(request, frame)
+        if request.colormap is None:
+            with self.profiler.stage("normalize"):
+                for layer, ranges, _ in layers:
+                    layer.update_range(ranges)
+        else:
+            with self.profiler.stage("normalize"):
+                for layer, ranges, _ in layers:
+                    layer.normalize(ranges)
+            with self.profiler.stage("colormap"):
+                for layer, _, colormap in layers:
+                    colormap.map(layer.norm_Z, layer.color_index, layer.colors)
+        if any(layer.clamped for layer in frame.layers):
+            # the clamp depends on the color range, a recolor has to evaluate the raw Z again
+            frame.z_key = None
+        if normals:
+            with self.profiler.stage("normals"):
+                for layer, _, _ in layers:
+                    layer.compute_normals()
+        return frame
+
+    def frame_layers(self, request, frame):
+        """(buffers, RangeEstimator, ColormapLUT or None in gpu mode) of every layer of a frame"""
+        layers = [(frame, self.ranges, request.colormap)]
+        for buffers, (layer, _) in zip(frame.layers[1:], request.surfaces):
+            layers.append((buffers, layer.ranges, layer.colormap if request.colormap is not None else None))
+        return layers
+
+    def compute_frame(self, request, frame):
+        """Compute a complete frame or load it from the frame cache"""
+        cache = self.frame_cache if request.cached else None
+        if cache is not None:
+            key = cache.key(request)
+            self.grid.ensure(request.grid_points, request.x_limits, request.y_limits, request.dtype)
+            frame.ensure(self.grid)
+            with self.profiler.stage("cache"):
+                hit = cache.load(key, frame)
+            if hit:
+                frame.params = request.params
+                frame.surfaces = ()
+                frame.z_key = None
+                return frame
+        # a kept Z still has its normals, only normalization and colors are redone
+        evaluated = self.evaluate_frame(request, frame)
+        self.finish_frame(request, frame, normals=evaluated)
+        if cache is not None:
+            with self.profiler.stage("cache"):
+                cache.store(key, frame, with_colors=request.colormap is not None)
+        return frame
+
+    def step_parameters(self, steps):
+        """(K, 3) array of (a, b, c) for K simulation steps, as the frames of these steps use them"""
+        times = self.clock.step_time(np.asarray(steps, dtype=float))
+        return np.stack(np.broadcast_arrays(*parameters_at(self.scaling_rules(), times, self.cache_step())), axis=-1)
+
+    def evaluate_batch(self, params, out=None):
+        """Evaluate K (a, b, c) triples with the current settings, return Z as a (K, N, N) array"""
+        request = self.frame_request()
+        grid = self.batch_grid
+        grid.ensure(request.grid_points, request.x_limits, request.y_limits, request.dtype)
+        if request.formula is not self._batch_formula:
+            grid.clear_invariants()
+            self._batch_formula = request.formula
+        params = np.asarray(params, dtype=float).reshape(-1, 3)
+        if out is None:
+            out = np.empty((len(params),) + grid.X.shape, dtype=grid.dtype)
+        return evaluate_batch(request.formula, grid, params, out, app_config.BATCH_CHUNK_BYTES)
+
+    def preroll(self, count, first_step=None):
+        """Compute the next count simulation steps in one batch and put them into the frame cache"""
+        if self.cache_step() is None:
+            return 0
+        first_step = self.clock.shown_step + 1 if first_step is None else first_step
+        requests = [self.step_request(step) for step in range(first_step, first_step + count)]
+        try:
+            Z = self.evaluate_batch([request.params for request in requests])
+        except Exception as e:
+            print(f"Error during preroll: {e}")
+            return 0
+        frame = FrameBuffers()
+        frame.ensure(self.batch_grid)
+        for request, z in zip(requests, Z):
+            frame.store_z(z)
+            self.finish_frame(request, frame)
+            self.frame_cache.store(self.frame_cache.key(request), frame, with_colors=request.colormap is not None)
+        return len(requests)
+
+    def create_function(self, a, b, c):
+        """Generate data for the 3D function"""
+        self.evaluate_frame(self.frame_request((a, b, c)), self.frame)
+        return self.grid.X, self.grid.Y, self.frame.Z
+
     def plot_function(self, X, Y, Z):
         """Update the surface plot with new data"""
         try:
-            # Normalize Z values for colormap if there's a range
-            if Z.max() != Z.min():
-                norm_Z = (Z - Z.min()) / (Z.max() - Z.min())
-            else:
-                norm_Z = np.zeros_like(Z)
-                
-            colors = self.cm.map(norm_Z)
-
-            # Update the mesh data
-            self.surface.mesh_data.set_vertices(np.column_stack([X.ravel(), Y.ravel(), Z.ravel()]))
-            self.surface.set_data(z=Z, x=X, y=Y, colors=colors)
+            self.finish_frame(self.frame_request(), self.frame)
+            self.show_frame(self.frame)
         except Exception as e:
             print(f"Error during plot_function: {e}")
+
+    @property
+    def effective_grid_points(self):
+        """Grid resolution that is evaluated, lowered by the adaptive level of detail"""
+        if self.adaptive_lod and self.lod.points is not None:
+            return min(self.lod.points, self.GRID_POINTS)
+        return self.GRID_POINTS
+
+    def show_frame(self, frame):
+        """Upload a computed frame to the surface"""
+        now = time.perf_counter()
+        if self._last_frame_shown is not None:
+            self._frame_interval = now - self._last_frame_shown
+        self._last_frame_shown = now
+
+        # Static x/y and indices are only sent again when the grid was rebuilt or the surfaces changed
+        layout = (frame.generation, frame.surfaces)
+        if self._surface_layout != layout:
+            offsets = side_by_side(len(frame.layers), frame.x, app_config.SURFACE_GAP) if frame.surfaces else None
+            self.surface.set_grid(frame.x, frame.y, offsets)
+            if self.surface.colormap_mode == 'gpu':
+                for k, layer in enumerate(frame.surfaces, 1):
+                    self.surface.set_colormap(layer.colormap.table, k)
+            self._surface_layout = layout
+        z, slopes, colors, z_range = frame.upload_data()
+        colors = colors if self.surface.colormap_mode == 'cpu' else None
+        with self.profiler.stage("upload"):
+            # all surfaces go up in one upload and are drawn in one call
+            self.surface.set_data(z, slopes, colors, z_range)
+
+    def measure_frame_allocations(self, frames=10):
+        """Return the average (net, peak) bytes one frame of the main surface allocates before upload
+
+        The frames go into their own grid and buffers, the compute worker
+        keeps writing the plotter's meanwhile.
+        """
+        request = self.frame_request((self.a, self.b, self.c), surfaces=())
+        grid, frame = GridBuffers(), FrameBuffers()
+        grid.ensure(request.grid_points, request.x_limits, request.y_limits, request.dtype)
+        frame.ensure(grid)
+        ranges = RangeEstimator(self.ranges.percentile, self.ranges.smoothing)
+
+        def compute():
+            self.evaluator.evaluate(request.formula, grid, request.params, frame.Z)
+            frame.store_z()
+            if request.colormap is None:
+                frame.update_range(ranges)
+            else:
+                request.colormap.map(frame.normalize(ranges), frame.color_index, frame.colors)
+            frame.compute_normals()
+
+        compute()  # the invariant terms are cached from the first frame on, like on the plotter's grid
+        net = peak = 0
+        for _ in range(frames):
+            with AllocationCounter() as counter:
+                compute()
+            net += counter.net
+            peak += counter.peak
+        return net / frames, peak / frames
     
+    def check_function(self, text):
+        """Trial-evaluate a formula on sample grids before it is plotted, return (accepted, message)
+
+        Formulas that fail, time out, are NaN or inf everywhere or would need
+        too much memory even at the lowest resolution are rejected. A frame
+        that would need too much memory lowers the grid resolution. A frame
+        slower than the target frame rate starts the adaptive level of detail
+        lower, switches to a backend that keeps up or gets a warning.
+        """
+        if self.trial is None:
+            return True, ""
+        steps = self.clock.shown_step + np.arange(4) * int(1 / self.clock.step)
+        try:
+            report = self.trial.run(text, self.GRID_POINTS, self.X_LIMITS, self.Y_LIMITS, self.precision,
+                                    self.step_parameters(steps))
+        except Exception as e:
+            print(f"Error during check_function: {e}")
+            return True, ""
+        if report.skipped:
+            return True, "The trial worker is still starting, the formula was not tried."
+        if report.error is not None:
+            return False, report.error
+        if report.nonfinite >= 1:
+            return False, "The formula is NaN or inf at every sampled point."
+
+        messages = []
+        points = self.GRID_POINTS
+        limit = app_config.TRIAL_MAX_FRAME_MB * 2 ** 20
+        if report.peak_bytes > limit:
+            points = int(points * (limit / report.peak_bytes) ** 0.5)
+            if points < self.props.grid_points.minimum():
+                return False, f"One frame would need about {report.peak_bytes / 2 ** 20:.0f} MB."
+            messages.append(f"Resolution lowered to {points}², one frame needed about "
+                            f"{report.peak_bytes / 2 ** 20:.0f} MB.")
+            self.props.grid_points.setValue(points)
+
+        budget = 1 / self.lod.target_fps
+        backend = self.evaluator.choice if self.evaluator.choice in report.seconds else report.fastest
+        seconds = report.estimate(backend, points)
+        if seconds > budget:
+            if self.adaptive_lod:
+                self.lod.points = max(self.lod.min_points, report.points_within(budget, backend))
+                messages.append(f"Starting at {self.lod.points}² to reach {self.lod.target_fps} FPS.")
+            elif report.estimate(report.fastest, points) <= budget:
+                messages.append(f"Switched to {report.fastest}, {backend} needs "
+                                f"{seconds * 1000:.0f} ms per frame.")
+                self.props.backend.setCurrentText(report.fastest)
+            else:
+                messages.append(f"Expect about {seconds * 1000:.0f} ms per frame at {points}².")
+        if report.nonfinite > app_config.TRIAL_NONFINITE_WARN:
+            messages.append(f"{report.nonfinite:.0%} of the sampled values are NaN or inf.")
+        return True, " ".join(messages)
+
     def update_function(self, new_function):
         """Change the function definition"""
+        try:
+            self.formula = compile_formula(new_function)
+        except FormulaError as e:
+            print(f"Error during update_function: {e}")
+            return
         self.function_input = new_function
-        self.X, self.Y, self.Z = self.create_function(self.a, self.b, self.c)
-        self.plot_function(self.X, self.Y, self.Z)
+        self.dirty.invalidate('invariants')
     
     def update_x_limits(self, value):
         """Update X axis limits"""
         self.X_LIMITS = (value * -1, value)
-        self.update_plot()
+        self.dirty.invalidate('grid')
     
     def update_y_limits(self, value):
         """Update Y axis limits"""
         self.Y_LIMITS = (value * -1, value)
-        self.update_plot()
+        self.dirty.invalidate('grid')
     
     def update_grid_points(self, value):
-        """Update grid resolution"""
+        """Update grid resolution, spinbox steps between two frames cause one rebuild"""
         self.GRID_POINTS = value
-        self.update_plot()
+        self.dirty.invalidate('grid')
     
+    def update_precision(self, precision):
+        """Switch between float32 and float64 grids and frame buffers"""
+        self.precision = precision
+        self.dirty.invalidate('grid')
+
+    def update_backend(self, name):
+        """Select the evaluation backend, "auto" times them and keeps the fastest"""
+        self.evaluator.choice = name
+        self.dirty.invalidate('z')
+
     def update_colormap(self, colormap_name):
-        """Update the colormap"""
-        self.cm = get_colormap(colormap_name)
-        self.update_plot()
+        """Update the colormap, Z is not evaluated again"""
+        self.colormap = ColormapLUT(colormap_name)
+        if self.surface.colormap_mode == 'gpu':
+            self.surface.set_colormap(self.colormap.table)
+        else:
+            self.dirty.invalidate('colors')
     
+    def update_range_percentile(self, value):
+        """Percentage of the values clipped at both ends of the color range"""
+        for ranges in self.all_ranges():
+            ranges.percentile = value
+        self.dirty.invalidate('normalization')
+
+    def update_range_smoothing(self, value):
+        """Weight of the previous color range in its moving average, 0 follows every frame"""
+        for ranges in self.all_ranges():
+            ranges.smoothing = value
+        self.dirty.invalidate('normalization')
+
+    def all_ranges(self):
+        """RangeEstimator of the main surface and of every surface next to it"""
+        return [self.ranges] + [layer.ranges for layer in self.surfaces]
+
+    def add_surface(self, colormap_name=None):
+        """Show the current formula and scaling rules as another surface, return False at app_config.MAX_SURFACES
+
+        The new surface keeps them when the main surface changes. Without a
+        colormap_name it takes the colormap after the last one in the list.
+        """
+        if len(self.surfaces) + 1 >= app_config.MAX_SURFACES:
+            return False
+        if colormap_name is None:
+            names = app_config.ALLOWED_COLORMAPS
+            last = self.surfaces[-1].colormap.name if self.surfaces else self.colormap.name
+            colormap_name = names[(names.index(last) + 1) % len(names)] if last in names else names[0]
+        self.surfaces = self.surfaces + [SurfaceLayer(self.formula, self.scaling_rules(), ColormapLUT(colormap_name),
+                                                      self.ranges.percentile, self.ranges.smoothing)]
+        self.dirty.invalidate('z')
+        return True
+
+    def clear_surfaces(self):
+        """Show the main surface alone again"""
+        self.surfaces = []
+        self.dirty.invalidate('z')
+
+    def update_adaptive_lod(self, enabled):
+        """Enable or disable the adaptive level of detail"""
+        self.adaptive_lod = bool(enabled)
+        self.lod.reset()
+        self.dirty.invalidate('grid')
+
+    def update_adaptive_mesh(self, enabled):
+        """Switch between the adaptive mesh and the regular grid"""
+        self.adaptive_mesh = bool(enabled)
+        self._mesh_topology = None
+        self._surface_layout = None  # the grid goes back on the surface with the next frame
+        if self.adaptive_mesh and self.pipeline is not None:
+            self.pipeline.invalidate()
+        self.dirty.invalidate('grid')
+
+    def update_mesh_vertices(self, value):
+        """Vertex budget of the adaptive mesh, it is merged or refined towards it over the next frames"""
+        self.mesh.max_vertices = value
+        self.mesh.converged = False
+        self.dirty.invalidate('z')
+
+    def update_target_fps(self, value):
+        """Frame rate the adaptive level of detail aims for"""
+        self.lod.target_fps = value
+        self.wake()
+
+    def is_animating(self):
+        """True if any scaling rule of any surface changes a, b or c over time"""
+        rules = self.scaling_rules() + tuple(rule for layer in self.surfaces for rule in layer.rules)
+        return any(rule != STATIC for rule, _ in rules)
+
+    def camera_moving(self, window=0.3):
+        """True while the camera has been dragged or zoomed within the last window seconds"""
+        return time.perf_counter() - self._last_interaction < window
+
+    def _update_lod(self):
+        """Let the level of detail controller react to the last frame interval"""
+        frame_interval, self._frame_interval = self._frame_interval, None
+        busy = self.is_animating() or self.camera_moving()
+        self.lod.update(frame_interval, self.GRID_POINTS, busy)
+
+    def _on_mouse_move(self, event):
+        if event.is_dragging:
+            self._last_interaction = time.perf_counter()
+            self.wake()
+
+    def _on_interaction(self, event):
+        self._last_interaction = time.perf_counter()
+        self.wake()
+
+    def update_scaling_rules(self):
+        """Drop frames computed with the previous scaling rules or speeds"""
+        self.dirty.invalidate('z')
+
+    def update_timing_mode(self, mode):
+        """Switch between the real-time, every-step and catch-up timing modes"""
+        self.clock.set_mode(mode)
+        if self.pipeline is not None:
+            self.pipeline.set_ordered(mode != REAL_TIME)
+            self.dirty.invalidate('z')
+
+    def invalidate_frames(self):
+        """Drop queued pipeline frames and recompute the step on screen"""
+        self.pipeline.invalidate()
+        self._scheduled_step = self.clock.shown_step
+        self.pipeline.submit(self.step_request(self.clock.shown_step))
+
     def update_plot(self):
         """Regenerate the function plot with current parameters"""
+        if self.pipeline is not None:
+            # The worker picks up the new settings, stale frames are dropped
+            self.invalidate_frames()
+            return
         self.X, self.Y, self.Z = self.create_function(self.a, self.b, self.c)
         self.plot_function(self.X, self.Y, self.Z)
-    
+
+    def refresh(self, stage):
+        """Recompute the plot from the earliest stale stage on"""
+        if self.pipeline is not None:
+            # the worker keeps a Z it still holds if only later stages are stale
+            self.invalidate_frames()
+        elif affects(stage, 'z'):
+            self.update_plot()
+        else:
+            self.recolor()
+
+    def recolor(self):
+        """Normalize and color the Z on screen again without evaluating the formula"""
+        self.finish_frame(self.frame_request(), self.frame, normals=False)
+        self.show_frame(self.frame)
+
+    def release_drawn_frames(self):
+        """Frames already drawn have been copied to the GPU and can be reused"""
+        if self.surface.drawn:
+            for held in self._held_frames:
+                self.pipeline.release(held)
+            self._held_frames = []
+
+    def update_from_pipeline(self):
+        """Queue upcoming steps and show the finished frame that is due"""
+        pipeline = self.pipeline
+        clock = self.clock
+        self.release_drawn_frames()
+
+        # Without animation every step looks the same, setting changes queue their own frame
+        animating = self.is_animating()
+        if pipeline.ordered:
+            # Keep the queue filled with the following steps, in order, catch-up strides over some
+            while animating and pipeline.outstanding < pipeline.slots:
+                self._scheduled_step = clock.step_after(self._scheduled_step)
+                pipeline.submit(self.step_request(self._scheduled_step))
+            ready_step = pipeline.next_ready_step()
+            if ready_step is None or ready_step > clock.due_step():
+                return
+        elif animating:
+            step = clock.next_step()
+            if step is not None and step != self._scheduled_step:
+                self._scheduled_step = step
+                pipeline.submit(self.step_request(step))
+
+        frame = pipeline.take()
+        if frame is None:
+            return
+        self.show_frame(frame)
+        self._held_frames.append(frame)
+        clock.mark_shown(frame.step)
+        self.time = clock.sim_time
+        self.a, self.b, self.c = frame.params
+        self.X, self.Y, self.Z = self.grid.X, self.grid.Y, frame.Z
+
+    def show_step(self, step):
+        """Compute and show one simulation step on the GUI thread"""
+        request = self.step_request(step)
+        self.compute_frame(request, self.frame)
+        self.show_frame(self.frame)
+        self.clock.mark_shown(step)
+        self.time = self.clock.sim_time
+        self.a, self.b, self.c = request.params
+        self.X, self.Y, self.Z = self.grid.X, self.grid.Y, self.frame.Z
+
+    def show_mesh_step(self, step):
+        """Refine the adaptive mesh incrementally, evaluate one simulation step on it and show it"""
+        request = self.step_request(step)
+        mesh = self.mesh
+        mesh.ensure(self.GRID_POINTS, self.X_LIMITS, self.Y_LIMITS, self.precision)
+        with self.profiler.stage("evaluate"):
+            mesh.step(self.formula, request.params, self.ranges)
+        colors = None
+        if self.surface.colormap_mode == 'cpu':
+            with self.profiler.stage("colormap"):
+                colors = self.colormap.map(mesh.normalize(), mesh.color_index, mesh.colors)
+        with self.profiler.stage("upload"):
+            # vertices and triangles are only sent again when the leaves changed
+            if self._mesh_topology != mesh.topology:
+                self.surface.set_mesh(mesh.ij, mesh.faces, mesh.origin, mesh.spacing, mesh.size)
+                self._mesh_topology = mesh.topology
+                self._surface_layout = None
+            self.surface.set_data(mesh.z_upload, mesh.normals, colors, mesh.z_range)
+        self.clock.mark_shown(step)
+        self.time = self.clock.sim_time
+        self.a, self.b, self.c = request.params
+
+    def start_playback(self, path):
+        """Play a precomputed frame store instead of evaluating the formula, return True on success"""
+        try:
+            store = FrameStore(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error during start_playback: {e}")
+            return False
+        self.playback = store
+        if self.pipeline is not None:
+            self.pipeline.invalidate()
+        self.wake()
+        return True
+
+    def stop_playback(self):
+        """Return to evaluating the formula"""
+        self.playback = None
+        self.update_plot()
+
+    def show_playback_step(self, step):
+        """Show the stored frame of a simulation step, streamed from the memory map"""
+        store = self.playback
+        colormap = self.colormap if self.surface.colormap_mode == 'cpu' else None
+        self.show_frame(store.frame(store.index_at(self.clock.step_time(step)), colormap))
+        self.clock.mark_shown(step)
+        self.time = self.clock.sim_time
+
+    def attach_bus(self, name):
+        """Show the frames of a running app_frame_server.py instead of computing them, return True on success"""
+        try:
+            viewer = FrameViewer(name)
+        except (OSError, ValueError) as e:
+            print(f"Error during attach_bus: {e}")
+            return False
+        self.detach_bus(replot=False)
+        self.bus = viewer
+        if self.pipeline is not None:
+            self.pipeline.invalidate()
+        self.wake()
+        return True
+
+    def detach_bus(self, replot=True):
+        """Return to computing frames locally"""
+        if self.bus is None:
+            return
+        self.bus.close()
+        self.bus = None
+        if replot:
+            self.update_plot()
+
+    def show_bus_frame(self):
+        """Show the newest frame of the frame server, older ones are skipped"""
+        frame = self.bus.latest()
+        if frame is None:
+            return
+        if self.surface.colormap_mode == 'cpu':
+            self.colormap.map(frame.normalize(), frame.color_index, frame.colors)
+        self.show_frame(frame)
+        self.clock.mark_shown(frame.step)
+        self.time = self.clock.sim_time
+
+    def stop(self):
+        """Stop the timer and the background pipeline"""
+        self.timer.stop()
+        self.detach_bus(replot=False)
+        if self.trial is not None:
+            self.trial.close()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        self.evaluator.shutdown()
+
     def update(self, event):
         """Update the function coefficients and replot."""
         try:
-            self.time += event.dt
-            self.update_parameters()
-            self.X, self.Y, self.Z = self.create_function(self.a, self.b, self.c)
-            self.plot_function(self.X, self.Y, self.Z)
+            self.clock.tick(event.dt)
+            # all setting changes since the last frame, frames from elsewhere ignore them
+            stale = self.dirty.take()
+            if stale is not None and affects(stale, 'z'):
+                # the color range of another Z starts over instead of drifting there
+                for ranges in self.all_ranges():
+                    ranges.reset()
+            if self.bus is not None:
+                self.show_bus_frame()
+            elif self.playback is not None:
+                step = self.clock.next_step()
+                if step is not None:
+                    self.show_playback_step(step)
+            elif self.adaptive_mesh:
+                step = self.clock.next_step()
+                if step is not None or stale is not None or not self.mesh.converged:
+                    self.show_mesh_step(self.clock.shown_step if step is None else step)
+            elif self.pipeline is not None:
+                if stale is not None:
+                    # the frame on screen goes back first, the worker reuses its Z for a recolor
+                    self.release_drawn_frames()
+                    self.refresh(stale)
+                self.update_from_pipeline()
+            else:
+                step = self.clock.next_step()
+                if step is not None:
+                    self.show_step(step)  # computes the step with the new settings anyway
+                elif stale is not None:
+                    self.refresh(stale)
+
+            if self.adaptive_lod:
+                self._update_lod()
 
             # update FPS overlay (default averaging window = 10)
             self._update_fps(event.dt, window=10)
+            if self.show_stages:
+                self._update_stages_text()
+            self.suspend_if_idle()
         except Exception as e:
             print(f"Error during update: {e}")
     
-    def update_parameters(self):
-        """Update a, b, c parameters based on scaling rules"""
-        # Get speed percentages from UI
-        speed_percent_a = int(self.props.scaling_speed_a.currentText().split()[-2]) / 100
-        speed_percent_b = int(self.props.scaling_speed_b.currentText().split()[-2]) / 100
-        speed_percent_c = int(self.props.scaling_speed_c.currentText().split()[-2]) / 100
-        
-        # Update parameter a
-        rule_a = self.props.scaling_rule_a.currentIndex()
-        if rule_a == 0:  # sin(t)
-            self.a = np.sin(self.time * speed_percent_a)
-        elif rule_a == 1:  # cos(t)
-            self.a = np.cos(self.time * speed_percent_a)
-        elif rule_a == 2:  # tan(t)
-            self.a = np.tan(self.time * speed_percent_a)
-        else:  # static
-            self.a = 1
-            
-        # Update parameter b
-        rule_b = self.props.scaling_rule_b.currentIndex()
-        if rule_b == 0:  # sin(t)
-            self.b = np.sin(self.time * speed_percent_b)
-        elif rule_b == 1:  # cos(t)
-            self.b = np.cos(self.time * speed_percent_b)
-        elif rule_b == 2:  # tan(t)
-            self.b = np.tan(self.time * speed_percent_b)
-        else:  # static
-            self.b = 1
-            
-        # Update parameter c
-        rule_c = self.props.scaling_rule_c.currentIndex()
-        if rule_c == 0:  # sin(t)
-            self.c = np.sin(self.time * speed_percent_c)
-        elif rule_c == 1:  # cos(t)
-            self.c = np.cos(self.time * speed_percent_c)
-        elif rule_c == 2:  # tan(t)
-            self.c = np.tan(self.time * speed_percent_c)
-        else:  # static
-            self.c = 1
+    def scaling_rules(self):
+        """((rule index, speed), ...) for a, b and c as selected in the UI"""
+        rules = []
+        for rule, speed in ((self.props.scaling_rule_a, self.props.scaling_speed_a),
+                            (self.props.scaling_rule_b, self.props.scaling_speed_b),
+                            (self.props.scaling_rule_c, self.props.scaling_speed_c)):
+            # Get speed percentages from UI
+            rules.append((rule.currentIndex(), int(speed.currentText().split()[-2]) / 100))
+        return tuple(rules)
 
     # helpers for FPS overlay
     def _position_fps_text(self, padding=10):
         w, h = self.canvas.size
         self._fps_text.pos = (w - padding, h - padding)
+        self._stages_text.pos = (w - padding, h - padding - 22)
 
     def _on_canvas_resize(self, event):
         self._position_fps_text()
@@ -197,10 +888,58 @@ class FunctionPlotter:
             return None
 
         fps = len(self._fps_dts) / sum(self._fps_dts)
-        self._fps_text.text = f"FPS: {fps:.1f}"
+        text = f"FPS: {fps:.1f}"
+        # Report when the simulation runs behind the wall clock
+        if self.clock.lag > self.clock.step:
+            text += f" | Lag: {self.clock.lag:.2f} s"
+        if self.adaptive_lod:
+            text += f" | Res: {self.effective_grid_points}²"
+        if self.evaluator.last is not None:
+            backend, seconds = self.evaluator.last
+            text += f" | {backend}: {seconds * 1000:.1f} ms"
+        if self.frame_cache is not None:
+            text += f" | Cache: {self.frame_cache.hits} hits / {self.frame_cache.misses} misses"
+        self._fps_text.text = text
         self._fps_text.visible = True
         return fps
 
+    def _on_draw_start(self, event):
+        if self.profiler.enabled:
+            self._draw_start = time.perf_counter()
+
+    def _on_draw_end(self, event):
+        if self.profiler.enabled and self._draw_start is not None:
+            self.profiler.record("draw", self._draw_start, time.perf_counter() - self._draw_start)
+            self._draw_start = None
+
+    def _update_stages_text(self, every=15):
+        """Refresh the p50/p95/p99 breakdown every few frames"""
+        self._stage_frames += 1
+        if self._stage_frames % every == 0:
+            self._stages_text.text = "p50 / p95 / p99\n" + self.profiler.summary()
+
+    # public setter to control the stage timing overlay
+    def set_show_stages(self, show: bool):
+        self.show_stages = bool(show)
+        self.profiler.enabled = self.show_stages or self.profiler.recording
+        if not self.show_stages:
+            self.profiler.reset()
+        self._stages_text.visible = self.show_stages
+
+    def start_trace(self):
+        """Record every stage run as a trace event until stop_trace"""
+        self.profiler.start_recording()
+
+    def stop_trace(self, path):
+        """Write the recorded session as Chrome trace-event JSON (chrome://tracing, Perfetto)"""
+        try:
+            count = self.profiler.stop_recording(path)
+        except OSError as e:
+            print(f"Error during stop_trace: {e}")
+            return 0
+        self.profiler.enabled = self.show_stages
+        return count
+
     # public setter to control FPS overlay
     def set_show_fps(self, show: bool):
         self.show_fps = bool(show)
@@ -0,0 +1,105 @@
+import numpy as np
+
+# values per block when the finite extremes are searched, the mask of one block stays in cache
+FINITE_BLOCK = 65536
+# values of the sample the percentiles are taken from
+PERCENTILE_POINTS = 16384
+
+
+def finite_range(values):
+    """(min, max, finite) of the finite values, finite is False if there are NaN or inf
+
+    min and max are two vectorized passes without temporaries. NaN and inf
+    show up in their results, only then the finite extremes are searched
+    block by block. (nan, nan, False) if no value is finite.
+    """
+    lo, hi = values.min(), values.max()
+    if np.isfinite(lo) and np.isfinite(hi):
+        return lo, hi, True
+    flat = values.reshape(-1)
+    lo, hi = np.inf, -np.inf
+    for start in range(0, flat.size, FINITE_BLOCK):
+        block = flat[start:start + FINITE_BLOCK]
+        block = block[np.isfinite(block)]
+        if block.size:
+            lo, hi = min(lo, block.min()), max(hi, block.max())
+    if lo > hi:
+        return np.nan, np.nan, False
+    return lo, hi, False
+
+
+class RangeEstimator:
+    def __init__(self, percentile=0.0, smoothing=0.0):
+        """Normalization range of Z frames: NaN-aware, clipped and smoothed
+
+        The extremes are measured on all values, so NaN and inf are found
+        wherever they are. percentile > 0 clips that percentage
+        of the finite values at both ends, so a few huge values near a pole
+        don't squeeze all others into one color. smoothing is the weight of
+        the previous range in an exponential moving average over the frames,
+        so the colors don't flicker when the range jumps. reset() drops the
+        history, e.g. for a new formula.
+        """
+        self.percentile = percentile
+        self.smoothing = smoothing
+        self.previous = None
+
+    def reset(self):
+        self.previous = None
+
+    def update(self, Z):
+        """((z_min, z_max), finite, covers) of the next frame
+
+        finite is False if NaN or inf were seen, covers is True if every
+        value of Z is known to lie within the range.
+        """
+        lo, hi, finite = finite_range(Z)
+        covers = finite
+        if not np.isfinite(lo):
+            return (0.0, 0.0), False, False
+
+        if self.percentile > 0 and lo < hi:
+            # every k-th row and column, a flat stride would alias with the row length and miss columns
+            k = max(1, int((Z.size / PERCENTILE_POINTS) ** 0.5))
+            values = (Z[::k, ::k] if Z.ndim == 2 else Z[::k * k]).ravel()
+            if not finite:
+                values = values[np.isfinite(values)]
+            if values.size:
+                lo, hi = np.percentile(values, (self.percentile, 100 - self.percentile))
+                covers = False
+        if self.smoothing > 0 and self.previous is not None:
+            w = self.smoothing
+            lo, hi = w * self.previous[0] + (1 - w) * lo, w * self.previous[1] + (1 - w) * hi
+            covers = False
+        self.previous = (lo, hi)
+        return (lo, hi), finite, covers
+
+
+def measure_range(Z, ranges=None):
+    """RangeEstimator.update of ranges, or the exact NaN-aware range without one"""
+    if ranges is not None:
+        return ranges.update(Z)
+    lo, hi, finite = finite_range(Z)
+    if not np.isfinite(lo):
+        return (0.0, 0.0), False, False
+    return (lo, hi), finite, finite
+
+
+def clamp_nonfinite(values, z_range):
+    """Replace NaN and -inf by z_min and inf by z_max in place, finite values stay as they are"""
+    return np.nan_to_num(values, copy=False, nan=z_range[0], posinf=z_range[1], neginf=z_range[0])
+
+
+def normalize_into(Z, out, z_range, finite=True, covers=True):
+    """Scale Z into [0, 1] in out, values outside the range end up at 0 or 1 and NaN at 0"""
+    z_min, z_max = z_range
+    if z_max == z_min:
+        out.fill(0)
+        return out
+    np.subtract(Z, z_min, out=out)
+    np.multiply(out, 1.0 / (z_max - z_min), out=out)
+    if not (finite and covers):
+        # values outside a clipped or smoothed range end up at 0 or 1, fmax turns NaN into 0
+        np.fmax(out, 0.0, out=out)
+        np.minimum(out, 1.0, out=out)
+    return out
@@ -0,0 +1,152 @@
+import threading
+from collections import deque
+
+from grid import FrameBuffers
+
+
+class FrameRequest:
+    def __init__(self, epoch, formula, params, grid_points, x_limits, y_limits, colormap=None, step=None,
+                 dtype='float64', surfaces=(), range_settings=(0.0, 0.0), cached=False):
+        """Snapshot of everything needed to compute one frame away from the GUI thread"""
+        self.epoch = epoch
+        self.formula = formula
+        self.params = params  # (a, b, c)
+        self.step = step  # simulation step index the parameters belong to
+        self.grid_points = grid_points
+        self.x_limits = x_limits
+        self.y_limits = y_limits
+        self.colormap = colormap  # ColormapLUT for per-vertex colors, None for gpu colormap mode
+        self.dtype = dtype  # precision of the grid and all per-frame buffers
+        self.surfaces = surfaces  # ((SurfaceLayer, (a, b, c)), ...) of the surfaces next to the main one
+        self.range_settings = range_settings  # (percentile, smoothing) of the color range
+        self.cached = cached  # parameters snapped to the steps of a period that fits the frame cache
+
+
+class ComputePipeline:
+    def __init__(self, compute, slots=3, ordered=False):
+        """Compute frames on a worker thread into a ring of reusable frame buffers
+
+        compute(request, frame) fills a FrameBuffers for a FrameRequest. The GUI
+        thread submits requests and takes finished frames. By default only the
+        newest request and the newest finished frame are kept, older ones are
+        dropped. With ordered=True every request is computed and handed out in
+        submission order, which is used to play every simulation step.
+        """
+        if slots < 2:
+            raise ValueError("The pipeline needs at least two frame buffers")
+        self.slots = slots
+        self.ordered = ordered
+        self._compute = compute
+        self._free = [FrameBuffers() for _ in range(slots)]
+        self._pending = deque()  # requests not started yet
+        self._ready = deque()  # finished frames not taken yet
+        self._epoch = 0
+        self._computing = False
+        self._running = True
+        self._cond = threading.Condition()
+        self.dropped = 0  # frames computed or requested but never shown
+
+        self._thread = threading.Thread(target=self._run, name="ComputePipeline", daemon=True)
+        self._thread.start()
+
+    @property
+    def epoch(self):
+        """Settings epoch, frames of older epochs are stale"""
+        return self._epoch
+
+    @property
+    def busy(self):
+        """True while a request is queued or computed, or a finished frame waits to be taken"""
+        with self._cond:
+            return bool(self._pending or self._ready or self._computing)
+
+    @property
+    def outstanding(self):
+        """Requests queued or computed and finished frames not taken yet"""
+        with self._cond:
+            return len(self._pending) + len(self._ready) + self._computing
+
+    def invalidate(self):
+        """Mark all queued and finished frames as stale, return the new epoch"""
+        with self._cond:
+            self._epoch += 1
+            self.dropped += len(self._pending) + len(self._ready)
+            self._pending.clear()
+            # behind the released frames, the worker takes the one drawn last first and may keep its Z
+            self._free[:0] = self._ready
+            self._ready.clear()
+            self._cond.notify_all()
+            return self._epoch
+
+    def set_ordered(self, ordered):
+        """Switch between newest-only and in-order delivery, dropping queued frames"""
+        if ordered != self.ordered:
+            self.ordered = ordered
+            self.invalidate()
+
+    def submit(self, request):
+        """Queue a request; unless ordered, it replaces one that has not been started yet"""
+        with self._cond:
+            if not self.ordered and self._pending:
+                self.dropped += len(self._pending)
+                self._pending.clear()
+            self._pending.append(request)
+            self._cond.notify_all()
+
+    def take(self):
+        """Return the next finished frame or None; hand it back with release()
+
+        Newest-only pipelines return the newest frame, ordered ones the oldest.
+        """
+        with self._cond:
+            return self._ready.popleft() if self._ready else None
+
+    def next_ready_step(self):
+        """Simulation step of the frame take() would return, None if nothing is ready"""
+        with self._cond:
+            return self._ready[0].step if self._ready else None
+
+    def release(self, frame):
+        """Give a frame taken with take() back to the ring once it is uploaded"""
+        with self._cond:
+            self._free.append(frame)
+            self._cond.notify_all()
+
+    def stop(self):
+        """Stop the worker thread"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        # wait for the frame in progress, a parallel Numba ufunc still running blocks the interpreter exit
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._pending or not self._free):
+                    self._cond.wait()
+                if not self._running:
+                    return
+                request = self._pending.popleft()
+                frame = self._free.pop()
+                self._computing = True
+
+            try:
+                self._compute(request, frame)
+                frame.epoch = request.epoch
+                frame.step = request.step
+            except Exception as e:
+                print(f"Error during compute pipeline: {e}")
+                frame.epoch = None
+
+            with self._cond:
+                self._computing = False
+                if frame.epoch != self._epoch:
+                    self._free.insert(0, frame)
+                    self.dropped += 1
+                    continue
+                if not self.ordered and self._ready:
+                    self._free[:0] = self._ready
+                    self.dropped += len(self._ready)
+                    self._ready.clear()
+                self._ready.append(frame)
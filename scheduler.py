@@ -0,0 +1,118 @@
+import numpy as np
+
+# indices of the timing modes in app_config.TIMING_MODES
+REAL_TIME = 0  # show the newest due step, skipping steps under load
+EVERY_STEP = 1  # show every step in order, the animation slows down under load
+CATCH_UP = 2  # show steps in order and run faster afterwards until back on time
+
+# scaling rules, indices match the scaling_rule_* combo boxes; index 3 is static
+SCALING_FUNCTIONS = (np.sin, np.cos, np.tan)
+SCALING_PERIODS = (2 * np.pi, 2 * np.pi, np.pi)
+STATIC = len(SCALING_FUNCTIONS)
+RULE_NAMES = ('sin', 'cos', 'tan', 'static')
+
+
+def period_steps(rule, speed, step):
+    """Simulation steps in one period of a scaling rule, rounded to a whole number; 0 if it does not change"""
+    if rule == STATIC or speed == 0:
+        return 0
+    return max(1, int(round(SCALING_PERIODS[rule] / (abs(speed) * step))))
+
+
+def cycle_steps(rules, step):
+    """Simulation steps after which all ((rule, speed), ...) rules snapped to step repeat; 0 if all are static"""
+    periods = [period_steps(rule, speed, step) for rule, speed in rules]
+    periods = [period for period in periods if period]
+    return int(np.lcm.reduce(periods)) if periods else 0
+
+
+def scaling_value(rule, speed, time, step=None):
+    """Value of one scaling rule at time (scalar or array)
+
+    With step the phase is snapped to the simulation steps, a period is
+    stretched to a whole number of steps so the values repeat exactly
+    from one period to the next.
+    """
+    if rule != STATIC:
+        phase = time * speed
+        steps = period_steps(rule, speed, step) if step else 0
+        if steps:
+            phase = np.round(time / step) % steps * (SCALING_PERIODS[rule] / steps) * np.sign(speed)
+        return SCALING_FUNCTIONS[rule](phase)
+    return np.ones_like(time) if np.ndim(time) else 1
+
+
+def parameters_at(rules, time, step=None):
+    """(a, b, c) for ((rule, speed), ...) rules at time (scalar or array)"""
+    return tuple(scaling_value(rule, speed, time, step) for rule, speed in rules)
+
+
+class SimulationClock:
+    def __init__(self, step=1 / 60, mode=REAL_TIME, catch_up_rate=4):
+        """Fixed-step simulation time decoupled from the render clock
+
+        The render loop calls tick() with the real time that passed and asks
+        next_step() which simulation step to show; mark_shown() records it.
+        While catch-up mode runs behind, each shown frame advances up to
+        catch_up_rate steps, so the lag shrinks even when frames are shown
+        no faster than the simulation steps.
+        """
+        self.step = step
+        self.mode = mode
+        self.catch_up_rate = catch_up_rate
+        self.wall_time = 0.0  # where the simulation would be if it were on time
+        self.target_time = 0.0  # simulation time that should be on screen now
+        self.shown_step = 0
+
+    @property
+    def sim_time(self):
+        """Simulation time of the step on screen"""
+        return self.shown_step * self.step
+
+    @property
+    def lag(self):
+        """How far the simulation runs behind the wall clock, in seconds"""
+        return max(0.0, self.wall_time - self.sim_time)
+
+    def step_time(self, step):
+        """Simulation time of a step"""
+        return step * self.step
+
+    def set_mode(self, mode):
+        """Change the timing mode, continuing on time from the step on screen"""
+        self.mode = mode
+        self.wall_time = self.target_time = self.sim_time
+
+    def tick(self, dt):
+        """Advance the wall clock by dt seconds"""
+        if dt is None or dt <= 0:
+            return
+        self.wall_time += dt
+        if self.mode == EVERY_STEP:
+            # never build up a backlog: at most one step ahead of the screen
+            self.target_time = min(self.target_time + dt, self.sim_time + self.step)
+        else:
+            self.target_time = self.wall_time
+
+    def due_step(self):
+        """Newest step whose time has come"""
+        return int(self.target_time / self.step + 1e-9)
+
+    def next_step(self):
+        """Step to show now, or None if the screen is up to date"""
+        due = self.due_step()
+        if due <= self.shown_step:
+            return None
+        if self.mode == REAL_TIME:
+            return due
+        return self.step_after(self.shown_step)
+
+    def step_after(self, step):
+        """Step that follows step in the in-order modes, catch-up skips ahead while behind the due step"""
+        if self.mode == CATCH_UP:
+            return step + int(min(self.catch_up_rate, max(1, self.due_step() - step)))
+        return step + 1
+
+    def mark_shown(self, step):
+        """Record the step that is on screen"""
+        self.shown_step = step
@@ -0,0 +1,283 @@
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from vispy.gloo import IndexBuffer, Texture2D, VertexBuffer
+from vispy.scene.visuals import create_visual_node
+from vispy.visuals import Visual
+from vispy.visuals.shaders import Function
+
+# positions come from the grid indices of a vertex and the two axes, the index streams stay on the
+# GPU per grid size, only z, the slopes and colors are streamed. $layer is (x, y, z offset, index)
+# of the surface a vertex belongs to when several surfaces share one draw call
+VERTEX_SHADER = """
+varying vec4 v_color;
+varying float v_value;
+varying vec3 v_normal;
+varying float v_layer;
+
+void main() {
+    v_color = $color;
+    v_value = $z;
+    v_layer = $layer.w;
+
+    // Unnormalized normal (-dz/dx, -dz/dy, 1) in scene coordinates for lighting
+    vec4 normal_scene = $visual2scene(vec4($slope, 1.0, 1.0));
+    vec4 origin_scene = $visual2scene(vec4(0.0, 0.0, 0.0, 1.0));
+    v_normal = normal_scene.xyz / normal_scene.w - origin_scene.xyz / origin_scene.w;
+
+    gl_Position = $transform(vec4($origin + $ij * $spacing + $layer.xy, $z + $layer.z, 1.0));
+}
+"""
+
+FRAGMENT_SHADER = """
+varying vec4 v_color;
+varying float v_value;
+varying vec3 v_normal;
+varying float v_layer;
+
+void main() {
+    vec4 color = $base_color(v_color, v_value, v_layer);
+
+    // Light both sides of the surface
+    vec3 normal = normalize(gl_FrontFacing ? v_normal : -v_normal);
+    float diffuse = max(dot(-normalize($light_dir), normal), 0.0);
+    gl_FragColor = vec4(color.rgb * ($ambient + $diffuse * diffuse), color.a);
+}
+"""
+
+# 'cpu' mode: colors are computed on the CPU and streamed per vertex
+VERTEX_COLOR = """
+vec4 vertex_color(vec4 color, float value, float layer) {
+    return color;
+}
+"""
+
+# 'gpu' mode: z is normalized with the (z_min, z_scale) of its surface and looked up in the colormap
+# row of its surface, one texel and one row per surface
+TEXTURE_COLOR = """
+vec4 texture_color(vec4 color, float value, float layer) {
+    float row = (layer + 0.5) * $row_scale;
+    vec4 range = texture2D($ranges, vec2(row, 0.5));
+    float t = clamp((value - range.x) * range.y, 0.0, 1.0);
+    // sample texel centers so that 0 and 1 hit the first and last entry
+    return texture2D($lut, vec2(t * $lut_scale + $lut_offset, row));
+}
+"""
+
+COLORMAP_MODES = ('gpu', 'cpu')
+
+
+# grid sizes whose index streams are kept on the GPU, switching between them uploads nothing
+MESH_CACHE_SIZES = 4
+
+
+@lru_cache(maxsize=1)
+def grid_strip(rows, cols, layers=1):
+    """uint32 triangle strip over a rows x cols vertex grid, about 2 indices per vertex instead of 6
+
+    Each pair of rows is one zigzag strip, consecutive strips are joined by
+    repeating the last vertex of one and the first of the next. The join
+    adds an even number of indices, so the winding stays the same. Layers
+    are stacked copies of the grid, their strips are joined the same way.
+    """
+    row = np.arange(rows - 1, dtype=np.uint32)[:, None] * cols
+    strip = np.empty((rows - 1, 2 * cols + 2), dtype=np.uint32)
+    strip[:, 0:2 * cols:2] = row + np.arange(cols, dtype=np.uint32)
+    strip[:, 1:2 * cols:2] = strip[:, 0:2 * cols:2] + cols
+    strip[:, -2] = strip[:, 2 * cols - 1]
+    strip[:, -1] = row[:, 0] + cols
+    strip = strip.ravel()[:-2]
+    if layers > 1:
+        size = rows * cols
+        parts = [strip]
+        for layer in range(1, layers):
+            parts.append(np.array([strip[-1] + (layer - 1) * size, strip[0] + layer * size], dtype=np.uint32))
+            parts.append(strip + np.uint32(layer * size))
+        strip = np.concatenate(parts)
+    strip.setflags(write=False)
+    return strip
+
+
+def grid_indices(rows, cols):
+    """(column, row) of every vertex as float32, exact up to 2**24"""
+    ij = np.empty((rows, cols, 2), dtype=np.float32)
+    ij[..., 0] = np.arange(cols, dtype=np.float32)
+    ij[..., 1] = np.arange(rows, dtype=np.float32)[:, None]
+    return ij.reshape(-1, 2)
+
+
+class GridSurfaceVisual(Visual):
+    def __init__(self, x, y, colormap_mode='gpu', colormap=None, light_dir=(10, 5, -5), ambient=0.25, diffuse=0.7):
+        """Surface over a regular grid that only streams z, slopes and colors per frame
+
+        x and y are only kept as origin and spacing, vertex positions are
+        built in the vertex shader from the grid indices of the vertex. The
+        index streams are cached on the GPU per grid size. colormap_mode 'gpu'
+        streams z alone and colors it in the fragment shader from the
+        colormap lookup table, 'cpu' streams one RGBA color per vertex.
+        Several surfaces over the same grid can be drawn as layers of one
+        draw call, each with its own offset, Z range and colormap.
+        """
+        if colormap_mode not in COLORMAP_MODES:
+            raise ValueError(f"Unknown colormap mode {colormap_mode!r}, use one of {COLORMAP_MODES}")
+        Visual.__init__(self, vcode=VERTEX_SHADER, fcode=FRAGMENT_SHADER)
+        # grid_strip winds clockwise seen from +z, the two-sided lighting relies on gl_FrontFacing
+        self.set_gl_state('translucent', depth_test=True, cull_face=False, front_face='cw')
+        self.colormap_mode = colormap_mode
+
+        self._meshes = OrderedDict()  # (rows, cols, layers): (grid index VertexBuffer, strip IndexBuffer)
+        self._offsets = [(0.0, 0.0, 0.0)]  # (x, y, z) offset of every layer
+        self._layers = VertexBuffer(np.zeros((0, 4), dtype=np.float32))  # $layer of every vertex
+        # irregular mesh of lattice points, e.g. adaptive, streamed whenever it changes
+        self._mesh_ij = VertexBuffer(np.zeros((0, 2), dtype=np.float32))
+        self._mesh_faces = IndexBuffer(np.zeros(0, dtype=np.uint32))
+        self._z = VertexBuffer(np.zeros(0, dtype=np.float32))
+        self._slopes = VertexBuffer(np.zeros((0, 2), dtype=np.float32))
+        self._colors = VertexBuffer(np.zeros((0, 4), dtype=np.float32))
+        self.shared_program.vert['z'] = self._z
+        self.shared_program.vert['slope'] = self._slopes
+        if colormap_mode == 'gpu':
+            self.shared_program.vert['color'] = (1.0, 1.0, 1.0, 1.0)
+            self._base_color = Function(TEXTURE_COLOR)
+            self._lut = Texture2D(np.zeros((1, 2, 4), dtype=np.uint8), interpolation='linear', wrapping='clamp_to_edge')
+            self._tables = [np.zeros((2, 4), dtype=np.uint8)]  # colormap of every layer as uint8 RGBA
+            # (z_min, z_scale) of every layer, float texels keep the range exact
+            self._ranges = Texture2D(np.zeros((1, 1, 4), dtype=np.float32), internalformat='rgba32f',
+                                     interpolation='nearest', wrapping='clamp_to_edge')
+            self._base_color['lut'] = self._lut
+            self._base_color['ranges'] = self._ranges
+            self._base_color['row_scale'] = 1.0
+            self._base_color['lut_scale'] = 1.0
+            self._base_color['lut_offset'] = 0.0
+            if colormap is not None:
+                self.set_colormap(colormap)
+        else:
+            self.shared_program.vert['color'] = self._colors
+            self._base_color = Function(VERTEX_COLOR)
+        self.shared_program.frag['base_color'] = self._base_color
+        self.shared_program.frag['light_dir'] = tuple(float(v) for v in light_dir)
+        self.shared_program.frag['ambient'] = float(ambient)
+        self.shared_program.frag['diffuse'] = float(diffuse)
+
+        self._bounds = None
+        self._draw_mode = 'triangle_strip'
+        self.drawn = False  # True once the last set_data has been drawn and flushed
+        self.set_grid(x, y)
+        self.freeze()
+
+    def set_grid(self, x, y, offsets=None):
+        """Switch to the regular grid of the 1-D axes x and y
+
+        Other limits only change two uniforms, a grid size seen recently
+        reuses its index streams already on the GPU. offsets holds one
+        (x, y, z) offset per layer, None draws a single surface.
+        """
+        offsets = [tuple(float(v) for v in offset) for offset in offsets] if offsets else [(0.0, 0.0, 0.0)]
+        rows, cols, layers = len(y), len(x), len(offsets)
+        mesh = self._meshes.pop((rows, cols, layers), None)
+        if mesh is None:
+            ij = grid_indices(rows, cols)
+            mesh = VertexBuffer(np.tile(ij, (layers, 1)) if layers > 1 else ij), IndexBuffer(grid_strip(rows, cols, layers))
+        self._meshes[(rows, cols, layers)] = mesh
+        while len(self._meshes) > MESH_CACHE_SIZES:
+            self._meshes.popitem(last=False)
+        self.shared_program.vert['ij'], self._index_buffer = mesh
+        self._draw_mode = 'triangle_strip'
+        self._set_layers(offsets, rows * cols)
+
+        x0, x1, y0, y1 = float(x[0]), float(x[-1]), float(y[0]), float(y[-1])
+        self.shared_program.vert['origin'] = (x0, y0)
+        self.shared_program.vert['spacing'] = ((x1 - x0) / max(cols - 1, 1), (y1 - y0) / max(rows - 1, 1))
+        dx = [offset[0] for offset in offsets]
+        dy = [offset[1] for offset in offsets]
+        self._bounds = [(min(x0, x1) + min(dx), max(x0, x1) + max(dx)),
+                        (min(y0, y1) + min(dy), max(y0, y1) + max(dy)), (0.0, 0.0)]
+        self.update()
+
+    def _set_layers(self, offsets, vertices):
+        """Offsets of the layers of vertices each, new layers start with the colormap of the first"""
+        layers = len(offsets)
+        if layers > 1:
+            values = np.empty((layers, 4), dtype=np.float32)
+            values[:, :3] = offsets
+            values[:, 3] = np.arange(layers)
+            self._layers.set_data(np.repeat(values, vertices, axis=0))
+            self.shared_program.vert['layer'] = self._layers
+        else:
+            self.shared_program.vert['layer'] = offsets[0] + (0.0,)
+        if self.colormap_mode == 'gpu' and layers != len(self._offsets):
+            self._tables = (self._tables + [self._tables[0]] * layers)[:layers]
+            self._lut.set_data(np.stack(self._tables))
+            self._ranges.set_data(np.zeros((1, layers, 4), dtype=np.float32))
+            self._base_color['row_scale'] = 1.0 / layers
+        self._offsets = offsets
+
+    def set_mesh(self, ij, faces, origin, spacing, size):
+        """Switch to triangles faces (T, 3) between lattice points ij (V, 2), float32 (column, row)
+
+        The lattice starts at origin and is size steps of spacing along each
+        axis. The triangles wind clockwise like the grid strips.
+        """
+        self._mesh_ij.set_data(ij)
+        self._mesh_faces.set_data(np.ascontiguousarray(faces, dtype=np.uint32).ravel())
+        self.shared_program.vert['ij'], self._index_buffer = self._mesh_ij, self._mesh_faces
+        self.shared_program.vert['layer'] = (0.0, 0.0, 0.0, 0.0)  # the mesh draws the first surface alone
+        self._draw_mode = 'triangles'
+
+        (x0, y0), (dx, dy) = origin, spacing
+        self.shared_program.vert['origin'] = (float(x0), float(y0))
+        self.shared_program.vert['spacing'] = (float(dx), float(dy))
+        x1, y1 = x0 + size * dx, y0 + size * dy
+        self._bounds = [(min(x0, x1), max(x0, x1)), (min(y0, y1), max(y0, y1)), (0.0, 0.0)]
+        self.update()
+
+    def set_colormap(self, table, layer=0):
+        """Swap the colormap of a layer, table is an (N, 4) RGBA lookup table in [0, 1]"""
+        table = np.asarray(table)
+        self._tables[layer] = np.round(table * 255).astype(np.uint8)
+        self._lut.set_data(np.stack(self._tables))
+        self._base_color['lut_scale'] = (len(table) - 1) / len(table)
+        self._base_color['lut_offset'] = 0.5 / len(table)
+        self.update()
+
+    def set_data(self, z, slopes, colors=None, z_range=None):
+        """Stream one frame: z (V,), slopes (V, 2) and colors (V, 4) per vertex, all float32
+
+        slopes are (-dz/dx, -dz/dy), the normal is (-dz/dx, -dz/dy, 1). In 'gpu'
+        mode colors are ignored and z_range sets the normalization bounds,
+        a list of them for layers.
+        """
+        self._z.set_data(z)
+        self._slopes.set_data(slopes)
+        if self.colormap_mode == 'cpu':
+            self._colors.set_data(colors)
+        if z_range is not None:
+            ranges = [z_range] if np.ndim(z_range[0]) == 0 else z_range
+            texels = np.zeros((1, len(self._offsets), 4), dtype=np.float32)
+            for layer, (z_min, z_max) in enumerate(ranges):
+                z_min, z_max = float(z_min), float(z_max)
+                texels[0, layer, :2] = z_min, 1.0 / (z_max - z_min) if z_max != z_min else 0.0
+            dz = [offset[2] for offset in self._offsets[:len(ranges)]]
+            self._bounds[2] = (min(float(r[0]) + d for r, d in zip(ranges, dz)),
+                               max(float(r[1]) + d for r, d in zip(ranges, dz)))
+            if self.colormap_mode == 'gpu':
+                self._ranges.set_data(texels)
+        self.drawn = False
+        self.update()
+
+    def _prepare_transforms(self, view):
+        view.view_program.vert['transform'] = view.transforms.get_transform()
+        view.view_program.vert['visual2scene'] = view.transforms.get_transform('visual', 'scene')
+
+    def _prepare_draw(self, view):
+        self.drawn = True
+        return True
+
+    def _compute_bounds(self, axis, view):
+        if self._bounds is None or axis > 2:
+            return None
+        return self._bounds[axis]
+
+
+GridSurface = create_visual_node(GridSurfaceVisual)
@@ -0,0 +1,182 @@
+import ast
+
+import numpy as np
+
+EVEN, ODD = 1, -1
+
+# f(-u) = f(u) and f(-u) = -f(u) for the allowed np functions of one argument
+EVEN_FUNCTIONS = frozenset(('cos', 'cosh', 'abs'))
+ODD_FUNCTIONS = frozenset(('sin', 'tan', 'sinh', 'tanh', 'arcsin', 'arctan', 'arcsinh', 'arctanh'))
+
+
+class Symmetry:
+    def __init__(self, x=None, y=None, swap=False):
+        """Symmetries of a formula, found on its syntax tree
+
+        x is EVEN if Z(-X, Y) = Z(X, Y), ODD if Z(-X, Y) = -Z(X, Y) and None
+        otherwise, y the same for Y. swap means Z(Y, X) = Z(X, Y).
+        """
+        self.x = x
+        self.y = y
+        self.swap = swap
+
+    def __bool__(self):
+        return self.x is not None or self.y is not None or self.swap
+
+    def __repr__(self):
+        names = {EVEN: 'even', ODD: 'odd', None: None}
+        return f"Symmetry(x={names[self.x]}, y={names[self.y]}, swap={self.swap})"
+
+
+def parity(node, name):
+    """EVEN or ODD if node keeps or flips its sign when the variable name is negated, None if unknown"""
+    if isinstance(node, ast.Expression):
+        return parity(node.body, name)
+    if isinstance(node, ast.Name):
+        return ODD if node.id == name else EVEN
+    if isinstance(node, (ast.Constant, ast.Attribute)):
+        return EVEN
+    if isinstance(node, ast.UnaryOp):
+        return parity(node.operand, name)
+    if isinstance(node, ast.BinOp):
+        left, right = parity(node.left, name), parity(node.right, name)
+        if left is None or right is None:
+            return None
+        if isinstance(node.op, (ast.Add, ast.Sub)):
+            return left if left == right else None
+        if isinstance(node.op, (ast.Mult, ast.Div)):
+            return left * right
+        if isinstance(node.op, ast.Pow) and right == EVEN:
+            exponent = node.right.operand if isinstance(node.right, ast.UnaryOp) else node.right
+            if left == ODD and isinstance(exponent, ast.Constant) and float(exponent.value).is_integer():
+                return EVEN if int(exponent.value) % 2 == 0 else ODD
+        # any function of even arguments is even
+        return EVEN if left == right == EVEN else None
+    if isinstance(node, ast.Call):
+        args = [parity(arg, name) for arg in node.args]
+        if all(arg == EVEN for arg in args):
+            return EVEN
+        if len(args) == 1 and args[0] == ODD:
+            if node.func.attr in EVEN_FUNCTIONS:
+                return EVEN
+            if node.func.attr in ODD_FUNCTIONS:
+                return ODD
+    return None
+
+
+def _operands(node, op):
+    """Operands of a chain of the same commutative operator"""
+    if isinstance(node, ast.BinOp) and isinstance(node.op, op):
+        return _operands(node.left, op) + _operands(node.right, op)
+    return [node]
+
+
+def canonical(node, names=None):
+    """Text of node with sums and products sorted, and variables renamed by names"""
+    names = names or {}
+    if isinstance(node, ast.Expression):
+        return canonical(node.body, names)
+    if isinstance(node, ast.Name):
+        return names.get(node.id, node.id)
+    if isinstance(node, ast.Constant):
+        return repr(node.value)
+    if isinstance(node, ast.Attribute):
+        return f"np.{node.attr}"
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Mult)):
+        operands = sorted(canonical(operand, names) for operand in _operands(node, type(node.op)))
+        return f"{type(node.op).__name__}({', '.join(operands)})"
+    parts = [canonical(child, names) for child in ast.iter_child_nodes(node) if isinstance(child, ast.expr)]
+    op = type(node.op).__name__ if hasattr(node, 'op') else type(node).__name__
+    return f"{op}({', '.join(parts)})"
+
+
+def analyze(tree):
+    """Symmetry of a parsed formula"""
+    x, y = parity(tree, 'X'), parity(tree, 'Y')
+    swap = canonical(tree) == canonical(tree, {'X': 'Y', 'Y': 'X'})
+    if swap:
+        # Z(X, -Y) = Z(-Y, X) = ±Z(Y, X) = ±Z(X, Y), one parity gives the other
+        x = y if x is None else x
+        y = x if y is None else y
+    return Symmetry(x, y, swap)
+
+
+class MirrorPlan:
+    def __init__(self, n, symmetry):
+        """Blocks of an n x n grid to evaluate and how to fill the rest from them
+
+        X parity keeps the columns from n // 2 on, Y parity the rows, so the
+        middle row and column of an odd n are evaluated. Swap symmetry splits
+        the remaining square into four blocks and fills the lower left one
+        with the transpose of the upper right one.
+        """
+        self.n = n
+        self.symmetry = symmetry
+        h = n // 2
+        self.row0 = h if symmetry.y is not None else 0
+        self.col0 = h if symmetry.x is not None else 0
+        self.swap = symmetry.swap and self.row0 == self.col0 and n - self.row0 >= 2
+        if self.swap:
+            start = self.row0
+            self.mid = start + (n - start) // 2
+            self.regions = [((start, self.mid), (start, self.mid)), ((start, self.mid), (self.mid, n)),
+                            ((self.mid, n), (self.mid, n))]
+        else:
+            self.regions = [((self.row0, n), (self.col0, n))]
+
+    @property
+    def fraction(self):
+        """Share of the grid points that are evaluated"""
+        return sum((r1 - r0) * (c1 - c0) for (r0, r1), (c0, c1) in self.regions) / self.n ** 2
+
+    def fill(self, out):
+        """Fill everything outside the evaluated blocks of out (..., n, n), one strided copy per step"""
+        n, start = self.n, self.row0
+        if self.swap:
+            np.copyto(out[..., self.mid:, start:self.mid],
+                      np.swapaxes(out[..., start:self.mid, self.mid:], -1, -2))
+        if self.col0:
+            _mirror(out[..., self.row0:, n - 1:n - 1 - self.col0:-1], out[..., self.row0:, :self.col0],
+                    self.symmetry.x)
+        if self.row0:
+            _mirror(out[..., n - 1:n - 1 - self.row0:-1, :], out[..., :self.row0, :], self.symmetry.y)
+        return out
+
+
+def _mirror(source, target, sign):
+    if sign == ODD:
+        np.negative(source, out=target)
+    else:
+        np.copyto(target, source)
+
+
+def mirror_plan(symmetry, grid):
+    """MirrorPlan of a formula's symmetry on grid, None if nothing can be mirrored
+
+    Parity needs limits symmetric around zero, swap also equal X and Y axes.
+    """
+    if not symmetry or grid.parent is not None:
+        return None
+    x, y = grid.x, grid.y
+    symmetric_x = x[0] == -x[-1]
+    symmetric_y = y[0] == -y[-1]
+    used = Symmetry(symmetry.x if symmetric_x else None, symmetry.y if symmetric_y else None,
+                    symmetry.swap and np.array_equal(x, y))
+    if not used:
+        return None
+    plan = MirrorPlan(len(x), used)
+    return plan if plan.fraction < 1 else None
+
+
+def evaluate_mirrored(evaluate, formula, grid, params, out):
+    """evaluate(formula, grid, params, out) on the fundamental region of a symmetric formula only
+
+    The other blocks are filled by mirroring, formulas without a usable
+    symmetry are evaluated on the whole grid. out may have leading axes.
+    """
+    plan = mirror_plan(formula.symmetry, grid)
+    if plan is None:
+        return evaluate(formula, grid, params, out)
+    for rows, cols in plan.regions:
+        evaluate(formula, grid.region(rows, cols), params, out[..., rows[0]:rows[1], cols[0]:cols[1]])
+    return plan.fill(out)
@@ -0,0 +1,33 @@
+import time
+
+import numpy as np
+import pytest
+
+from evaluation import BackendSelector, NumbaBackend, TiledEvaluator
+from expression import compile_formula
+from grid import GridBuffers
+
+
+def test_auto_mode_times_numba_only_once_it_is_compiled():
+    pytest.importorskip("numba")
+    numba_backend = NumbaBackend()
+    selector = BackendSelector([TiledEvaluator(), numba_backend], "auto", trial_frames=1)
+    formula = compile_formula("np.sin(X * a) + np.cos(Y * b) + c")
+    grid = GridBuffers()
+    grid.ensure(16, (-1, 1), (-1, 1))
+    out = np.empty_like(grid.X)
+
+    # the frames go on with NumPy while Numba compiles
+    start = time.perf_counter()
+    for _ in range(3):
+        selector.evaluate(formula, grid, (1.0, 2.0, 0.5), out)
+        assert selector.last[0] == "numpy"
+    assert time.perf_counter() - start < 0.3
+
+    deadline = time.perf_counter() + 30
+    while not numba_backend.ready(formula) and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    for _ in range(3):
+        selector.evaluate(formula, grid, (1.0, 2.0, 0.5), out)
+    assert any(name == "numba" for _, _, name in selector.costs)
+    np.testing.assert_allclose(out, np.sin(grid.X) + np.cos(grid.Y * 2) + 0.5)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from expression import FormulaError, compile_formula, validate_formula
+
+
+@pytest.mark.parametrize("text", ["np.sin(X, Y) + a + b + c", "np.abs(X, X) + Y + a + b + c",
+                                  "np.sin() + X + Y + a + b + c", "np.arctan2(X) + Y + a + b + c",
+                                  "np.arctan2(X, Y, X) + a + b + c", "np.pi() + X + Y + a + b + c"])
+def test_wrong_number_of_arguments_is_rejected(text):
+    with pytest.raises(FormulaError):
+        compile_formula(text)
+    assert not validate_formula(text)[0]
+
+
+def test_rejected_output_argument_leaves_the_grid_alone():
+    X, Y = np.meshgrid(np.linspace(-1, 1, 5), np.linspace(-2, 2, 5))
+    expected = Y.copy()
+    assert not validate_formula("np.sin(X, Y) + a + b + c")[0]
+    np.testing.assert_array_equal(Y, expected)
+
+
+@pytest.mark.parametrize("text", ["a * np.log(0.5) ** 2 + X + Y + b + c",
+                                  "np.sin(-2) ** 2 * a + X + Y + b + c",
+                                  "a ** np.cos(np.pi) + np.log(0.25) ** 3 * X + Y + b + c",
+                                  "-np.arctan2(-1, 1) ** 2 + a * X + Y * b + c"])
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_folded_negative_constants_match_plain_eval(text, dtype):
+    X, Y = np.meshgrid(np.linspace(-1, 1, 7, dtype=dtype), np.linspace(-2, 2, 7, dtype=dtype))
+    a, b, c = 1.5, 0.5, -0.25
+    expected = eval(text, {'np': np, 'X': X.astype(np.float64), 'Y': Y.astype(np.float64), 'a': a, 'b': b, 'c': c})
+    result = compile_formula(text).evaluate(X, Y, a, b, c)
+    np.testing.assert_allclose(result, expected, rtol=1e-5 if dtype == "float32" else 1e-12)
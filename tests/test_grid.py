@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from grid import FrameBuffers, GridBuffers
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_clamping_marks_z_as_no_longer_raw(dtype):
+    grid = GridBuffers()
+    grid.ensure(8, (-1, 1), (-1, 1), dtype)
+    frame = FrameBuffers()
+    frame.ensure(grid)
+    frame.store_z(grid.X + grid.Y)
+    frame.update_range()
+    assert not frame.clamped
+
+    Z = grid.X + grid.Y
+    Z[0, 0], Z[1, 1] = np.nan, np.inf
+    frame.store_z(Z)
+    lo, hi = frame.update_range()
+    assert frame.clamped
+    assert np.all(np.isfinite(frame.z_upload))
+    assert frame.Z[0, 0] == lo and frame.Z[1, 1] == hi
+
+    frame.store_z(grid.X + grid.Y)
+    assert not frame.clamped
@@ -0,0 +1,33 @@
+import time
+
+from pipeline import ComputePipeline, FrameRequest
+
+
+def request(epoch, step):
+    return FrameRequest(epoch, None, (1.0, 1.0, 1.0), 8, (-1, 1), (-1, 1), step=step)
+
+
+def wait_ready(pipeline, step, timeout=2.0):
+    deadline = time.perf_counter() + timeout
+    while pipeline.next_ready_step() != step:
+        assert time.perf_counter() < deadline, "the pipeline did not finish"
+        time.sleep(0.005)
+
+
+def test_worker_reuses_the_frame_on_screen_after_invalidate():
+    computed = []
+    pipeline = ComputePipeline(lambda request, frame: computed.append(frame), slots=3)
+    try:
+        pipeline.submit(request(pipeline.epoch, 0))
+        wait_ready(pipeline, 0)
+        shown = pipeline.take()
+        pipeline.submit(request(pipeline.epoch, 1))
+        wait_ready(pipeline, 1)
+
+        # the shown frame comes back while another one waits to be taken
+        pipeline.release(shown)
+        pipeline.submit(request(pipeline.invalidate(), 2))
+        wait_ready(pipeline, 2)
+        assert computed[-1] is shown
+    finally:
+        pipeline.stop()
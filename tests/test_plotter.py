@@ -0,0 +1,66 @@
+import os
+import time
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PyQt6")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import app_config
+
+
+@pytest.fixture
+def window(monkeypatch):
+    from PyQt6.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    monkeypatch.setattr(app_config, "TRIAL_TIMEOUT", 0)
+    monkeypatch.setattr(app_config, "BACKGROUND_COMPUTE", True)
+    monkeypatch.setattr(app_config, "IDLE_SUSPEND", True)
+    from app_ui import FunctionPlotterUI
+    window = FunctionPlotterUI()
+    yield window
+    window.plotter.stop()
+    window.close()
+    app.processEvents()
+
+
+def set_static_rules(plotter):
+    static = plotter.props.scaling_rule_a.count() - 1
+    for combo in (plotter.props.scaling_rule_a, plotter.props.scaling_rule_b, plotter.props.scaling_rule_c):
+        combo.setCurrentIndex(static)
+
+
+def run_until_idle(plotter, timeout=10):
+    """Call update() like the timer does, with every upload drawn, until the plotter suspends"""
+    event = types.SimpleNamespace(dt=1 / 60)
+    deadline = time.perf_counter() + timeout
+    while not plotter.idle and time.perf_counter() < deadline:
+        plotter.update(event)
+        plotter.surface.drawn = True
+        time.sleep(0.01)
+
+
+def test_static_rules_suspend_the_timer(window):
+    plotter = window.plotter
+    set_static_rules(plotter)
+    assert not plotter.is_animating()
+
+    run_until_idle(plotter)
+    assert plotter.idle
+    assert not plotter.timer.running
+    assert not plotter.pipeline.busy
+
+
+def test_frames_leave_no_grid_sized_allocations(window):
+    plotter = window.plotter
+    set_static_rules(plotter)
+    plotter.update_grid_points(200)
+    # an idle pipeline allocates nothing while the frames are counted
+    run_until_idle(plotter)
+    assert plotter.idle
+    net, peak = plotter.measure_frame_allocations(5)
+    z_bytes = 200 * 200 * np.dtype(plotter.precision).itemsize
+    assert net < z_bytes / 4
+    assert peak < 2 * z_bytes
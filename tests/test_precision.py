@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import app_config
+from colormap import ColormapLUT
+from evaluation import TiledEvaluator
+from expression import compile_formula
+from grid import FrameBuffers, GridBuffers
+
+PARAMS = (0.5, 0.7, 0.3)
+
+
+def float_arrays(owner, names):
+    """(name, dtype) of the floating point arrays among the attributes of owner"""
+    for name in names:
+        value = getattr(owner, name)
+        if isinstance(value, np.ndarray) and value.dtype.kind == 'f':
+            yield name, value.dtype
+
+
+@pytest.fixture(scope="module")
+def evaluator():
+    evaluator = TiledEvaluator(None, app_config.TILE_POINTS, min_points=0)
+    yield evaluator
+    evaluator.shutdown()
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("text", [app_config.START_FUNCTION] + app_config.EXAMPLE_FUNCTIONS)
+def test_float32_hot_path_stays_float32(text, evaluator):
+    formula = compile_formula(text)
+    # only formulas with large powers compute some terms in float64, their Z buffer stays float32
+    upcast = 'np.float64' in formula.frame_source or any('np.float64' in key for key in formula.frame_keys)
+    grid = GridBuffers()
+    grid.ensure(64, (-2, 2), (-2, 2), 'float32')
+    frame = FrameBuffers()
+    frame.ensure(grid)
+
+    evaluator.evaluate(formula, grid, tuple(np.float64(value) for value in PARAMS), frame.Z)
+    frame.store_z()
+    ColormapLUT(app_config.DEFAULT_CMAP).map(frame.normalize(), frame.color_index, frame.colors)
+    frame.compute_normals()
+
+    arrays = list(float_arrays(grid, ('x', 'y', 'X', 'Y')))
+    arrays += list(float_arrays(frame, ('Z', 'norm_Z', 'colors', 'z_upload', 'normals')))
+    if not upcast:
+        arrays += [(f"invariant {key}", value.dtype) for key, value in grid.invariants.items()]
+        a, b, c = (grid.dtype.type(value) for value in PARAMS)
+        arrays.append(("formula result", np.result_type(formula.evaluate(grid.X, grid.Y, a, b, c, grid.invariants))))
+    assert [name for name, dtype in arrays if dtype != np.float32] == []
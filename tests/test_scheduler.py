@@ -0,0 +1,55 @@
+import numpy as np
+
+from scheduler import CATCH_UP, EVERY_STEP, SimulationClock, cycle_steps, parameters_at
+
+STEP = 1 / 60
+
+
+def run_behind(mode, lag=1.0, seconds=5.0):
+    """Lag of a clock that fell lag seconds behind and then shows one step per tick at the step rate"""
+    clock = SimulationClock(STEP, mode, catch_up_rate=4)
+    clock.tick(lag)
+    lags = [clock.lag]
+    for _ in range(int(seconds / STEP)):
+        clock.tick(STEP)
+        step = clock.next_step()
+        if step is not None:
+            clock.mark_shown(step)
+        lags.append(clock.lag)
+    return lags
+
+
+def test_catch_up_shrinks_the_lag():
+    lags = run_behind(CATCH_UP)
+    assert lags[60] < lags[0]
+    assert lags[-1] < STEP
+
+
+def test_catch_up_shows_steps_in_order():
+    clock = SimulationClock(STEP, CATCH_UP, catch_up_rate=4)
+    clock.tick(1.0)
+    shown = []
+    for _ in range(30):
+        clock.tick(STEP)
+        step = clock.next_step()
+        clock.mark_shown(step)
+        shown.append(step)
+    assert all(0 < later - earlier <= 4 for earlier, later in zip(shown, shown[1:]))
+
+
+def test_every_step_does_not_build_a_backlog():
+    clock = SimulationClock(STEP, EVERY_STEP)
+    clock.tick(1.0)
+    assert clock.next_step() == 1
+
+
+def test_snapped_phases_repeat_every_period_without_repeating_steps():
+    rules = ((0, 0.1), (1, 1.0), (3, 1.0))
+    period = cycle_steps(rules, STEP)
+    steps = np.arange(2 * period)
+    a, b, c = parameters_at(rules, steps * STEP, STEP)
+    np.testing.assert_array_equal(a[:period], a[period:])
+    np.testing.assert_array_equal(b[:period], b[period:])
+    # at a slow speed every step still moves a on, the snapping does not hold values
+    assert np.all(np.diff(a[:period // 4]) > 0)
+    np.testing.assert_allclose(a, np.sin(steps * STEP * 0.1), atol=2e-3)
@@ -0,0 +1,163 @@
+import multiprocessing
+import time
+import warnings
+
+import numpy as np
+
+
+class TrialReport:
+    def __init__(self, grid_points):
+        """What evaluating a formula on small sample grids predicts for the full grid"""
+        self.grid_points = grid_points
+        self.seconds = {}  # backend name: estimated seconds per frame on the full grid, one thread
+        self.peak_bytes = 0  # estimated peak allocation of the first frame on the full grid
+        self.nonfinite = 0.0  # fraction of the sampled values that are NaN or inf
+        self.error = None  # why the formula cannot be used, None if it can
+        self.timed_out = False
+        self.skipped = False  # the worker was still starting, the formula was not tried
+        self._fits = {}  # backend name: (fixed seconds, seconds per grid point)
+
+    @property
+    def fastest(self):
+        """Name of the backend with the lowest estimated frame time, None without estimates"""
+        return min(self.seconds, key=self.seconds.get) if self.seconds else None
+
+    def estimate(self, backend, grid_points):
+        """Estimated seconds per frame of a backend at another resolution"""
+        fixed, per_point = self._fits[backend]
+        return fixed + per_point * grid_points ** 2
+
+    def points_within(self, seconds, backend):
+        """Highest resolution whose estimated frame time stays within seconds"""
+        fixed, per_point = self._fits[backend]
+        if per_point <= 0:
+            return self.grid_points
+        return min(self.grid_points, int((max(0.0, seconds - fixed) / per_point) ** 0.5))
+
+    def fit(self, backend, sample_points, seconds):
+        """Fit fixed + per_point * n² through the frame times of the two largest samples"""
+        (n1, n2), (t1, t2) = sample_points[-2:], seconds[-2:]
+        per_point = max(0.0, (t2 - t1) / (n2 ** 2 - n1 ** 2))
+        fixed = max(0.0, t1 - per_point * n1 ** 2)
+        self._fits[backend] = (fixed, per_point)
+        self.seconds[backend] = self.estimate(backend, self.grid_points)
+
+
+def _warm_up():
+    """Import the formula compiler and the backends once in the worker"""
+    import evaluation  # noqa: F401
+    import expression  # noqa: F401
+    return True
+
+
+def _trial(text, grid_points, x_limits, y_limits, dtype, params, sample_points, repeat=3):
+    """Evaluate text on sample grids in the worker process and extrapolate to grid_points"""
+    from evaluation import NumexprBackend, TiledEvaluator
+    from expression import compile_formula
+    from grid import GridBuffers
+    from instrumentation import AllocationCounter
+
+    report = TrialReport(grid_points)
+    backends = []
+    try:
+        formula = compile_formula(text)
+        backends = [backend for backend in (TiledEvaluator(1), NumexprBackend(1))
+                    if getattr(backend, 'available', True) and backend.supports(formula, dtype)]
+        times = {backend.name: [] for backend in backends}
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for n in sample_points:
+                grid = GridBuffers()
+                grid.ensure(n, x_limits, y_limits, dtype)
+                Z = np.empty_like(grid.X)
+                for backend in backends:
+                    # the first frame fills the invariant cache, the following ones are steady state
+                    backend.evaluate(formula, grid, params[0], Z)
+                    best = np.inf
+                    for _ in range(repeat):
+                        for p in params:
+                            start = time.perf_counter()
+                            backend.evaluate(formula, grid, p, Z)
+                            best = min(best, time.perf_counter() - start)
+                    times[backend.name].append(best)
+
+            # first frame on a fresh grid, with the invariant terms, is the most memory hungry
+            n = sample_points[-1]
+            grid = GridBuffers()
+            grid.ensure(n, x_limits, y_limits, dtype)
+            Z = np.empty_like(grid.X)
+            with AllocationCounter() as counter:
+                backends[0].evaluate(formula, grid, params[0], Z)
+            # X, Y and Z of the full grid plus the temporaries, scaled with the points
+            report.peak_bytes = int((counter.peak + 3 * Z.nbytes) * (grid_points / n) ** 2)
+            nonfinite = 0
+            for p in params:
+                backends[0].evaluate(formula, grid, p, Z)
+                nonfinite += Z.size - np.count_nonzero(np.isfinite(Z))
+            report.nonfinite = nonfinite / (Z.size * len(params))
+        for name, seconds in times.items():
+            report.fit(name, sample_points, seconds)
+    except Exception as e:
+        report.error = f"The formula cannot be evaluated: {e}"
+    finally:
+        for backend in backends:
+            backend.shutdown()
+    return report
+
+
+class FormulaTrial:
+    def __init__(self, timeout=1.0, sample_points=(32, 64)):
+        """Trial evaluation of formulas in a worker process, before they reach the render loop
+
+        The worker evaluates a formula on small sample grids with every
+        available single-threaded backend. A trial that runs longer than
+        timeout seconds kills the worker, which is started again right away.
+        start() launches the worker early so its imports are done by the
+        first trial. Waiting for a worker that is still starting counts into
+        the timeout, a trial it leaves no time for is skipped.
+        """
+        self.timeout = timeout
+        self.sample_points = sample_points
+        self._pool = None
+        self._warm = None
+
+    def start(self):
+        """Launch the worker process if it is not running"""
+        if self._pool is None:
+            self._pool = multiprocessing.get_context('spawn').Pool(1)
+            self._warm = self._pool.apply_async(_warm_up)
+
+    def run(self, text, grid_points, x_limits, y_limits, dtype, params):
+        """TrialReport of text at grid_points, with params a list of (a, b, c) to sample"""
+        self.start()
+        deadline = time.perf_counter() + self.timeout
+        starting = not self._warm.ready()
+        self._warm.wait(self.timeout)
+        if not self._warm.ready():
+            report = TrialReport(grid_points)
+            report.skipped = True
+            return report
+        params = [tuple(float(v) for v in p) for p in params]
+        result = self._pool.apply_async(_trial, (text, grid_points, tuple(x_limits), tuple(y_limits), str(dtype),
+                                                 params, self.sample_points))
+        try:
+            return result.get(max(0.0, deadline - time.perf_counter()))
+        except multiprocessing.TimeoutError:
+            self.close()
+            self.start()  # warms up while the next formula is typed
+            report = TrialReport(grid_points)
+            if starting:
+                # the start-up took part of the time limit, that says nothing about the formula
+                report.skipped = True
+                return report
+            report.timed_out = True
+            report.error = (f"The formula takes longer than {self.timeout:g} s on a "
+                            f"{self.sample_points[-1]}² sample grid.")
+            return report
+
+    def close(self):
+        """Kill the worker process"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None